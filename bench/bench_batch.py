@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""Publish throughput through the broker, one request per message vs 'batch'.
+
+Starts a local stack (reference, pub/sub proxy, broker and one servidor, see
+loadgen.start_stack), creates a channel and then sends --messages 'publish'
+requests from one REQ client: first one round trip per message, then in
+'batch' requests of --batch messages.
+
+    python bench/bench_batch.py --messages 2000 --batch 50
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+import zmq
+
+sys.path.insert(0, os.path.dirname(__file__))
+from loadgen import start_stack, stop_stack, call  # noqa: E402
+
+
+def publish(i):
+    return {'user': 'bench', 'channel': 'bench', 'message': f'mensagem {i}', 'timestamp': '00:00:00', 'clock': i}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='publish vs batch throughput benchmark')
+    parser.add_argument('--messages', type=int, default=2000)
+    parser.add_argument('--batch', type=int, default=50)
+    args = parser.parse_args()
+
+    procs = start_stack(tempfile.mkdtemp(prefix='bench-batch-'))
+    ctx = zmq.Context()
+    s = ctx.socket(zmq.REQ)
+    s.setsockopt(zmq.RCVTIMEO, 10000)
+    s.setsockopt(zmq.LINGER, 0)
+    s.connect('tcp://127.0.0.1:5555')
+    try:
+        call(s, 'login', {'user': 'bench', 'timestamp': '00:00:00'})
+        call(s, 'channel', {'channel': 'bench', 'timestamp': '00:00:00'})
+
+        start = time.perf_counter()
+        ok = 0
+        for i in range(args.messages):
+            ok += call(s, 'publish', publish(i))['data']['status'] == 'OK'
+        single = time.perf_counter() - start
+        print(f"single  messages={args.messages} ok={ok} rate={args.messages / single:,.0f} msg/s "
+              f"round trips={args.messages}")
+
+        start = time.perf_counter()
+        ok = trips = 0
+        for first in range(0, args.messages, args.batch):
+            items = [{'service': 'publish', 'data': publish(i)}
+                     for i in range(first, min(first + args.batch, args.messages))]
+            reply = call(s, 'batch', {'requests': items, 'clock': first})
+            ok += sum(r['data']['status'] == 'OK' for r in reply['data']['replies'])
+            trips += 1
+        batched = time.perf_counter() - start
+        print(f"batch   messages={args.messages} ok={ok} rate={args.messages / batched:,.0f} msg/s "
+              f"round trips={trips} (batch={args.batch}, {single / batched:.1f}x)")
+    finally:
+        s.close(0)
+        ctx.term()
+        stop_stack(procs)
+
+
+if __name__ == '__main__':
+    main()
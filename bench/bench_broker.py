@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+"""Request latency through the broker when one replica is slow.
+
+Starts req-rep/broker.py in the given --mode (proxy: round-robin DEALER back end;
+lb: load-balancing ROUTER back end) and --workers simulated servers in this
+process, each answering one request at a time after --work-ms; the first one
+takes --slow-ms instead, like a replica stuck on a slow disk or a sync round.
+--clients REQ sockets then send requests back to back for --duration seconds.
+
+With --kill-after the first server crashes (stops answering and heartbeating)
+that many seconds into the run; the report then shows how long its requests
+took to be answered elsewhere (idempotent --service, e.g. users) or failed
+(e.g. login).
+
+    python bench/bench_broker.py --mode proxy
+    python bench/bench_broker.py --mode lb
+    python bench/bench_broker.py --mode lb --slow-ms 2 --kill-after 2 --service users
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+import msgpack
+import zmq
+
+BROKER = os.path.join(os.path.dirname(__file__), '..', 'req-rep', 'broker.py')
+
+
+def pct(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def worker(ctx, mode, delay, stop, served, heartbeat):
+    if mode == 'lb':
+        s = ctx.socket(zmq.DEALER)
+        s.connect('tcp://127.0.0.1:5556')
+        s.send_multipart([b'', b'READY', b'1'])
+    else:
+        s = ctx.socket(zmq.REP)
+        s.connect('tcp://127.0.0.1:5556')
+    s.setsockopt(zmq.RCVTIMEO, 100)
+    s.setsockopt(zmq.LINGER, 0)
+    next_beat = time.monotonic() + heartbeat
+    while not stop.is_set():
+        if mode == 'lb' and time.monotonic() >= next_beat:
+            s.send_multipart([b'', b'HEARTBEAT', b'1'])
+            next_beat = time.monotonic() + heartbeat
+        try:
+            frames = s.recv_multipart()
+        except zmq.Again:
+            continue
+        time.sleep(delay)
+        if stop.is_set():
+            break
+        s.send_multipart(frames[:-1] + [OK])
+        served.append(1)
+    s.close(0)
+
+
+OK = msgpack.packb({'service': 'bench', 'data': {'status': 'sucesso'}})
+
+
+def drive(ctx, clients, duration, payload):
+    socks = []
+    poller = zmq.Poller()
+    sent_at = {}
+    for _ in range(clients):
+        s = ctx.socket(zmq.REQ)
+        s.setsockopt(zmq.LINGER, 0)
+        s.connect('tcp://127.0.0.1:5555')
+        poller.register(s, zmq.POLLIN)
+        socks.append(s)
+    for s in socks:
+        sent_at[s] = time.perf_counter()
+        s.send(payload)
+    latencies = []
+    errors = 0
+    end = time.perf_counter() + duration
+    while time.perf_counter() < end:
+        for s, _ in poller.poll(100):
+            if s.recv() != OK:
+                errors += 1
+            now = time.perf_counter()
+            latencies.append(now - sent_at[s])
+            sent_at[s] = now
+            s.send(payload)
+    # clients still waiting after a second at the end lost their request for good
+    hung = sum(1 for s in socks if time.perf_counter() - sent_at[s] > 1.0)
+    for s in socks:
+        s.close(0)
+    return latencies, errors, hung
+
+
+def main():
+    parser = argparse.ArgumentParser(description='broker routing benchmark with one slow replica')
+    parser.add_argument('--mode', choices=['proxy', 'lb'], default='lb')
+    parser.add_argument('--workers', type=int, default=3)
+    parser.add_argument('--clients', type=int, default=6)
+    parser.add_argument('--work-ms', type=float, default=2.0)
+    parser.add_argument('--slow-ms', type=float, default=100.0)
+    parser.add_argument('--duration', type=float, default=5.0)
+    parser.add_argument('--kill-after', type=float, default=None, help='crash the first server after N seconds')
+    parser.add_argument('--service', default='users', help='service named in the requests')
+    parser.add_argument('--heartbeat', type=float, default=1.0, help='BROKER_HEARTBEAT_INTERVAL')
+    args = parser.parse_args()
+
+    env = dict(os.environ, BROKER_MODE=args.mode, BROKER_HEARTBEAT_INTERVAL=str(args.heartbeat))
+    proc = subprocess.Popen([sys.executable, BROKER], env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    ctx = zmq.Context()
+    stop = threading.Event()
+    stops = [threading.Event() if i == 0 else stop for i in range(args.workers)]
+    served = [[] for _ in range(args.workers)]
+    payload = msgpack.packb({'service': args.service, 'data': {}})
+    try:
+        time.sleep(1.0)
+        for i in range(args.workers):
+            delay = (args.slow_ms if i == 0 else args.work_ms) / 1000
+            threading.Thread(target=worker, args=(ctx, args.mode, delay, stops[i], served[i], args.heartbeat),
+                             daemon=True).start()
+        time.sleep(0.5)
+        if args.kill_after is not None:
+            threading.Timer(args.kill_after, stops[0].set).start()
+        start = time.perf_counter()
+        lat, errors, hung = drive(ctx, args.clients, args.duration, payload)
+        elapsed = time.perf_counter() - start
+        print(f"{args.mode:6s} done={len(lat)} rate={len(lat) / elapsed:,.0f}/s p50={pct(lat, .5) * 1e3:.1f}ms "
+              f"p99={pct(lat, .99) * 1e3:.1f}ms max={max(lat, default=0) * 1e3:.0f}ms errors={errors} hung={hung} "
+              f"served per worker (slow first)={[len(s) for s in served]}")
+        if args.mode == 'lb':
+            s = ctx.socket(zmq.REQ)
+            s.setsockopt(zmq.RCVTIMEO, 2000)
+            s.setsockopt(zmq.LINGER, 0)
+            s.connect('tcp://127.0.0.1:5554')
+            s.send(b'stats')
+            report = json.loads(s.recv())
+            s.close(0)
+            print(f"       broker: queue peak={report['totals']['queue_peak']} "
+                  f"queue wait p99={report['queue_wait_p99_ms']}ms failovers={report['failovers']}")
+    finally:
+        stop.set()
+        stops[0].set()
+        proc.terminate()
+        proc.wait()
+        time.sleep(0.3)
+        ctx.term()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+"""Publish throughput of one client: lockstep REQ vs pipelined DEALER.
+
+Starts the local stack of loadgen.py (one servidor in --server-mode) and
+publishes --messages messages from a single client, first with a REQ socket
+(one request in flight) and then with req-rep/pipeline_client.py at each --window.
+
+    python bench/bench_pipeline.py --messages 3000 --window 8 64
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+import zmq
+
+sys.path.insert(0, os.path.dirname(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'req-rep'))
+from bench_batch import publish  # noqa: E402
+from loadgen import start_stack, stop_stack, call  # noqa: E402
+from pipeline_client import PipelineClient  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description='REQ vs pipelined DEALER throughput benchmark')
+    parser.add_argument('--messages', type=int, default=3000)
+    parser.add_argument('--window', type=int, nargs='+', default=[8, 64])
+    parser.add_argument('--server-mode', default='rep', help='SERVER_MODE of the servidor')
+    args = parser.parse_args()
+
+    procs = start_stack(tempfile.mkdtemp(prefix='bench-pipeline-'), server_env={'SERVER_MODE': args.server_mode})
+    ctx = zmq.Context()
+    s = ctx.socket(zmq.REQ)
+    s.setsockopt(zmq.RCVTIMEO, 10000)
+    s.setsockopt(zmq.LINGER, 0)
+    s.connect('tcp://127.0.0.1:5555')
+    try:
+        call(s, 'login', {'user': 'bench', 'timestamp': '00:00:00'})
+        call(s, 'channel', {'channel': 'bench', 'timestamp': '00:00:00'})
+
+        start = time.perf_counter()
+        ok = sum(call(s, 'publish', publish(i))['data']['status'] == 'OK' for i in range(args.messages))
+        base = args.messages / (time.perf_counter() - start)
+        print(f"REQ              mode={args.server_mode} ok={ok}/{args.messages} rate={base:,.0f} msg/s")
+
+        for window in args.window:
+            with PipelineClient('127.0.0.1:5555', window=window, timeout=10.0, ctx=ctx) as client:
+                start = time.perf_counter()
+                replies = client.call_many([('publish', publish(i)) for i in range(args.messages)])
+                rate = args.messages / (time.perf_counter() - start)
+            ok = sum(1 for r in replies if r and r['data']['status'] == 'OK')
+            print(f"DEALER window={window:<4d} mode={args.server_mode} ok={ok}/{args.messages} "
+                  f"rate={rate:,.0f} msg/s ({rate / base:.1f}x)")
+    finally:
+        s.close(0)
+        ctx.term()
+        stop_stack(procs)
+
+
+if __name__ == '__main__':
+    main()
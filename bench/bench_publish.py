@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""Compare pub/sub fan-out throughput of a per-message PUB socket (context +
+connect + send + term, as servidor.py used to do) against one long-lived
+PUB socket, through a local XSUB/XPUB proxy.
+
+Both paths are timed from the first send until the last message reaches the
+subscriber (or until --deadline seconds pass without completing), so the rate
+is the delivery rate, not the rate of queueing into the socket.
+
+    python bench/bench_publish.py --messages 2000
+"""
+
+import argparse
+import threading
+import time
+import zmq
+
+
+def run_proxy(ctx, xsub_port, xpub_port):
+    xsub = ctx.socket(zmq.XSUB)
+    xsub.bind(f"tcp://127.0.0.1:{xsub_port}")
+    xpub = ctx.socket(zmq.XPUB)
+    xpub.bind(f"tcp://127.0.0.1:{xpub_port}")
+    try:
+        zmq.proxy(xsub, xpub)
+    except zmq.ContextTerminated:
+        pass
+    finally:
+        xsub.close(0)
+        xpub.close(0)
+
+
+def count_received(ctx, xpub_port, topic, counter, stop):
+    """counter = [delivered, perf_counter() of the last delivery]"""
+    sub = ctx.socket(zmq.SUB)
+    sub.connect(f"tcp://127.0.0.1:{xpub_port}")
+    sub.setsockopt_string(zmq.SUBSCRIBE, topic)
+    sub.setsockopt(zmq.RCVTIMEO, 50)
+    while not stop.is_set():
+        try:
+            sub.recv()
+            counter[0] += 1
+            counter[1] = time.perf_counter()
+        except zmq.Again:
+            continue
+    sub.close(0)
+
+
+def per_message(xsub_port, topic, n):
+    for i in range(n):
+        ctx = zmq.Context()
+        pub = ctx.socket(zmq.PUB)
+        pub.connect(f"tcp://127.0.0.1:{xsub_port}")
+        pub.send_string(f"{topic} bench: msg {i}")
+        pub.close()
+        ctx.term()
+
+
+def persistent(ctx, xsub_port):
+    pub = ctx.socket(zmq.PUB)
+    pub.setsockopt(zmq.SNDHWM, 10000)
+    pub.connect(f"tcp://127.0.0.1:{xsub_port}")
+    time.sleep(0.2)  # connected once at startup, like servidor.py's Publisher
+    return pub
+
+
+def send_all(pub, topic, n):
+    for i in range(n):
+        pub.send_string(f"{topic} bench: msg {i}")
+
+
+def measure(ctx, args, label, fn):
+    topic = f"bench-{label}"
+    counter = [0, None]
+    stop = threading.Event()
+    t = threading.Thread(target=count_received, args=(ctx, args.xpub_port, topic, counter, stop), daemon=True)
+    t.start()
+    time.sleep(0.3)
+    start = time.perf_counter()
+    fn(topic)
+    sent_at = time.perf_counter()
+    # wait for every message to be delivered, or give up at the deadline
+    while counter[0] < args.messages and time.perf_counter() - start < args.deadline:
+        time.sleep(0.005)
+    stop.set()
+    t.join()
+    delivered = counter[0]
+    end = max(sent_at, counter[1] or sent_at)
+    elapsed = end - start
+    rate = delivered / elapsed if elapsed > 0 else float('inf')
+    print(f"{label:12s} sent={args.messages} delivered={delivered} "
+          f"elapsed={elapsed:.3f}s delivered_rate={rate:,.0f} msg/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='PUB socket fan-out benchmark')
+    parser.add_argument('--messages', type=int, default=2000)
+    parser.add_argument('--xsub-port', type=int, default=15557)
+    parser.add_argument('--xpub-port', type=int, default=15558)
+    parser.add_argument('--deadline', type=float, default=10.0, help='seconds to wait for delivery')
+    args = parser.parse_args()
+
+    ctx = zmq.Context()
+    threading.Thread(target=run_proxy, args=(ctx, args.xsub_port, args.xpub_port), daemon=True).start()
+    time.sleep(0.2)
+    measure(ctx, args, 'per-message', lambda topic: per_message(args.xsub_port, topic, args.messages))
+    pub = persistent(ctx, args.xsub_port)
+    measure(ctx, args, 'persistent', lambda topic: send_all(pub, topic, args.messages))
+    pub.close(0)
+    ctx.term()
+
+
+if __name__ == '__main__':
+    main()
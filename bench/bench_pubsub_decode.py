@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""Decoded messages per second for one subscriber, text vs multipart msgpack framing.
+
+A publisher pushes --messages channel messages through a local XSUB/XPUB proxy
+in each framing, shaped like servidor.py's publish. The subscriber turns every
+message into (topic, sender, body, timestamp, clock):
+
+- text: "<topic> <user>: <body> [HH:MM:SS] (clock=N)" -> split + regex
+- msgpack: [topic, {sender, clock, timestamp, body}] -> two recv() + unpackb
+
+The subscriber only starts reading once every message is queued on its socket,
+so the rate reflects receive + decode cost alone, not the publisher or proxy
+competing for the same CPU.
+
+    python bench/bench_pubsub_decode.py --messages 200000
+"""
+
+import argparse
+import re
+import threading
+import time
+import msgpack
+import zmq
+
+TEXT_RE = re.compile(r"^(?P<sender>[^:]*): (?P<body>.*) \[(?P<timestamp>[^\]]*)\] \(clock=(?P<clock>\d+)\)$", re.S)
+
+
+def run_proxy(ctx, xsub_port, xpub_port):
+    xsub = ctx.socket(zmq.XSUB)
+    xsub.setsockopt(zmq.RCVHWM, 0)
+    xsub.bind(f"tcp://127.0.0.1:{xsub_port}")
+    xpub = ctx.socket(zmq.XPUB)
+    xpub.setsockopt(zmq.SNDHWM, 0)
+    xpub.bind(f"tcp://127.0.0.1:{xpub_port}")
+    try:
+        zmq.proxy(xsub, xpub)
+    except zmq.ContextTerminated:
+        pass
+    finally:
+        xsub.close(0)
+        xpub.close(0)
+
+
+def decode_text(sub):
+    topic, _, rest = sub.recv().decode("utf-8").partition(" ")
+    m = TEXT_RE.match(rest)
+    return topic, m.group("sender"), m.group("body"), m.group("timestamp"), int(m.group("clock"))
+
+
+def decode_msgpack(sub):
+    # always two frames: two recv() calls are ~3x cheaper than recv_multipart() in pyzmq
+    topic = sub.recv()
+    f = msgpack.unpackb(sub.recv(), raw=False)
+    return topic.decode("utf-8"), f["sender"], f["body"], f["timestamp"], f["clock"]
+
+
+def subscribe(ctx, xpub_port, topic, decode, n, result, ready, go):
+    sub = ctx.socket(zmq.SUB)
+    sub.setsockopt(zmq.RCVHWM, 0)
+    sub.connect(f"tcp://127.0.0.1:{xpub_port}")
+    sub.setsockopt_string(zmq.SUBSCRIBE, topic)
+    sub.setsockopt(zmq.RCVTIMEO, 2000)
+    ready.set()
+    go.wait()
+    count, first, last = 0, None, None
+    try:
+        while count < n:
+            fields = decode(sub)
+            if fields[0] != topic:
+                continue
+            count += 1
+            last = time.perf_counter()
+            if first is None:
+                first = last
+    except zmq.Again:
+        pass
+    sub.close(0)
+    result.extend([count, first, last])
+
+
+def publish(ctx, xsub_port, topic, framing, n, body):
+    pub = ctx.socket(zmq.PUB)
+    pub.setsockopt(zmq.SNDHWM, 0)
+    pub.connect(f"tcp://127.0.0.1:{xsub_port}")
+    time.sleep(0.3)
+    for i in range(n):
+        if framing == "text":
+            pub.send_string(f"{topic} ana: {body} [12:00:00] (clock={i})")
+        else:
+            pub.send_multipart([topic.encode("utf-8"), msgpack.packb(
+                {"sender": "ana", "clock": i, "timestamp": "12:00:00", "body": body}, use_bin_type=True)])
+    return pub
+
+
+def wait_queued(seconds=1.0):
+    # the subscriber is not reading yet: give the proxy time to move everything
+    time.sleep(seconds)
+
+
+def measure(ctx, args, framing, decode):
+    topic = f"bench-{framing}"
+    result, ready, go = [], threading.Event(), threading.Event()
+    t = threading.Thread(target=subscribe, args=(ctx, args.xpub_port, topic, decode, args.messages, result, ready, go))
+    t.start()
+    ready.wait()
+    time.sleep(0.3)
+    pub = publish(ctx, args.xsub_port, topic, framing, args.messages, "x" * args.size)
+    wait_queued(args.settle)
+    go.set()
+    t.join()
+    pub.close(0)
+    count, first, last = result
+    elapsed = (last - first) if count > 1 else 0.0
+    rate = (count - 1) / elapsed if elapsed > 0 else 0.0
+    print(f"{framing:8s} decoded={count}/{args.messages} elapsed={elapsed:.3f}s rate={rate:,.0f} msg/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='pub/sub decode throughput per subscriber')
+    parser.add_argument('--messages', type=int, default=200000)
+    parser.add_argument('--size', type=int, default=64, help='message body length')
+    parser.add_argument('--settle', type=float, default=2.0, help='seconds to let the proxy deliver before reading')
+    parser.add_argument('--xsub-port', type=int, default=15567)
+    parser.add_argument('--xpub-port', type=int, default=15568)
+    args = parser.parse_args()
+
+    ctx = zmq.Context()
+    threading.Thread(target=run_proxy, args=(ctx, args.xsub_port, args.xpub_port), daemon=True).start()
+    time.sleep(0.2)
+    measure(ctx, args, "text", decode_text)
+    measure(ctx, args, "msgpack", decode_msgpack)
+    ctx.term()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""Heartbeat throughput of the reference service with many simulated servers.
+
+Starts req-rep/reference.py (or the script given with --script, e.g. an older
+checkout) on a fresh STORAGE_DIR, registers --servers servers with 'rank', then
+keeps every one of them sending heartbeats back to back for --duration
+seconds, one REQ socket per simulated server. A separate client issues 'list'
+requests in parallel to show how reads behave while heartbeats are flowing.
+
+    python bench/bench_reference.py --servers 500 --duration 5
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import msgpack
+import zmq
+
+DEFAULT_SCRIPT = os.path.join(os.path.dirname(__file__), '..', 'req-rep', 'reference.py')
+
+
+def pct(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def request(sock, service, data):
+    sock.send(msgpack.packb({'service': service, 'data': data}, use_bin_type=True))
+
+
+def drive(ctx, endpoint, n, service, duration):
+    """Keep n REQ sockets busy with `service`; returns (completed, latencies)."""
+    socks = []
+    poller = zmq.Poller()
+    for i in range(n):
+        s = ctx.socket(zmq.REQ)
+        s.setsockopt(zmq.LINGER, 0)
+        s.connect(endpoint)
+        poller.register(s, zmq.POLLIN)
+        socks.append(s)
+    sent_at = {}
+    for i, s in enumerate(socks):
+        sent_at[s] = time.perf_counter()
+        request(s, service, {'user': f'bench-{i}', 'address': f'bench-{i}:6000'})
+    index = {s: i for i, s in enumerate(socks)}
+    latencies = []
+    end = time.perf_counter() + duration
+    while time.perf_counter() < end:
+        for s, _ in poller.poll(100):
+            s.recv()
+            now = time.perf_counter()
+            latencies.append(now - sent_at[s])
+            if service == 'rank' or now >= end:
+                poller.unregister(s)
+                continue
+            sent_at[s] = now
+            request(s, service, {'user': f'bench-{index[s]}', 'address': f'bench-{index[s]}:6000'})
+        if service == 'rank' and len(latencies) == n:
+            break
+    for s in socks:
+        s.close(0)
+    return len(latencies), latencies
+
+
+def list_client(ctx, endpoint, stop, latencies):
+    s = ctx.socket(zmq.REQ)
+    s.setsockopt(zmq.LINGER, 0)
+    s.setsockopt(zmq.RCVTIMEO, 5000)
+    s.connect(endpoint)
+    while not stop.is_set():
+        t0 = time.perf_counter()
+        request(s, 'list', {})
+        try:
+            s.recv()
+        except zmq.Again:
+            break
+        latencies.append(time.perf_counter() - t0)
+    s.close(0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='reference heartbeat throughput benchmark')
+    parser.add_argument('--servers', type=int, default=500)
+    parser.add_argument('--duration', type=float, default=5.0)
+    parser.add_argument('--script', default=DEFAULT_SCRIPT, help='reference script to start')
+    parser.add_argument('--endpoint', default='tcp://127.0.0.1:5560')
+    args = parser.parse_args()
+
+    storage = tempfile.mkdtemp(prefix='bench-reference-')
+    env = dict(os.environ, STORAGE_DIR=storage, PUBSUB_ADDR='127.0.0.1:15557')
+    proc = subprocess.Popen([sys.executable, args.script], env=env, stdin=subprocess.DEVNULL,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    ctx = zmq.Context()
+    try:
+        time.sleep(1.0)
+        done, lat = drive(ctx, args.endpoint, args.servers, 'rank', 30.0)
+        print(f"rank       registered={done}/{args.servers} p50={pct(lat, .5) * 1e3:.2f}ms p99={pct(lat, .99) * 1e3:.2f}ms")
+
+        stop = threading.Event()
+        list_lat = []
+        t = threading.Thread(target=list_client, args=(ctx, args.endpoint, stop, list_lat), daemon=True)
+        t.start()
+        start = time.perf_counter()
+        done, lat = drive(ctx, args.endpoint, args.servers, 'heartbeat', args.duration)
+        elapsed = time.perf_counter() - start
+        stop.set()
+        t.join()
+        print(f"heartbeat  servers={args.servers} done={done} rate={done / elapsed:,.0f}/s "
+              f"p50={pct(lat, .5) * 1e3:.2f}ms p99={pct(lat, .99) * 1e3:.2f}ms")
+        print(f"list       done={len(list_lat)} p50={pct(list_lat, .5) * 1e3:.2f}ms "
+              f"p99={pct(list_lat, .99) * 1e3:.2f}ms (during heartbeats)")
+    finally:
+        proc.terminate()
+        proc.wait()
+        ctx.term()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,363 @@
+#!/usr/bin/env python3
+"""Load generator: replays the bot workload against a local stack and reports latency per service.
+
+Starts the pub/sub proxy, broker.py, reference.py and --servers servidor.py
+processes on their default localhost ports (fresh STORAGE_DIR), then runs
+--concurrency virtual bots from one process, each on its own REQ socket. A bot
+does what req-rep/js-bot/bot.js does: login, then rounds of 'channels' (creating
+a channel when there is none, or with probability --new-channel), followed by
+--burst sends to one channel: 'publish', or with probability --message-ratio a
+direct 'message' to another bot. Message bodies are --message-size bytes
+(N or MIN:MAX), with --think-ms between requests (0 = back to back).
+
+Throughput and p50/p95/p99 latency per service, measured after --warmup, are
+printed and written as JSON to --output. With --baseline, the run is compared
+to an earlier report and the exit status is 1 when a service got slower (p99)
+or slower to serve (throughput) by more than --tolerance.
+
+With --trace R, a fraction R of the publish/message requests carry a trace
+(msgpack framing is switched on) and pub-sub/subscriber.py --measure runs
+alongside; the report then also has a 'delivery' section with end-to-end
+delivery latency per topic and per hop.
+
+    python bench/loadgen.py --servers 3 --concurrency 32 --duration 20 --output report.json
+    python bench/loadgen.py --servers 3 --concurrency 32 --duration 20 --baseline report.json
+    python bench/loadgen.py --servers 3 --concurrency 32 --duration 20 --trace 0.1 --proxy-mode instrumented
+"""
+
+import argparse
+import heapq
+import json
+import os
+import platform
+import random
+import shutil
+import string
+import subprocess
+import sys
+import tempfile
+import time
+import msgpack
+import zmq
+
+ROOT = os.path.join(os.path.dirname(__file__), '..')
+FRONTEND = 'tcp://127.0.0.1:5555'
+sys.path.insert(0, os.path.join(ROOT, 'pub-sub'))
+import subscriber  # noqa: E402
+
+
+def start_stack(storage, servers=1, server_env=None, broker_env=None, proxy_env=None):
+    """Start proxy, broker, reference and `servers` servidor processes; returns the Popen list.
+
+    If the stack does not come up, whatever was started is stopped before the
+    error propagates, so no orphan keeps the ports bound.
+    """
+    env = dict(os.environ, STORAGE_DIR=storage, REFERENCE_ADDR='127.0.0.1:5560', BROKER_ADDR='127.0.0.1:5556',
+               PUBSUB_ADDR='127.0.0.1:5557', PUBSUB_SUB_ADDR='127.0.0.1:5558')
+    quiet = dict(stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    procs = []
+    try:
+        procs.append(subprocess.Popen([sys.executable, os.path.join(ROOT, 'pub-sub', 'proxy.py')],
+                                      env=dict(env, **(proxy_env or {})), **quiet))
+        procs.append(subprocess.Popen([sys.executable, os.path.join(ROOT, 'req-rep', 'broker.py')],
+                                      env=dict(env, **(broker_env or {})), **quiet))
+        procs.append(subprocess.Popen([sys.executable, os.path.join(ROOT, 'req-rep', 'reference.py')],
+                                      env=dict(env, STORAGE_DIR=os.path.join(storage, 'reference')), **quiet))
+        time.sleep(0.5)
+        for i in range(servers):
+            name = 'bench-server' if servers == 1 else f'bench-server-{i + 1}'
+            procs.append(subprocess.Popen([sys.executable, os.path.join(ROOT, 'req-rep', 'servidor.py')],
+                                          env=dict(env, SERVER_NAME=name, **(server_env or {})), **quiet))
+        wait_ready(servers)
+    except BaseException:
+        stop_stack(procs)
+        raise
+    return procs
+
+
+def stop_stack(procs):
+    for p in procs:
+        p.terminate()
+    for p in procs:
+        try:
+            p.wait(5)
+        except subprocess.TimeoutExpired:
+            p.kill()
+
+
+def wait_ready(servers, timeout=20.0):
+    """Wait until the broker answers and the reference lists every server."""
+    ctx = zmq.Context.instance()
+    deadline = time.monotonic() + timeout
+    for endpoint, ready in ((FRONTEND, lambda r: True),
+                            ('tcp://127.0.0.1:5560', lambda r: len(r['data'].get('list', [])) >= servers)):
+        while time.monotonic() < deadline:
+            s = ctx.socket(zmq.REQ)
+            s.setsockopt(zmq.LINGER, 0)
+            s.connect(endpoint)
+            s.send(msgpack.packb({'service': 'users' if endpoint == FRONTEND else 'list', 'data': {}}))
+            ok = s.poll(500) and ready(msgpack.unpackb(s.recv(), raw=False))
+            s.close(0)
+            if ok:
+                break
+            time.sleep(0.2)
+        else:
+            raise RuntimeError(f'pilha não respondeu em {timeout}s ({endpoint})')
+    # servers register with the reference before they connect to the broker
+    time.sleep(0.5)
+
+
+def call(sock, service, data):
+    sock.send(msgpack.packb({'service': service, 'data': data}, use_bin_type=True))
+    return msgpack.unpackb(sock.recv(), raw=False)
+
+
+def pct(values, p):
+    if not values:
+        return None
+    return round(values[min(len(values) - 1, int(len(values) * p))] * 1000, 3)
+
+
+class Bot:
+    """One virtual bot: a generator of (service, data) that receives each reply."""
+
+    def __init__(self, index, args, rng, logged):
+        self.name = f'lg-{index}-{rng.randrange(1 << 30):x}'
+        self.args = args
+        self.rng = rng
+        self.logged = logged
+        self.clock = 0
+        self.steps = self._steps()
+        self.next_request = next(self.steps)
+
+    def _body(self):
+        size = self.rng.randint(*self.args.message_size)
+        return ''.join(self.rng.choices(string.ascii_lowercase + string.digits, k=size))
+
+    def _steps(self):
+        ts = time.strftime('%H:%M:%S')
+        reply = yield 'login', {'user': self.name, 'timestamp': ts}
+        if reply is not None:
+            self.logged.append(self.name)
+        while True:
+            reply = yield 'channels', {'timestamp': ts}
+            channels = ((reply or {}).get('data') or {}).get('channels') or []
+            if not channels or self.rng.random() < self.args.new_channel:
+                new = f'chan-{self.rng.randrange(1 << 30):x}'
+                yield 'channel', {'channel': new, 'timestamp': ts}
+                channels = channels + [new]
+            channel = self.rng.choice(channels)
+            for _ in range(self.args.burst):
+                if self.rng.random() < self.args.message_ratio:
+                    yield 'message', {'src': self.name, 'dst': self.rng.choice(self.logged or [self.name]),
+                                      'message': self._body(), 'timestamp': ts}
+                else:
+                    yield 'publish', {'user': self.name, 'channel': channel, 'message': self._body(),
+                                      'timestamp': ts}
+
+    def payload(self):
+        service, data = self.next_request
+        self.clock += 1
+        data = dict(data, clock=self.clock)
+        if service in ('publish', 'message') and self.args.trace and self.rng.random() < self.args.trace:
+            data['trace'] = {'id': f'{self.name}-{self.clock}', 't0': time.time_ns()}
+        return msgpack.packb({'service': service, 'data': data}, use_bin_type=True)
+
+    def advance(self, reply):
+        data = (reply or {}).get('data') or {}
+        if isinstance(data.get('clock'), int):
+            self.clock = max(self.clock, data['clock'])
+        self.next_request = self.steps.send(reply)
+
+
+def run_load(args):
+    """Drive args.concurrency bots for args.duration seconds; returns the samples per service."""
+    ctx = zmq.Context.instance()
+    rng = random.Random(args.seed)
+    logged = []
+    bots = {}
+    poller = zmq.Poller()
+
+    def connect(bot):
+        s = ctx.socket(zmq.REQ)
+        s.setsockopt(zmq.LINGER, 0)
+        s.connect(FRONTEND)
+        poller.register(s, zmq.POLLIN)
+        bots[s] = [bot, 0.0]
+        return s
+
+    def send(s):
+        bots[s][1] = time.perf_counter()
+        s.send(bots[s][0].payload())
+
+    samples = {}
+    errors = {}
+    timeouts = {}
+    start = time.perf_counter()
+    measure_from = start + args.warmup
+    end = measure_from + args.duration
+    waiting = []  # (due, seq, socket): bots in think time
+    seq = 0
+    for i in range(args.concurrency):
+        send(connect(Bot(i, args, random.Random(rng.random()), logged)))
+    while True:
+        now = time.perf_counter()
+        if now >= end:
+            break
+        while waiting and waiting[0][0] <= now:
+            send(heapq.heappop(waiting)[2])
+        timeout = min(end, waiting[0][0] if waiting else end, now + 0.1) - now
+        for s, _ in poller.poll(max(0, int(timeout * 1000))):
+            reply = msgpack.unpackb(s.recv(), raw=False, strict_map_key=False)
+            now = time.perf_counter()
+            bot, sent_at = bots[s]
+            service = bot.next_request[0]
+            if sent_at >= measure_from:
+                samples.setdefault(service, []).append(now - sent_at)
+                if ((reply or {}).get('data') or {}).get('status') == 'erro':
+                    errors[service] = errors.get(service, 0) + 1
+            bot.advance(reply)
+            if args.think_ms > 0:
+                seq += 1
+                heapq.heappush(waiting, (now + args.think_ms / 1000, seq, s))
+            else:
+                send(s)
+        # lazy pirate: a REQ socket that lost its reply is replaced and the step retried
+        now = time.perf_counter()
+        in_think = {entry[2] for entry in waiting}
+        for s in [s for s, (_, sent_at) in bots.items() if s not in in_think and now - sent_at > args.timeout]:
+            bot = bots.pop(s)[0]
+            poller.unregister(s)
+            s.close(0)
+            service = bot.next_request[0]
+            timeouts[service] = timeouts.get(service, 0) + 1
+            send(connect(bot))
+    for s in bots:
+        s.close(0)
+    return samples, errors, timeouts
+
+
+def build_report(args, samples, errors, timeouts):
+    services = {}
+    total = 0
+    for service in sorted(set(samples) | set(timeouts)):
+        lat = sorted(samples.get(service, []))
+        total += len(lat)
+        services[service] = {
+            'count': len(lat),
+            'errors': errors.get(service, 0),
+            'timeouts': timeouts.get(service, 0),
+            'throughput': round(len(lat) / args.duration, 1),
+            'p50_ms': pct(lat, 0.50),
+            'p95_ms': pct(lat, 0.95),
+            'p99_ms': pct(lat, 0.99),
+            'max_ms': round(lat[-1] * 1000, 3) if lat else None,
+        }
+    return {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'host': {'cpus': os.cpu_count(), 'python': platform.python_version(), 'pyzmq': zmq.__version__},
+        'config': {k: v for k, v in vars(args).items() if k not in ('output', 'baseline')},
+        'total': {'count': total, 'throughput': round(total / args.duration, 1),
+                  'errors': sum(errors.values()), 'timeouts': sum(timeouts.values())},
+        'services': services,
+    }
+
+
+def compare(report, baseline, tolerance):
+    """Regressions of `report` against `baseline`: p99 up or throughput down by more than `tolerance`."""
+    problems = []
+    for service, cur in report['services'].items():
+        old = baseline.get('services', {}).get(service)
+        if not old:
+            continue
+        if old.get('p99_ms') and cur['p99_ms'] and cur['p99_ms'] > old['p99_ms'] * (1 + tolerance):
+            problems.append(f"{service}: p99 {old['p99_ms']}ms -> {cur['p99_ms']}ms")
+        if old.get('throughput') and cur['throughput'] < old['throughput'] * (1 - tolerance):
+            problems.append(f"{service}: vazão {old['throughput']}/s -> {cur['throughput']}/s")
+    return problems
+
+
+def print_report(report):
+    t = report['total']
+    print(f"total {t['count']} requisições, {t['throughput']:,.1f}/s, erros={t['errors']} timeouts={t['timeouts']}")
+    print(f"{'serviço':10s} {'n':>8s} {'req/s':>9s} {'erros':>6s} {'p50 ms':>8s} {'p95 ms':>8s} {'p99 ms':>8s} {'max ms':>8s}")
+    for service, st in report['services'].items():
+        print(f"{service:10s} {st['count']:>8d} {st['throughput']:>9,.1f} {st['errors'] + st['timeouts']:>6d} "
+              f"{str(st['p50_ms']):>8s} {str(st['p95_ms']):>8s} {str(st['p99_ms']):>8s} {str(st['max_ms']):>8s}")
+
+
+def size_range(text):
+    lo, _, hi = text.partition(':')
+    return int(lo), int(hi or lo)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='bot workload load generator with per-service latency report')
+    parser.add_argument('--servers', type=int, default=1, help='servidor processes to start')
+    parser.add_argument('--server-mode', default=None, help='SERVER_MODE (default rep, or lb with --broker-mode lb)')
+    parser.add_argument('--broker-mode', default='proxy', choices=['proxy', 'lb'])
+    parser.add_argument('--concurrency', type=int, default=16, help='virtual bots, one REQ socket each')
+    parser.add_argument('--duration', type=float, default=10.0, help='measured seconds')
+    parser.add_argument('--warmup', type=float, default=2.0, help='seconds run before measuring')
+    parser.add_argument('--burst', type=int, default=10, help='sends per channel round (bot.js: 10)')
+    parser.add_argument('--message-ratio', type=float, default=0.2, help='share of sends that are direct messages')
+    parser.add_argument('--new-channel', type=float, default=0.0, help='chance of creating a channel each round')
+    parser.add_argument('--message-size', type=size_range, default=(40, 40), help='body bytes, N or MIN:MAX')
+    parser.add_argument('--think-ms', type=float, default=0.0, help='pause between requests of one bot')
+    parser.add_argument('--timeout', type=float, default=5.0, help='seconds before a request counts as lost')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--framing', default='text', choices=['text', 'msgpack'], help='PUBSUB_FRAMING of the servers')
+    parser.add_argument('--proxy-mode', default='plain', choices=['plain', 'instrumented'], help='PROXY_MODE')
+    parser.add_argument('--trace', type=float, default=0.0,
+                        help='fraction of publish/message requests traced to a measuring subscriber')
+    parser.add_argument('--output', default='loadgen-report.json', help='JSON report file')
+    parser.add_argument('--baseline', default=None, help='earlier report to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed relative regression (0.2 = 20%%)')
+    parser.add_argument('--no-stack', action='store_true', help='use an already running stack')
+    args = parser.parse_args()
+    args.server_mode = args.server_mode or ('lb' if args.broker_mode == 'lb' else 'rep')
+    if args.trace:
+        args.framing = 'msgpack'
+
+    procs = []
+    storage = tempfile.mkdtemp(prefix='loadgen-')
+    delivery_file = os.path.join(storage, 'delivery.json')
+    try:
+        if not args.no_stack:
+            procs = start_stack(storage, args.servers,
+                                {'SERVER_MODE': args.server_mode, 'PUBSUB_FRAMING': args.framing},
+                                {'BROKER_MODE': args.broker_mode}, {'PROXY_MODE': args.proxy_mode})
+        if args.trace:
+            # runs through the warmup too; the extra second lets the last messages arrive
+            procs.append(subprocess.Popen(
+                [sys.executable, os.path.join(ROOT, 'pub-sub', 'subscriber.py'), '--measure',
+                 '--addr', '127.0.0.1:5558', '--duration', str(args.warmup + args.duration + 1),
+                 '--interval', '3600', '--output', delivery_file],
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+            time.sleep(0.5)
+        report = build_report(args, *run_load(args))
+        if args.trace:
+            procs[-1].wait(10)
+            with open(delivery_file) as f:
+                report['delivery'] = json.load(f)
+    finally:
+        stop_stack(procs)
+        shutil.rmtree(storage, ignore_errors=True)
+    print_report(report)
+    if 'delivery' in report:
+        subscriber.print_report(report['delivery'])
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"relatório em {args.output}")
+    if args.baseline:
+        with open(args.baseline) as f:
+            problems = compare(report, json.load(f), args.tolerance)
+        for p in problems:
+            print('REGRESSÃO', p)
+        if problems:
+            sys.exit(1)
+        print(f"sem regressões acima de {args.tolerance:.0%} em relação a {args.baseline}")
+
+
+if __name__ == '__main__':
+    main()
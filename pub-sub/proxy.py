@@ -1,5 +1,20 @@
+import os
+import time
+import json
 import zmq
 
+# plain: zmq.proxy em C, sem visibilidade; instrumented: laço próprio com contadores
+# por tópico, contagem de assinaturas, descartes por HWM e socket de controle
+PROXY_MODE = os.environ.get("PROXY_MODE", "plain")
+PROXY_CONTROL_ADDR = os.environ.get("PROXY_CONTROL_ADDR", "tcp://*:5559")
+# opcional: com XPUB_NODROP, a fila cheia de um assinante faz o envio falhar em vez
+# de descartar em silêncio (única forma de contar descartes por HWM); a mensagem
+# então não chega a nenhum assinante do tópico, nem aos rápidos: o assinante mais
+# lento (ex.: um assinante de "" como subscriber.py --measure) dita o ritmo
+PROXY_NODROP = os.environ.get("PROXY_NODROP", "0") != "0"
+PROXY_HWM = int(os.environ.get("PROXY_HWM", "1000"))
+PROXY_RATE_INTERVAL = float(os.environ.get("PROXY_RATE_INTERVAL", "1.0"))
+
 context = zmq.Context()
 
 # XSUB socket para publishers
@@ -10,8 +25,163 @@ xsub.bind("tcp://*:5557")
 xpub = context.socket(zmq.XPUB)
 xpub.bind("tcp://*:5558")
 
+
+def topic_of(frames):
+    # framing msgpack: tópico na primeira parte; texto: "<tópico> <payload>"
+    if len(frames) > 1:
+        return frames[0]
+    return frames[0].split(b" ", 1)[0]
+
+
+class TrafficStats:
+    """Contadores por tópico (mensagens, bytes, descartes) e número de assinaturas."""
+
+    def __init__(self):
+        self.started = time.time()
+        self.topics = {}
+        self.subscriptions = {}
+        self.totals = {"msgs": 0, "bytes": 0, "drops": 0}
+        self._last = {}
+        self._last_tick = time.monotonic()
+
+    def _topic(self, topic):
+        st = self.topics.get(topic)
+        if st is None:
+            st = self.topics[topic] = {"msgs": 0, "bytes": 0, "drops": 0, "msgs_per_s": 0.0, "bytes_per_s": 0.0}
+        return st
+
+    def forwarded(self, topic, size):
+        st = self._topic(topic)
+        st["msgs"] += 1
+        st["bytes"] += size
+        self.totals["msgs"] += 1
+        self.totals["bytes"] += size
+
+    def dropped(self, topic):
+        self._topic(topic)["drops"] += 1
+        self.totals["drops"] += 1
+
+    def subscription(self, topic, subscribe):
+        n = self.subscriptions.get(topic, 0) + (1 if subscribe else -1)
+        if n > 0:
+            self.subscriptions[topic] = n
+        else:
+            self.subscriptions.pop(topic, None)
+
+    def tick(self):
+        """Recalcula as taxas por tópico no último intervalo."""
+        now = time.monotonic()
+        elapsed = now - self._last_tick
+        if elapsed <= 0:
+            return
+        for topic, st in self.topics.items():
+            msgs, nbytes = self._last.get(topic, (0, 0))
+            st["msgs_per_s"] = round((st["msgs"] - msgs) / elapsed, 1)
+            st["bytes_per_s"] = round((st["bytes"] - nbytes) / elapsed, 1)
+            self._last[topic] = (st["msgs"], st["bytes"])
+        self._last_tick = now
+
+    def report(self, top=20):
+        name = lambda t: t.decode("utf-8", "replace")
+        hot = sorted(self.topics.items(), key=lambda kv: (kv[1]["msgs_per_s"], kv[1]["msgs"]), reverse=True)
+        if top:
+            hot = hot[:top]
+        return {
+            "uptime": round(time.time() - self.started, 1),
+            "totals": dict(self.totals),
+            "topics": [dict(st, topic=name(t), subscribers=self.subscriptions.get(t, 0)) for t, st in hot],
+            "subscriptions": {name(t): n for t, n in self.subscriptions.items()},
+        }
+
+    def reset(self):
+        # assinaturas são estado, não estatística: sobrevivem ao reset
+        subscriptions = self.subscriptions
+        self.__init__()
+        self.subscriptions = subscriptions
+
+
+def run_instrumented():
+    stats = TrafficStats()
+    paused = False
+    # recebe toda assinatura/cancelamento, não só a primeira/última de cada tópico
+    xpub.setsockopt(getattr(zmq, "XPUB_VERBOSER", zmq.XPUB_VERBOSE), 1)
+    xpub.setsockopt(zmq.SNDHWM, PROXY_HWM)
+    if PROXY_NODROP:
+        xpub.setsockopt(zmq.XPUB_NODROP, 1)
+    control = context.socket(zmq.REP)
+    control.bind(PROXY_CONTROL_ADDR)
+    poller = zmq.Poller()
+    poller.register(xsub, zmq.POLLIN)
+    poller.register(xpub, zmq.POLLIN)
+    poller.register(control, zmq.POLLIN)
+    next_tick = time.monotonic() + PROXY_RATE_INTERVAL
+    print(f"[proxy_pubsub] modo instrumentado; controle em {PROXY_CONTROL_ADDR} (NODROP={PROXY_NODROP})")
+    while True:
+        timeout = max(0, int((next_tick - time.monotonic()) * 1000))
+        events = dict(poller.poll(timeout))
+        if xsub in events:
+            # publishers -> assinantes, em rajadas limitadas para o controle continuar respondendo
+            for _ in range(1000):
+                try:
+                    frames = xsub.recv_multipart(zmq.NOBLOCK)
+                except zmq.Again:
+                    break
+                topic = topic_of(frames)
+                if len(frames) == 3:
+                    # mensagem rastreada (tópico, campos, trace): carimba a passagem pelo proxy
+                    frames.append(str(time.time_ns()).encode())
+                try:
+                    xpub.send_multipart(frames, zmq.NOBLOCK)
+                    stats.forwarded(topic, sum(len(f) for f in frames))
+                except zmq.Again:
+                    stats.dropped(topic)
+        if xpub in events:
+            # assinaturas sobem para os publishers: b"\x01tópico" assina, b"\x00tópico" cancela
+            while True:
+                try:
+                    frames = xpub.recv_multipart(zmq.NOBLOCK)
+                except zmq.Again:
+                    break
+                msg = frames[0]
+                if msg and msg[0] in (0, 1):
+                    stats.subscription(msg[1:], msg[0] == 1)
+                xsub.send_multipart(frames)
+        if control in events:
+            raw = control.recv_multipart()[0]
+            try:
+                # dentro do try: um comando que não é UTF-8 recebe erro em vez de derrubar o laço
+                parts = raw.decode("utf-8").split()
+                cmd = parts[0].lower() if parts else ""
+                if cmd == "stats":
+                    top = 0 if len(parts) > 1 and parts[1] == "all" else int(parts[1]) if len(parts) > 1 else 20
+                    reply = dict(stats.report(top), paused=paused, nodrop=PROXY_NODROP)
+                elif cmd in ("pause", "resume"):
+                    # pausado, as mensagens esperam no XSUB (e depois nos publishers,
+                    # até o HWM deles); as assinaturas continuam passando
+                    if cmd == "pause" and not paused:
+                        poller.unregister(xsub)
+                    elif cmd == "resume" and paused:
+                        poller.register(xsub, zmq.POLLIN)
+                    paused = cmd == "pause"
+                    reply = {"paused": paused}
+                elif cmd == "reset":
+                    stats.reset()
+                    reply = {"reset": True}
+                else:
+                    reply = {"erro": "comando desconhecido (use stats [N|all], pause, resume, reset)"}
+            except Exception as e:
+                reply = {"erro": str(e)}
+            control.send_string(json.dumps(reply, ensure_ascii=False))
+        if time.monotonic() >= next_tick:
+            stats.tick()
+            next_tick = time.monotonic() + PROXY_RATE_INTERVAL
+
+
 print("[proxy_pubsub] Proxy Pub/Sub rodando nas portas 5557 (XSUB) e 5558 (XPUB)...")
-zmq.proxy(xsub, xpub)
+if PROXY_MODE == "instrumented":
+    run_instrumented()
+else:
+    zmq.proxy(xsub, xpub)
 
 xsub.close()
 xpub.close()
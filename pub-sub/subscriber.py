@@ -1,29 +1,197 @@
-
+import argparse
+import json
+import time
 import zmq
+import msgpack
+
+# limites (ms) dos baldes do histograma de latência; o último balde é "acima de 5000"
+BUCKETS_MS = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 5000]
+# trechos de uma mensagem rastreada (stamps em time_ns, ver servidor.py):
+# broker = cliente -> broker -> servidor (t0 -> t_recv), servidor = requisição -> publicação,
+# proxy = PUB do servidor -> proxy (só com PROXY_MODE=instrumented), subscriber = proxy -> este processo
+HOPS = ["broker", "servidor", "proxy", "subscriber", "proxy+subscriber"]
+
+
+class Histogram:
+    """Amostras de latência (ms): contagem por balde e percentis sobre as últimas `keep` amostras."""
+
+    def __init__(self, keep=100000):
+        self.counts = [0] * (len(BUCKETS_MS) + 1)
+        self.samples = []
+        self.keep = keep
+        self.total = 0.0
+        self.n = 0
+
+    def add(self, ms):
+        i = 0
+        while i < len(BUCKETS_MS) and ms > BUCKETS_MS[i]:
+            i += 1
+        self.counts[i] += 1
+        self.n += 1
+        self.total += ms
+        if len(self.samples) < self.keep:
+            self.samples.append(ms)
+        else:
+            self.samples[self.n % self.keep] = ms
+
+    def report(self):
+        s = sorted(self.samples)
+        pct = lambda p: round(s[min(len(s) - 1, int(len(s) * p))], 3) if s else None
+        labels = [f"<={b}" for b in BUCKETS_MS] + [f">{BUCKETS_MS[-1]}"]
+        return {
+            "count": self.n,
+            "mean_ms": round(self.total / self.n, 3) if self.n else None,
+            "p50_ms": pct(0.50),
+            "p95_ms": pct(0.95),
+            "p99_ms": pct(0.99),
+            "max_ms": round(s[-1], 3) if s else None,
+            "histogram_ms": {label: c for label, c in zip(labels, self.counts) if c},
+        }
+
+
+class DeliveryStats:
+    """Latência de entrega por tópico (total) e por trecho, a partir dos stamps das mensagens rastreadas."""
+
+    def __init__(self):
+        self.topics = {}
+        self.hops = {}
+        self.received = 0
+        self.untraced = 0
+        self.started = time.time()
+
+    def add(self, topic, trace, t_proxy, t_sub):
+        t0, t_recv, t_pub = trace.get("t0"), trace.get("t_recv"), trace.get("t_pub")
+        hops = {}
+        if t0 and t_recv:
+            hops["broker"] = t_recv - t0
+        if t_recv and t_pub:
+            hops["servidor"] = t_pub - t_recv
+        if t_proxy and t_pub:
+            hops["proxy"] = t_proxy - t_pub
+            hops["subscriber"] = t_sub - t_proxy
+        elif t_pub:
+            hops["proxy+subscriber"] = t_sub - t_pub
+        for hop, ns in hops.items():
+            self.hops.setdefault(hop, Histogram()).add(ns / 1e6)
+        start = t0 or t_recv or t_pub
+        if start:
+            self.topics.setdefault(topic, Histogram()).add((t_sub - start) / 1e6)
+
+    def report(self):
+        hops = {hop: self.hops[hop].report() for hop in HOPS if hop in self.hops}
+        # onde o tempo vai: fração da média de cada trecho na soma das médias
+        total_mean = sum(h["mean_ms"] for h in hops.values()) or 1
+        for h in hops.values():
+            h["share"] = round(h["mean_ms"] / total_mean, 3)
+        everything = Histogram()
+        for h in self.topics.values():
+            for ms in h.samples:
+                everything.add(ms)
+        return {
+            "elapsed_s": round(time.time() - self.started, 1),
+            "received": self.received,
+            "untraced": self.untraced,
+            "total": everything.report(),
+            "hops": hops,
+            "topics": {t: h.report() for t, h in sorted(self.topics.items())},
+        }
+
+
+def print_report(report, top=10):
+    t = report["total"]
+    print(f"[medição] {report['received']} recebidas, {t['count']} rastreadas; entrega p50={t['p50_ms']}ms "
+          f"p95={t['p95_ms']}ms p99={t['p99_ms']}ms max={t['max_ms']}ms")
+    for hop, h in report["hops"].items():
+        print(f"  {hop:18s} {h['share']:>6.1%}  média={h['mean_ms']}ms p50={h['p50_ms']}ms "
+              f"p99={h['p99_ms']}ms")
+    topics = sorted(report["topics"].items(), key=lambda kv: kv[1]["count"], reverse=True)[:top]
+    for topic, h in topics:
+        print(f"  tópico {topic[:30]:30s} n={h['count']} p50={h['p50_ms']}ms p99={h['p99_ms']}ms")
+
+
+def measure(subscriber, args):
+    stats = DeliveryStats()
+    deadline = time.monotonic() + args.duration if args.duration else None
+    next_print = time.monotonic() + args.interval
+    try:
+        while deadline is None or time.monotonic() < deadline:
+            if not subscriber.poll(200):
+                continue
+            frames = subscriber.recv_multipart()
+            t_sub = time.time_ns()
+            stats.received += 1
+            if len(frames) < 3:
+                stats.untraced += 1
+            else:
+                t_proxy = int(frames[3]) if len(frames) > 3 else None
+                stats.add(frames[0].decode("utf-8", "replace"), msgpack.unpackb(frames[2], raw=False), t_proxy, t_sub)
+            if time.monotonic() >= next_print:
+                print_report(stats.report())
+                next_print = time.monotonic() + args.interval
+    except KeyboardInterrupt:
+        pass
+    report = stats.report()
+    print_report(report)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        print(f"relatório em {args.output}")
+
+
+def interactive(subscriber):
+    print("Digite o tópico para se inscrever (ex: seu nome ou canal):")
+    topic = input().strip()
+    subscriber.setsockopt_string(zmq.SUBSCRIBE, topic)
+    print(f"Inscrito no tópico: {topic}")
+    try:
+        while True:
+            frames = subscriber.recv_multipart()
+            try:
+                if len(frames) >= 2:
+                    # framing msgpack: [tópico, {sender, clock, timestamp, body}] — sem parsing de texto
+                    fields = msgpack.unpackb(frames[1], raw=False)
+                    print(f"[RECEBIDO] tópico='{frames[0].decode('utf-8')}' -> {fields.get('sender')}: {fields.get('body')} "
+                          f"[{fields.get('timestamp')}] (clock={fields.get('clock')})")
+                else:
+                    # mensagem no formato: "<topic> <payload>" — separamos para melhor exibição
+                    msg = frames[0].decode('utf-8')
+                    parts = msg.split(' ', 1)
+                    topic = parts[0]
+                    payload = parts[1] if len(parts) > 1 else ''
+                    print(f"[RECEBIDO] tópico='{topic}' -> {payload}")
+            except Exception:
+                print(f"[RECEBIDO] {frames}")
+    except KeyboardInterrupt:
+        print("\nSaindo...")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Assinante pub/sub; com --measure, mede a latência de entrega")
+    parser.add_argument("--addr", default="proxy_pubsub:5558", help="XPUB do proxy (host:porta)")
+    parser.add_argument("--measure", action="store_true", help="modo de medição (mensagens rastreadas)")
+    parser.add_argument("--topics", nargs="*", default=[""], help="tópicos assinados no modo de medição (padrão: todos)")
+    parser.add_argument("--duration", type=float, default=0, help="segundos de medição (0 = até Ctrl+C)")
+    parser.add_argument("--interval", type=float, default=5.0, help="intervalo entre resumos parciais")
+    parser.add_argument("--output", default=None, help="arquivo JSON do relatório final")
+    args = parser.parse_args()
+
+    context = zmq.Context()
+    subscriber = context.socket(zmq.SUB)
+    if args.measure:
+        # sem limite de fila: um descarte por HWM aqui sumiria com as amostras mais lentas
+        subscriber.setsockopt(zmq.RCVHWM, 0)
+    subscriber.connect(f"tcp://{args.addr}")
+    try:
+        if args.measure:
+            for topic in args.topics:
+                subscriber.setsockopt_string(zmq.SUBSCRIBE, topic)
+            measure(subscriber, args)
+        else:
+            interactive(subscriber)
+    finally:
+        subscriber.close(0)
+        context.term()
+
 
-context = zmq.Context()
-
-subscriber = context.socket(zmq.SUB)
-subscriber.connect("tcp://proxy_pubsub:5558")
-
-print("Digite o tópico para se inscrever (ex: seu nome ou canal):")
-topic = input().strip()
-subscriber.setsockopt_string(zmq.SUBSCRIBE, topic)
-print(f"Inscrito no tópico: {topic}")
-
-try:
-    while True:
-        msg = subscriber.recv_string()
-        # mensagem no formato: "<topic> <payload>" — separamos para melhor exibição
-        try:
-            parts = msg.split(' ', 1)
-            topic = parts[0]
-            payload = parts[1] if len(parts) > 1 else ''
-            print(f"[RECEBIDO] tópico='{topic}' -> {payload}")
-        except Exception:
-            print(f"[RECEBIDO] {msg}")
-except KeyboardInterrupt:
-    print("\nSaindo...")
-finally:
-    subscriber.close()
-    context.term()
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
 import argparse
+import os
 import zmq
 import msgpack
 import time
@@ -8,15 +9,23 @@ import json
 
 REFERENCE_ADDR = "reference:5560"
 PUBSUB_PROXY_XSUB = "proxy_pubsub:5557"
+PUBSUB_PROXY_CONTROL = "proxy_pubsub:5559"
+BROKER_STATS = "broker:5554"
+# "text" or "msgpack" framing for announcements (see servidor.py)
+PUBSUB_FRAMING = os.environ.get("PUBSUB_FRAMING", "text")
+# local copy of the reference's server list; later calls only fetch what changed
+ADMIN_CACHE = os.environ.get("ADMIN_CACHE", os.path.expanduser("~/.admin_tool_servers.json"))
 
 
-def call_reference_list(timeout=3.0):
+def call_reference_list(timeout=3.0, since_version=None, epoch=None):
     ctx = zmq.Context()
     s = ctx.socket(zmq.REQ)
     s.setsockopt(zmq.RCVTIMEO, int(timeout * 1000))
     s.setsockopt(zmq.SNDTIMEO, int(timeout * 1000))
     s.connect(f"tcp://{REFERENCE_ADDR}")
     req = {"service": "list", "data": {"timestamp": time.strftime("%H:%M:%S"), "clock": 0}}
+    if since_version is not None:
+        req["data"].update(since_version=since_version, epoch=epoch)
     try:
         s.send(msgpack.packb(req, use_bin_type=True))
         raw = s.recv()
@@ -53,7 +62,8 @@ def admin_req(address, msg, timeout=3.0):
         reply = {"error": str(e)}
     finally:
         try:
-            s.close()
+            # a request to a dead server must not keep ctx.term() waiting
+            s.close(0)
             ctx.term()
         except Exception:
             pass
@@ -66,7 +76,11 @@ def publish_servers_topic(payload):
     try:
         pub.connect(f"tcp://{PUBSUB_PROXY_XSUB}")
         time.sleep(0.12)
-        pub.send_string(f"servers {json.dumps(payload)}")
+        if PUBSUB_FRAMING == "msgpack":
+            fields = {"sender": "admin_tool", "clock": 0, "timestamp": time.strftime('%H:%M:%S'), "body": payload}
+            pub.send_multipart([b"servers", msgpack.packb(fields, use_bin_type=True)])
+        else:
+            pub.send_string(f"servers {json.dumps(payload)}")
     except Exception as e:
         print("Erro ao publicar no proxy_pubsub:", e)
         return False
@@ -79,13 +93,48 @@ def publish_servers_topic(payload):
     return True
 
 
+def load_cache():
+    try:
+        with open(ADMIN_CACHE, 'r', encoding='utf-8') as f:
+            cache = json.load(f)
+        if isinstance(cache, dict) and isinstance(cache.get('servers'), list):
+            return cache
+    except Exception:
+        pass
+    return None
+
+
+def save_cache(cache):
+    tmp = ADMIN_CACHE + '.tmp'
+    try:
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(cache, f, indent=2, ensure_ascii=False)
+        os.replace(tmp, ADMIN_CACHE)
+    except Exception as e:
+        print("Erro salvando cache local:", e)
+
+
 def list_servers():
-    r = call_reference_list()
+    cache = load_cache()
+    if cache:
+        r = call_reference_list(since_version=cache.get('version'), epoch=cache.get('epoch'))
+    else:
+        r = call_reference_list()
     if r is None:
         print("Sem resposta do reference")
         return []
     data = r.get('data', {})
-    lst = data.get('list', [])
+    if data.get('not_modified') and cache:
+        lst = cache['servers']
+    elif data.get('delta') and cache:
+        by_name = {s.get('name'): s for s in cache['servers']}
+        for name in data.get('removed', []):
+            by_name.pop(name, None)
+        for s in data.get('added', []) + data.get('changed', []):
+            by_name[s.get('name')] = s
+        lst = list(by_name.values())
+    else:
+        lst = data.get('list', [])
     normalized = []
     for s in lst:
         normalized.append({
@@ -93,6 +142,9 @@ def list_servers():
             'rank': s.get('rank'),
             'address': s.get('address')
         })
+    normalized.sort(key=lambda s: s.get('rank') or 0)
+    if data.get('version') is not None:
+        save_cache({'version': data.get('version'), 'epoch': data.get('epoch'), 'servers': normalized})
     print(json.dumps(normalized, indent=2, ensure_ascii=False))
     return normalized
 
@@ -166,6 +218,200 @@ def set_clock(target, tval):
     print(reply)
 
 
+def sync_servers(target=None, run=False):
+    """Show the sync scheduler of one or all servers; with run, ask each for a round now."""
+    servers = list_servers()
+    targets = [s for s in servers if s.get('name') == target] if target else servers
+    if not targets:
+        print("Servidor alvo não encontrado" if target else "Nenhum servidor retornado pelo reference")
+        return
+    for s in targets:
+        name = s.get('name')
+        addr = s.get('address') or f"{name}:{5600 + int(s.get('rank'))}"
+        req = {"service": "sync", "data": {"run": run, "timestamp": time.strftime('%H:%M:%S'), "clock": 0}}
+        reply = admin_req(addr, req, timeout=2.0)
+        d = reply.get('data', {}) if isinstance(reply, dict) else {}
+        if 'scheduler' not in d:
+            print(name, reply)
+            continue
+        sch = d['scheduler']
+        print(f"{name}: coordenador={d.get('coordinator')} rodadas={sch.get('rounds')} agrupadas={sch.get('coalesced')} "
+              f"última={sch.get('last_reason')} ({sch.get('last_duration')}s) disparada={d.get('triggered')} "
+              f"berkeley={d.get('berkeley')}")
+
+
+def proxy_control(action, top="20", timeout=3.0):
+    """Send a command to the control socket of the instrumented pub/sub proxy."""
+    ctx = zmq.Context()
+    s = ctx.socket(zmq.REQ)
+    s.setsockopt(zmq.RCVTIMEO, int(timeout * 1000))
+    s.setsockopt(zmq.SNDTIMEO, int(timeout * 1000))
+    s.connect(f"tcp://{PUBSUB_PROXY_CONTROL}")
+    try:
+        s.send_string(f"stats {top}" if action == "stats" else action)
+        reply = json.loads(s.recv_string())
+    except Exception as e:
+        print("Erro ao contatar o controle do proxy (PROXY_MODE=instrumented?):", e)
+        return None
+    finally:
+        try:
+            s.close(0)
+            ctx.term()
+        except Exception:
+            pass
+    if action != "stats" or "erro" in reply:
+        print(json.dumps(reply, indent=2, ensure_ascii=False))
+        return reply
+    t = reply.get('totals', {})
+    print(f"uptime={reply.get('uptime')}s paused={reply.get('paused')} nodrop={reply.get('nodrop')} "
+          f"msgs={t.get('msgs')} bytes={t.get('bytes')} drops={t.get('drops')}")
+    print(f"{'tópico':30s} {'msg/s':>10s} {'bytes/s':>12s} {'msgs':>10s} {'drops':>8s} {'subs':>5s}")
+    for st in reply.get('topics', []):
+        print(f"{st['topic'][:30]:30s} {st['msgs_per_s']:>10} {st['bytes_per_s']:>12} {st['msgs']:>10} "
+              f"{st['drops']:>8} {st['subscribers']:>5}")
+    return reply
+
+
+def broker_stats(timeout=3.0):
+    """Queue depth and per-server load of the load-balancing broker (BROKER_MODE=lb)."""
+    ctx = zmq.Context()
+    s = ctx.socket(zmq.REQ)
+    s.setsockopt(zmq.RCVTIMEO, int(timeout * 1000))
+    s.setsockopt(zmq.SNDTIMEO, int(timeout * 1000))
+    s.connect(f"tcp://{BROKER_STATS}")
+    try:
+        s.send(b"stats")
+        reply = json.loads(s.recv())
+    except Exception as e:
+        print("Erro ao contatar as estatísticas do broker (BROKER_MODE=lb?):", e)
+        return None
+    finally:
+        try:
+            s.close(0)
+            ctx.term()
+        except Exception:
+            pass
+    t = reply.get('totals', {})
+    print(f"uptime={reply.get('uptime')}s fila={reply.get('queue_depth')}/{reply.get('queue_max')} "
+          f"pico={t.get('queue_peak')} espera p50={reply.get('queue_wait_p50_ms')}ms p99={reply.get('queue_wait_p99_ms')}ms "
+          f"em andamento={reply.get('inflight')} requisições={t.get('requests')} respostas={t.get('replies')}")
+    hb = reply.get('heartbeat', {})
+    print(f"servidores perdidos={t.get('workers_lost')} reenviadas={t.get('requeued')} "
+          f"resultado desconhecido={t.get('failed')} respostas tardias={t.get('late_replies')} "
+          f"(detecção em até {hb.get('failover_bound_s')}s)")
+    for f in reply.get('failovers', []):
+        print(f"  falha: servidor {f['worker']} em {time.strftime('%H:%M:%S', time.localtime(f['at']))}, "
+              f"silencioso por {f['silent_s']}s, {f['requeued']} reenviadas, {f['failed']} com erro")
+    print(f"{'servidor':12s} {'cap':>4s} {'andam.':>7s} {'atendidas':>10s} {'p50 ms':>8s} {'p99 ms':>8s}")
+    for ident, w in reply.get('workers', {}).items():
+        print(f"{ident:12s} {w['capacity']:>4} {w['outstanding']:>7} {w['served']:>10} "
+              f"{str(w['p50_ms']):>8s} {str(w['p99_ms']):>8s}")
+    return reply
+
+
+def bucket_quantile(bounds, counts, q):
+    """Upper bound (ms) of the histogram bucket holding quantile q; None when empty."""
+    total = sum(counts)
+    if not total:
+        return None
+    seen = 0
+    for bound, n in zip(list(bounds) + [None], counts):
+        seen += n
+        if seen >= q * total:
+            return round(bound * 1000, 3) if bound is not None else f">{bounds[-1] * 1000:g}"
+    return None
+
+
+def merge_metrics(reports):
+    """Add up the counters and histograms of several servers' 'metrics' replies, by name and labels."""
+    counters, histograms = {}, {}
+    for r in reports:
+        for c in r.get('counters', []):
+            key = (c['name'], tuple(sorted(c['labels'].items())))
+            counters[key] = counters.get(key, 0) + c['value']
+        for h in r.get('histograms', []):
+            key = (h['name'], tuple(sorted(h['labels'].items())))
+            m = histograms.setdefault(key, {'buckets': [0] * len(h['buckets']), 'sum': 0.0, 'count': 0})
+            m['buckets'] = [a + b for a, b in zip(m['buckets'], h['buckets'])]
+            m['sum'] += h['sum']
+            m['count'] += h['count']
+    return counters, histograms
+
+
+def print_histograms(title, bounds, histograms, name, label=lambda labels: '-'):
+    """One line per series of histogram `name`; `label` turns the series labels into the row name."""
+    rows = sorted((label(dict(labels)), h) for (n, labels), h in histograms.items() if n == name)
+    if not rows:
+        return
+    print(f"{title:24s} {'n':>9s} {'média ms':>9s} {'p50 ms':>8s} {'p99 ms':>8s}")
+    for key, h in rows:
+        mean = round(h['sum'] / h['count'] * 1000, 3) if h['count'] else None
+        print(f"{key[:24]:24s} {h['count']:>9} {str(mean):>9s} {str(bucket_quantile(bounds, h['buckets'], 0.5)):>8s} "
+              f"{str(bucket_quantile(bounds, h['buckets'], 0.99)):>8s}")
+
+
+def stats_all(as_json=False):
+    """Ask every server listed by the reference for its 'metrics' and print the aggregate."""
+    servers = list_servers()
+    if not servers:
+        print("Nenhum servidor retornado pelo reference")
+        return None
+    reports, skews = [], {}
+    for s in servers:
+        name = s.get('name')
+        addr = s.get('address') or f"{name}:{5600 + int(s.get('rank'))}"
+        sent = time.time()
+        reply = admin_req(addr, {"service": "metrics", "data": {"timestamp": time.strftime('%H:%M:%S'), "clock": 0}},
+                          timeout=2.0)
+        received = time.time()
+        data = reply.get('data') if isinstance(reply, dict) else None
+        if not isinstance(data, dict) or 'histograms' not in data:
+            print(f"{name}: sem métricas ({reply})")
+            continue
+        reports.append(data)
+        # app time against this machine's clock at the middle of the round trip (error up to rtt/2)
+        skews[data['server']] = data['clocks']['app_time_seconds'] - (sent + received) / 2
+    if not reports:
+        return None
+    counters, histograms = merge_metrics(reports)
+    bounds = reports[0]['buckets_s']
+    if as_json:
+        print(json.dumps({'servers': reports, 'skew_s': skews}, indent=2, ensure_ascii=False))
+        return reports
+
+    print(f"\n{'servidor':14s} {'modo':8s} {'uptime s':>9s} {'respostas':>10s} {'pub falhas':>10s} "
+          f"{'clock':>8s} {'offset s':>9s} {'desvio s':>9s}")
+    for r in reports:
+        c = r['clocks']
+        print(f"{r['server'][:14]:14s} {r['mode']:8s} {r['uptime_s']:>9} {r['replies']:>10} "
+              f"{r['pubsub']['failed']:>10} {c['logical_clock']:>8} {c['app_time_offset_seconds']:>9.3f} "
+              f"{skews[r['server']]:>9.3f}")
+    clocks = [r['clocks']['logical_clock'] for r in reports]
+    print(f"clock lógico: min={min(clocks)} max={max(clocks)} diferença={max(clocks) - min(clocks)}; "
+          f"app time: diferença entre servidores={max(skews.values()) - min(skews.values()):.3f}s")
+    coordinators = sorted({str(r.get('coordinator')) for r in reports})
+    sent = sum(r['pubsub']['sent'] for r in reports)
+    failed = sum(r['pubsub']['failed'] for r in reports)
+    print(f"coordenador={','.join(coordinators)} eleições={counters.get(('elections', ()), 0)} "
+          f"trocas de coordenador={counters.get(('coordinator_changes', ()), 0)} "
+          f"pub/sub enviadas={sent} falhas={failed}\n")
+
+    errors = {dict(labels)['service']: v for (n, labels), v in counters.items() if n == 'request_errors'}
+    rows = sorted((dict(labels)['service'], h) for (n, labels), h in histograms.items() if n == 'request_seconds')
+    print(f"{'serviço':12s} {'requisições':>11s} {'erros':>7s} {'média ms':>9s} {'p50 ms':>8s} {'p99 ms':>8s}")
+    for service, h in rows:
+        mean = round(h['sum'] / h['count'] * 1000, 3) if h['count'] else None
+        print(f"{service:12s} {h['count']:>11} {errors.pop(service, 0):>7} {str(mean):>9s} "
+              f"{str(bucket_quantile(bounds, h['buckets'], 0.5)):>8s} {str(bucket_quantile(bounds, h['buckets'], 0.99)):>8s}")
+    for service, n in errors.items():
+        print(f"{service:12s} {'-':>11s} {n:>7}")
+    print()
+    print_histograms('armazenamento', bounds, histograms, 'storage_seconds', lambda l: f"{l['op']} {l['target']}")
+    print_histograms('rodada de sync (motivo)', bounds, histograms, 'sync_round_seconds', lambda l: str(l.get('reason')))
+    print_histograms('rodada de Berkeley', bounds, histograms, 'berkeley_round_seconds')
+    return reports
+
+
 def announce_coordinator(name):
     payload = {"service": "election", "data": {"coordinator": name, "timestamp": time.strftime('%H:%M:%S'), "clock": 0}}
     ok = publish_servers_topic(payload)
@@ -190,6 +436,19 @@ def main():
     p_ann = sub.add_parser('announce', help='Announce coordinator via pubsub')
     p_ann.add_argument('--coordinator', required=True, help='Coordinator name')
 
+    p_sync = sub.add_parser('sync', help='Show sync scheduler state; --run forces a sync round')
+    p_sync.add_argument('--server', help='Server name (default: all servers)')
+    p_sync.add_argument('--run', action='store_true', help='Ask for a sync round now')
+
+    p_proxy = sub.add_parser('proxy', help='Query or steer the instrumented pub/sub proxy')
+    p_proxy.add_argument('action', choices=['stats', 'pause', 'resume', 'reset'])
+    p_proxy.add_argument('--top', default='20', help='Topics to show, hottest first (number or "all")')
+
+    sub.add_parser('broker', help='Show queue depth and per-server latency of the load-balancing broker')
+
+    p_stats = sub.add_parser('stats', help='Aggregate the metrics of every server listed by the reference')
+    p_stats.add_argument('--json', action='store_true', help='Print the raw per-server metrics as JSON')
+
     args = parser.parse_args()
     if args.cmd == 'list':
         list_servers()
@@ -201,6 +460,14 @@ def main():
         set_clock(args.server, args.time)
     elif args.cmd == 'announce':
         announce_coordinator(args.coordinator)
+    elif args.cmd == 'sync':
+        sync_servers(target=args.server, run=args.run)
+    elif args.cmd == 'broker':
+        broker_stats()
+    elif args.cmd == 'stats':
+        stats_all(as_json=args.json)
+    elif args.cmd == 'proxy':
+        proxy_control(args.action, args.top)
     else:
         parser.print_help()
 
@@ -1,15 +1,284 @@
+import os
+import time
+import json
+from collections import deque
 import zmq
+import msgpack
+
+# proxy: zmq.proxy(ROUTER, DEALER), distribui em round-robin entre os servidores;
+# lb: ROUTER-ROUTER, os servidores (SERVER_MODE=lb) anunciam READY com sua capacidade
+# e cada requisição vai para o servidor com menos requisições em andamento
+BROKER_MODE = os.environ.get("BROKER_MODE", "proxy")
+BROKER_STATS_ADDR = os.environ.get("BROKER_STATS_ADDR", "tcp://*:5554")
+# requisições aguardando um servidor livre; com a fila cheia o broker para de ler
+# do front end e os clientes esperam nas próprias filas do ZeroMQ
+BROKER_QUEUE_MAX = int(os.environ.get("BROKER_QUEUE_MAX", "1000"))
+BROKER_LATENCY_WINDOW = int(os.environ.get("BROKER_LATENCY_WINDOW", "1000"))
+# os servidores enviam HEARTBEAT a cada BROKER_HEARTBEAT_INTERVAL segundos; sem nenhuma
+# mensagem por BROKER_HEARTBEAT_LIVENESS intervalos, o servidor é dado como morto
+BROKER_HEARTBEAT_INTERVAL = float(os.environ.get("BROKER_HEARTBEAT_INTERVAL", "1.0"))
+BROKER_HEARTBEAT_LIVENESS = int(os.environ.get("BROKER_HEARTBEAT_LIVENESS", "3"))
+# requisições de um servidor morto são reenviadas a outro só para serviços idempotentes;
+# as demais (login, channel, publish...) recebem erro: podem ou não ter sido executadas,
+# e reenviar poderia executá-las duas vezes
+BROKER_IDEMPOTENT = set(os.environ.get("BROKER_IDEMPOTENT", "users,channels,history").split(","))
 
 context = zmq.Context()
 
 client_socket = context.socket(zmq.ROUTER)
 client_socket.bind("tcp://*:5555")
 
-server_socket = context.socket(zmq.DEALER)
-server_socket.bind("tcp://*:5556")
 
-zmq.proxy(client_socket, server_socket)
+def pct(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(len(values) * p))] * 1000, 2)
+
+
+class Worker:
+    """Um servidor conectado ao back end: capacidade anunciada, requisições em andamento e latências."""
+
+    def __init__(self, identity, capacity):
+        self.identity = identity
+        self.capacity = capacity
+        self.inflight = set()
+        self.expiry = time.monotonic() + BROKER_HEARTBEAT_INTERVAL * BROKER_HEARTBEAT_LIVENESS
+        self.last_used = 0.0
+        self.served = 0
+        self.latencies = deque(maxlen=BROKER_LATENCY_WINDOW)
+
+    def report(self):
+        return {
+            "capacity": self.capacity,
+            "outstanding": len(self.inflight),
+            "served": self.served,
+            "p50_ms": pct(self.latencies, 0.5),
+            "p99_ms": pct(self.latencies, 0.99),
+        }
+
+
+class LoadBalancer:
+    """Fila limitada de requisições e escolha do servidor menos ocupado.
+
+    Protocolo do back end: o servidor envia [b"", b"READY", capacidade] ao conectar
+    e [b"", b"HEARTBEAT", capacidade] a cada BROKER_HEARTBEAT_INTERVAL; o broker envia
+    [seq, envelope do cliente..., payload] e o servidor devolve todas as partes antes
+    do payload, seguidas da resposta. Um HEARTBEAT de um servidor desconhecido (por
+    exemplo, depois de o broker reiniciar) vale como READY.
+    """
+
+    def __init__(self):
+        self.workers = {}
+        self.queue = deque()
+        self.inflight = {}
+        self.seq = 0
+        self.started = time.time()
+        self.totals = {"requests": 0, "replies": 0, "queued": 0, "queue_peak": 0,
+                       "workers_lost": 0, "requeued": 0, "failed": 0, "late_replies": 0}
+        self.failovers = deque(maxlen=20)
+        self.queue_waits = deque(maxlen=BROKER_LATENCY_WINDOW)
+
+    def ready(self, identity, capacity):
+        w = self.workers.get(identity)
+        if w is None:
+            w = self.workers[identity] = Worker(identity, capacity)
+            print(f"[broker] servidor {identity.hex()} pronto (capacidade {capacity})")
+        else:
+            w.capacity = capacity
+        return w
+
+    def alive(self, identity):
+        """Qualquer mensagem de um servidor conhecido adia sua expiração."""
+        w = self.workers.get(identity)
+        if w is not None:
+            w.expiry = time.monotonic() + BROKER_HEARTBEAT_INTERVAL * BROKER_HEARTBEAT_LIVENESS
+
+    def purge(self, clients):
+        """Remove servidores sem heartbeat e reenvia ou falha o que estava com eles."""
+        now = time.monotonic()
+        for w in [w for w in self.workers.values() if w.expiry <= now]:
+            self.lost(w, clients)
+
+    def lost(self, w, clients):
+        self.workers.pop(w.identity, None)
+        self.totals["workers_lost"] += 1
+        requeued = failed = 0
+        # do mais novo para o mais velho: appendleft mantém a ordem original na fila
+        for seq in sorted(w.inflight, reverse=True):
+            queued_at, sent_at, frames = self.inflight.pop(seq)[1:]
+            service = service_of(frames[-1])
+            if service in BROKER_IDEMPOTENT:
+                self.queue.appendleft((queued_at, frames))
+                requeued += 1
+            else:
+                clients.send_multipart(frames[:-1] + [unknown_result(service)])
+                failed += 1
+        w.inflight.clear()
+        self.totals["requeued"] += requeued
+        self.totals["failed"] += failed
+        silent = time.monotonic() - (w.expiry - BROKER_HEARTBEAT_INTERVAL * BROKER_HEARTBEAT_LIVENESS)
+        self.failovers.append({"worker": w.identity.hex(), "at": round(time.time(), 3),
+                               "silent_s": round(silent, 3), "requeued": requeued, "failed": failed})
+        print(f"[broker] servidor {w.identity.hex()} sem resposta há {silent:.1f}s: "
+              f"{requeued} requisições reenviadas, {failed} com resultado desconhecido")
+
+    def pick(self):
+        """Servidor com capacidade livre e menos requisições em andamento; empate: o usado há mais tempo."""
+        best = None
+        for w in self.workers.values():
+            if len(w.inflight) >= w.capacity:
+                continue
+            if best is None or (len(w.inflight), w.last_used) < (len(best.inflight), best.last_used):
+                best = w
+        return best
+
+    def full(self):
+        return len(self.queue) >= BROKER_QUEUE_MAX
+
+    def submit(self, frames):
+        self.totals["requests"] += 1
+        self.queue.append((time.perf_counter(), frames))
+        if len(self.queue) > 1 or self.pick() is None:
+            self.totals["queued"] += 1
+            self.totals["queue_peak"] = max(self.totals["queue_peak"], len(self.queue))
+
+    def dispatch(self, backend, clients):
+        """Envia requisições da fila enquanto houver servidor com capacidade livre."""
+        while self.queue:
+            w = self.pick()
+            if w is None:
+                return
+            queued_at, frames = self.queue.popleft()
+            self.seq += 1
+            seq = self.seq.to_bytes(8, "big")
+            try:
+                # ROUTER_MANDATORY: servidor já desconectado falha aqui em vez de engolir a mensagem
+                backend.send_multipart([w.identity, seq] + frames)
+            except zmq.ZMQError:
+                self.queue.appendleft((queued_at, frames))
+                self.lost(w, clients)
+                continue
+            now = time.perf_counter()
+            self.queue_waits.append(now - queued_at)
+            self.inflight[seq] = (w, queued_at, now, frames)
+            w.inflight.add(seq)
+            w.last_used = now
+
+    def reply(self, identity, frames):
+        """Resposta [seq, envelope..., payload] de um servidor; devolve o que vai para o cliente.
+
+        Devolve None para respostas de requisições que já foram reenviadas ou
+        falhadas (servidor dado como morto que voltou a responder).
+        """
+        entry = self.inflight.pop(frames[0], None)
+        if entry is None:
+            self.totals["late_replies"] += 1
+            return None
+        w, sent_at = entry[0], entry[2]
+        w.inflight.discard(frames[0])
+        w.served += 1
+        w.latencies.append(time.perf_counter() - sent_at)
+        self.totals["replies"] += 1
+        return frames[1:]
+
+    def report(self):
+        return {
+            "mode": "lb",
+            "uptime": round(time.time() - self.started, 1),
+            "queue_depth": len(self.queue),
+            "queue_max": BROKER_QUEUE_MAX,
+            "queue_wait_p50_ms": pct(self.queue_waits, 0.5),
+            "queue_wait_p99_ms": pct(self.queue_waits, 0.99),
+            "inflight": len(self.inflight),
+            "heartbeat": {"interval": BROKER_HEARTBEAT_INTERVAL, "liveness": BROKER_HEARTBEAT_LIVENESS,
+                          "failover_bound_s": BROKER_HEARTBEAT_INTERVAL * (BROKER_HEARTBEAT_LIVENESS + 1)},
+            "failovers": list(self.failovers),
+            "totals": dict(self.totals),
+            "workers": {identity.hex(): w.report() for identity, w in self.workers.items()},
+        }
+
+
+def service_of(payload):
+    try:
+        request = msgpack.unpackb(payload, raw=False, strict_map_key=False)
+    except Exception:
+        try:
+            request = json.loads(payload.decode("utf-8"))
+        except Exception:
+            return None
+    return request.get("service") if isinstance(request, dict) else None
+
+
+def unknown_result(service):
+    return msgpack.packb({"service": service or "error", "data": {
+        "status": "erro",
+        "message": "servidor caiu antes de responder; a requisição pode ou não ter sido executada",
+        "clock": 0,
+    }}, use_bin_type=True)
+
+
+def run_lb():
+    lb = LoadBalancer()
+    stats = context.socket(zmq.REP)
+    stats.bind(BROKER_STATS_ADDR)
+    poller = zmq.Poller()
+    poller.register(server_socket, zmq.POLLIN)
+    poller.register(stats, zmq.POLLIN)
+    reading_clients = False
+    next_purge = time.monotonic() + BROKER_HEARTBEAT_INTERVAL
+    print(f"[broker] modo lb; estatísticas em {BROKER_STATS_ADDR}, fila até {BROKER_QUEUE_MAX}")
+    while True:
+        # só lê clientes enquanto a fila tem espaço
+        if lb.full() == reading_clients:
+            if reading_clients:
+                poller.unregister(client_socket)
+            else:
+                poller.register(client_socket, zmq.POLLIN)
+            reading_clients = not reading_clients
+        events = dict(poller.poll(max(0, int((next_purge - time.monotonic()) * 1000))))
+        if server_socket in events:
+            while True:
+                try:
+                    frames = server_socket.recv_multipart(zmq.NOBLOCK)
+                except zmq.Again:
+                    break
+                identity, rest = frames[0], frames[1:]
+                lb.alive(identity)
+                if rest and rest[0] == b"":
+                    # controle: [b"", b"READY" | b"HEARTBEAT", capacidade]
+                    if len(rest) > 1 and rest[1] in (b"READY", b"HEARTBEAT"):
+                        lb.ready(identity, int(rest[2]) if len(rest) > 2 else 1)
+                    continue
+                out = lb.reply(identity, rest)
+                if out is not None:
+                    client_socket.send_multipart(out)
+        if client_socket in events:
+            while not lb.full():
+                try:
+                    frames = client_socket.recv_multipart(zmq.NOBLOCK)
+                except zmq.Again:
+                    break
+                lb.submit(frames)
+        if time.monotonic() >= next_purge:
+            lb.purge(client_socket)
+            next_purge = time.monotonic() + BROKER_HEARTBEAT_INTERVAL
+        lb.dispatch(server_socket, client_socket)
+        if stats in events:
+            stats.recv()
+            stats.send_string(json.dumps(lb.report()))
+
+
+if BROKER_MODE == "lb":
+    server_socket = context.socket(zmq.ROUTER)
+    server_socket.setsockopt(zmq.ROUTER_MANDATORY, 1)
+    server_socket.bind("tcp://*:5556")
+    run_lb()
+else:
+    server_socket = context.socket(zmq.DEALER)
+    server_socket.bind("tcp://*:5556")
+    zmq.proxy(client_socket, server_socket)
 
 client_socket.close()
 server_socket.close()
-context.term()
\ No newline at end of file
+context.term()
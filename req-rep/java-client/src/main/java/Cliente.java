@@ -286,9 +286,17 @@ public class Cliente {
                 try {
                     int rc = poller.poll(500);
                     if (rc > 0 && poller.pollin(0)) {
-                        String msg = sub.recvStr(0);
-                        if (msg != null) {
-                            System.out.println("[RECEBIDO] " + msg);
+                        byte[] first = sub.recv(0);
+                        if (first != null && sub.hasReceiveMore()) {
+                            // multipart framing: [topic, msgpack {sender, clock, timestamp, body}]
+                            String topic = new String(first, ZMQ.CHARSET);
+                            Map<String,Object> f = unpackMsgpack(sub.recv(0));
+                            // traced messages carry extra frames (trace stamps): skip them
+                            while (sub.hasReceiveMore()) sub.recv(0);
+                            System.out.println("[RECEBIDO] " + topic + " " + f.get("sender") + ": " + f.get("body")
+                                    + " [" + f.get("timestamp") + "] (clock=" + f.get("clock") + ")");
+                        } else if (first != null) {
+                            System.out.println("[RECEBIDO] " + new String(first, ZMQ.CHARSET));
                         }
                     }
                 } catch (Exception e) {
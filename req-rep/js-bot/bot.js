@@ -5,6 +5,50 @@ const { encode, decode } = require('@msgpack/msgpack')
 function randInt(max) { return Math.floor(Math.random() * max) }
 function randChoice(arr) { return arr[randInt(arr.length)] }
 function sleep(ms) { return new Promise(r => setTimeout(r, ms)) }
+// BOT_BATCH > 1: send the publishes of each round in 'batch' requests of that size
+const BOT_BATCH = parseInt(process.env.BOT_BATCH || '1', 10)
+// BOT_PIPELINE > 0: DEALER socket with up to BOT_PIPELINE publishes in flight, replies
+// matched by request id (same envelope as req-rep/pipeline_client.py)
+const BOT_PIPELINE = parseInt(process.env.BOT_PIPELINE || '0', 10)
+// pipelined requests without a reply after this many ms are rejected (a lost reply
+// would otherwise stall the window forever)
+const BOT_TIMEOUT_MS = parseInt(process.env.BOT_TIMEOUT_MS || '5000', 10)
+
+// [b"", req_id, payload] out, [b"", req_id, reply] back, possibly out of order
+function pipelinedClient(sock, timeoutMs = BOT_TIMEOUT_MS) {
+  let nextId = 0
+  // id -> { resolve, timer }; a reply after the timeout finds no entry and is dropped
+  const pending = new Map()
+  ;(async () => {
+    for await (const frames of sock) {
+      const id = frames[frames.length - 2].readBigUInt64BE()
+      const entry = pending.get(id)
+      if (!entry) continue
+      pending.delete(id)
+      clearTimeout(entry.timer)
+      let reply
+      try { reply = decode(frames[frames.length - 1]) } catch (e) { reply = null }
+      entry.resolve(reply)
+    }
+  })().catch(e => console.warn('pipeline reader error', e && e.message))
+  return {
+    inflight: () => pending.size,
+    call(msg) {
+      const id = BigInt(++nextId)
+      const idBuf = Buffer.alloc(8)
+      idBuf.writeBigUInt64BE(id)
+      return new Promise((resolve, reject) => {
+        const timer = setTimeout(() => {
+          pending.delete(id)
+          reject(new Error(`sem resposta em ${timeoutMs}ms`))
+        }, timeoutMs)
+        pending.set(id, { resolve, timer })
+        sock.send([Buffer.alloc(0), idBuf, encode(msg)])
+          .catch(e => { clearTimeout(timer); pending.delete(id); reject(e) })
+      })
+    }
+  }
+}
 function randomText(len = 20) {
   const chars = 'abcdefghijklmnopqrstuvwxyz0123456789'
   let s = ''
@@ -13,6 +57,7 @@ function randomText(len = 20) {
 }
 
 async function main() {
+  if (BOT_PIPELINE > 0) return mainPipelined()
   const req = new zmq.Request()
   await req.connect('tcp://broker:5555')
   console.log('Bot connected to broker:5555')
@@ -66,6 +111,31 @@ async function main() {
     const channel = randChoice(channels)
     console.log(`Chosen channel: ${channel}, will send 10 messages`)
 
+    if (BOT_BATCH > 1) {
+      // send 10 messages, BOT_BATCH per round trip
+      for (let i = 0; i < 10; i += BOT_BATCH) {
+        const requests = []
+        for (let j = i; j < Math.min(i + BOT_BATCH, 10); j++) {
+          const message = `[${username}] ${randomText(40)}`
+          requests.push({ service: 'publish', data: { user: username, channel, message, timestamp: now(), clock: incClock() } })
+        }
+        try {
+          await req.send(encode({ service: 'batch', data: { requests, timestamp: now(), clock: incClock() } }));
+          [rawReply] = await req.receive()
+          try { reply = decode(rawReply) } catch (e) { reply = null }
+          const replies = (reply && reply.data && reply.data.replies) || []
+          for (const r of replies) updateClockFromReply(r && r.data)
+          updateClockFromReply(reply && reply.data)
+          console.log('published batch ->', channel, replies.map(r => r && r.data && r.data.status))
+        } catch (e) {
+          console.warn('batch error', e && e.message)
+        }
+        await sleep(300 + randInt(700))
+      }
+      await sleep(500 + randInt(1000))
+      continue
+    }
+
     // send 10 messages
     for (let i = 0; i < 10; i++) {
       const message = `[${username}] ${randomText(40)}`
@@ -88,4 +158,63 @@ async function main() {
   }
 }
 
+async function mainPipelined() {
+  const dealer = new zmq.Dealer()
+  dealer.connect('tcp://broker:5555')
+  const client = pipelinedClient(dealer)
+  console.log(`Bot connected to broker:5555 (pipelined, window ${BOT_PIPELINE})`)
+
+  let clock = 0
+  function incClock() { clock += 1; return clock }
+  function updateClockFromReply(replyData) {
+    if (replyData && typeof replyData.clock === 'number') clock = Math.max(clock, replyData.clock)
+  }
+  async function call(service, data) {
+    const reply = await client.call({ service, data: { ...data, clock: incClock() } })
+    updateClockFromReply(reply && reply.data)
+    return reply
+  }
+
+  const username = 'bot-' + Math.random().toString(36).substring(2, 8)
+  const now = () => new Date().toLocaleTimeString('pt-BR')
+  console.log('Bot username:', username)
+  console.log('login reply:', await call('login', { user: username, timestamp: now() }))
+
+  while (true) {
+    try {
+      let reply = await call('channels', { timestamp: now() })
+      let channels = (reply && reply.data && reply.data.channels) || []
+      if (channels.length === 0) {
+        const newChannel = 'chan-' + randomText(5)
+        console.log('No channels, creating', newChannel)
+        await call('channel', { channel: newChannel, timestamp: now() })
+        channels = [newChannel]
+      }
+      const channel = randChoice(channels)
+      console.log(`Chosen channel: ${channel}, will send 10 messages`)
+
+      // all 10 publishes go out without waiting, at most BOT_PIPELINE in flight
+      const started = Date.now()
+      const inflight = new Set()
+      const statuses = []
+      for (let i = 0; i < 10; i++) {
+        while (inflight.size >= BOT_PIPELINE) await Promise.race(inflight)
+        const message = `[${username}] ${randomText(40)}`
+        const p = call('publish', { user: username, channel, message, timestamp: now() })
+          .then(r => { statuses.push(r && r.data && r.data.status) })
+          .catch(e => { console.warn('publish error', e && e.message) })
+          .finally(() => inflight.delete(p))
+        inflight.add(p)
+      }
+      await Promise.all(inflight)
+      console.log('published ->', channel, statuses, `${Date.now() - started}ms`)
+    } catch (e) {
+      // a timed-out channels/channel call: skip this round
+      console.warn('round error', e && e.message)
+    }
+
+    await sleep(500 + randInt(1000))
+  }
+}
+
 main().catch(e => { console.error('bot error', e); process.exit(1) })
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+"""Pipelined client for the servers behind the broker.
+
+A REQ socket allows one request in flight, so a client never does more than
+1/RTT requests per second. PipelineClient uses a DEALER socket instead and tags
+every request with a correlation id frame:
+
+    request: [b"", req_id, msgpack payload]
+    reply:   [b"", req_id, msgpack reply]
+
+The empty delimiter is what a REQ socket would send, so the broker and every
+SERVER_MODE route the envelope back unchanged; replies may come back out of
+order (from different servers) and are matched by req_id. Up to `window`
+requests are kept in flight.
+
+    client = PipelineClient("127.0.0.1:5555")
+    replies = client.call_many([("publish", {...}), ("publish", {...})])
+    future = client.submit("users", {})
+    client.flush()
+    print(future.result())
+
+The socket is not thread-safe: use one client per thread. Replies are only read
+while the client is inside submit (window full), call, call_many, poll or flush.
+"""
+
+import argparse
+import concurrent.futures
+import time
+import msgpack
+import zmq
+
+BROKER_ADDR = "broker:5555"
+
+
+class PipelineClient:
+    def __init__(self, address=BROKER_ADDR, window=64, timeout=5.0, ctx=None):
+        self.ctx = ctx or zmq.Context.instance()
+        self.window = window
+        self.timeout = timeout
+        self.socket = self.ctx.socket(zmq.DEALER)
+        self.socket.setsockopt(zmq.LINGER, 0)
+        self.socket.connect(f"tcp://{address}")
+        self.clock = 0
+        self._next_id = 0
+        # req_id -> (future, deadline)
+        self._pending = {}
+        self.late = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        for future, _ in self._pending.values():
+            future.cancel()
+        self._pending.clear()
+        self.socket.close(0)
+
+    @property
+    def inflight(self):
+        return len(self._pending)
+
+    def submit(self, service, data=None):
+        """Send one request and return a Future for its reply; blocks while the window is full."""
+        while len(self._pending) >= self.window:
+            self.poll(self.timeout)
+        data = dict(data or {})
+        self.clock += 1
+        data.setdefault("clock", self.clock)
+        self._next_id += 1
+        req_id = self._next_id.to_bytes(8, "big")
+        future = concurrent.futures.Future()
+        self._pending[req_id] = (future, time.monotonic() + self.timeout)
+        self.socket.send_multipart([b"", req_id, msgpack.packb({"service": service, "data": data}, use_bin_type=True)])
+        return future
+
+    def poll(self, timeout=0.0):
+        """Read every reply available within `timeout` seconds; returns how many were matched."""
+        matched = 0
+        if self.socket.poll(int(timeout * 1000), zmq.POLLIN):
+            while True:
+                try:
+                    frames = self.socket.recv_multipart(zmq.NOBLOCK)
+                except zmq.Again:
+                    break
+                entry = self._pending.pop(frames[-2], None) if len(frames) >= 2 else None
+                if entry is None:
+                    # reply to a request that already timed out
+                    self.late += 1
+                    continue
+                reply = msgpack.unpackb(frames[-1], raw=False, strict_map_key=False)
+                self._update_clock(reply)
+                entry[0].set_result(reply)
+                matched += 1
+        self._expire()
+        return matched
+
+    def flush(self):
+        """Wait until every request in flight has a reply or has timed out."""
+        while self._pending:
+            self.poll(min(self.timeout, 0.1))
+
+    def call(self, service, data=None):
+        future = self.submit(service, data)
+        while not future.done():
+            self.poll(min(self.timeout, 0.1))
+        return future.result()
+
+    def call_many(self, requests):
+        """Pipeline (service, data) pairs and return their replies in the same order.
+
+        A request that timed out yields None in its slot.
+        """
+        futures = [self.submit(service, data) for service, data in requests]
+        self.flush()
+        return [None if f.exception() else f.result() for f in futures]
+
+    def _update_clock(self, reply):
+        data = reply.get("data") if isinstance(reply, dict) else None
+        if not isinstance(data, dict):
+            return
+        clocks = [data.get("clock")] + [r.get("data", {}).get("clock") for r in data.get("replies") or []
+                                        if isinstance(r, dict)]
+        for c in clocks:
+            if isinstance(c, int) and c > self.clock:
+                self.clock = c
+
+    def _expire(self):
+        now = time.monotonic()
+        for req_id in [k for k, (_, deadline) in self._pending.items() if deadline <= now]:
+            future, _ = self._pending.pop(req_id)
+            future.set_exception(TimeoutError(f"sem resposta em {self.timeout}s"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Publish messages through the broker with a pipelined DEALER client')
+    parser.add_argument('--addr', default=BROKER_ADDR, help='broker front end (host:port)')
+    parser.add_argument('--user', default='pipeline')
+    parser.add_argument('--channel', required=True)
+    parser.add_argument('--messages', type=int, default=100)
+    parser.add_argument('--window', type=int, default=64)
+    args = parser.parse_args()
+
+    with PipelineClient(args.addr, window=args.window) as client:
+        ts = time.strftime('%H:%M:%S')
+        client.call('login', {'user': args.user, 'timestamp': ts})
+        start = time.perf_counter()
+        replies = client.call_many([('publish', {'user': args.user, 'channel': args.channel,
+                                                 'message': f'mensagem {i}', 'timestamp': ts})
+                                    for i in range(args.messages)])
+        elapsed = time.perf_counter() - start
+        ok = sum(1 for r in replies if r and r.get('data', {}).get('status') == 'OK')
+        print(f"{ok}/{args.messages} publicadas em {elapsed:.2f}s ({args.messages / elapsed:,.0f} msg/s, "
+              f"janela {args.window})")
+
+
+if __name__ == '__main__':
+    main()
@@ -4,13 +4,42 @@ import os
 import time
 import json
 import threading
+import queue
+import heapq
+import itertools
+import collections
+from concurrent.futures import Future
 import msgpack
 import zmq
 
 STORAGE_DIR = os.environ.get('STORAGE_DIR', os.path.join(os.path.dirname(__file__), 'storage-server'))
 SERVERS_FILE = os.path.join(STORAGE_DIR, 'servers.txt')
-
-HEARTBEAT_TIMEOUT = 30.0 
+# append-only change log replayed on top of the servers.txt snapshot at startup
+SERVERS_WAL = os.path.join(STORAGE_DIR, 'servers.wal')
+SNAPSHOT_INTERVAL = float(os.environ.get('SNAPSHOT_INTERVAL', '60'))
+WAL_FSYNC = os.environ.get('WAL_FSYNC', '1') != '0'
+
+# lease granted to each server: it expires this long after the last renewal.
+# Replies to rank/heartbeat (and reads that carry data.user) return it so
+# servers can renew at about a third of it.
+HEARTBEAT_TIMEOUT = float(os.environ.get('LEASE_DURATION', '30'))
+
+# membership changes are pushed on this pub/sub topic; a periodic 'tick' carries
+# the current version so subscribers that missed an event notice the gap
+PUBSUB_ADDR = os.environ.get('PUBSUB_ADDR', 'proxy_pubsub:5557')
+MEMBERSHIP_TOPIC = 'membership'
+MEMBERSHIP_TICK = float(os.environ.get('MEMBERSHIP_TICK', '10'))
+REAP_INTERVAL = float(os.environ.get('REAP_INTERVAL', '5'))
+# 'text' ("membership <json>") or 'msgpack' ([topic, msgpack {sender, clock, timestamp, body}])
+PUBSUB_FRAMING = os.environ.get('PUBSUB_FRAMING', 'text')
+# recent membership changes kept to answer 'list' with since_version by delta
+CHANGE_LOG_SIZE = int(os.environ.get('CHANGE_LOG_SIZE', '1000'))
+# reads are served by REF_WORKERS threads behind the ROUTER front end; writes are
+# applied by the front end thread itself, the registry's only writer
+REF_WORKERS = int(os.environ.get('REF_WORKERS', str(os.cpu_count() or 1)))
+WORKERS_ADDR = 'inproc://reference-workers'
+WAKE_ADDR = 'inproc://reference-wake'
+READ_SERVICES = ('list', 'clock')
 
 
 def ensure_storage():
@@ -32,36 +61,186 @@ def load_servers():
 
 
 def save_servers(servers):
+    # write a temporary file and rename it, so a crash never leaves a torn snapshot
+    tmp = SERVERS_FILE + '.tmp'
     try:
-        with open(SERVERS_FILE, 'w', encoding='utf-8') as f:
+        with open(tmp, 'w', encoding='utf-8') as f:
             json.dump(servers, f, indent=2, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, SERVERS_FILE)
+        return True
     except Exception as e:
         print('Erro salvando servers:', e)
+        return False
+
+
+def membership_delta(changes, since):
+    """Collapse (version, event, server) changes after `since` into added/removed/changed.
+
+    Returns None when the retained changes do not reach back to `since`.
+    """
+    if not changes or changes[0][0] > since + 1:
+        return None
+    first, last = {}, {}
+    for version, event, server in changes:
+        if version <= since:
+            continue
+        name = server.get('name')
+        first.setdefault(name, event)
+        last[name] = (event, server)
+    added, removed, changed = [], [], []
+    for name, (event, server) in last.items():
+        if event == 'leave':
+            # joined and left within the window: the caller never saw it
+            if first[name] != 'join':
+                removed.append(name)
+        elif first[name] == 'join':
+            added.append(server)
+        else:
+            changed.append(server)
+    return added, removed, changed
+
+
+class ServerRegistry:
+    """In-memory server registry persisted as snapshot + change log.
+
+    Membership changes (add, address change, removal) are appended to
+    servers.wal; heartbeats only update last_seen in memory, so their cost does
+    not depend on the cluster size. snapshot() writes servers.txt atomically and
+    truncates the log. On startup the snapshot is loaded and the log replayed;
+    recovered servers get a fresh last_seen, i.e. a full lease to check in again.
+
+    servers is the name index. Ranks come from a min-heap of freed ranks plus a
+    high-water mark, so a new server always gets the lowest free rank in
+    O(log n). Expiry uses a heap keyed by deadline with one live entry per
+    server: a heartbeat only updates last_seen, and an entry that turns out to
+    be renewed when it reaches the top is pushed back with its new deadline.
+    """
+
+    def __init__(self):
+        self.servers = {}
+        self.dirty = False
+        self._wal = None
+        self.load()
+
+    def _rebuild_indexes(self):
+        used = {int(s['rank']) for s in self.servers.values() if s.get('rank') is not None}
+        self.next_rank = max(used, default=0) + 1
+        self.free_ranks = [r for r in range(1, self.next_rank) if r not in used]
+        heapq.heapify(self.free_ranks)
+        self._seq = itertools.count()
+        self._tokens = {}
+        self.expiry = []
+        for s in self.servers.values():
+            self._schedule(s)
+
+    def _schedule(self, s):
+        token = next(self._seq)
+        self._tokens[s['name']] = token
+        heapq.heappush(self.expiry, (float(s.get('last_seen', 0)) + HEARTBEAT_TIMEOUT, token, s['name']))
+
+    def _take_rank(self):
+        if self.free_ranks:
+            return heapq.heappop(self.free_ranks)
+        r = self.next_rank
+        self.next_rank += 1
+        return r
+
+    def load(self):
+        now = time.time()
+        self.servers = {s.get('name'): dict(s, last_seen=now) for s in load_servers() if s.get('name')}
+        replayed = 0
+        try:
+            with open(SERVERS_WAL, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        rec = json.loads(line)
+                    except ValueError:
+                        break  # torn last record from a crash: stop there
+                    self._apply(rec, now)
+                    replayed += 1
+        except FileNotFoundError:
+            pass
+        self.dirty = replayed > 0
+        self._rebuild_indexes()
+        if replayed:
+            print(f'Reference: snapshot + {replayed} registros do log recuperados')
+
+    def _apply(self, rec, now):
+        op = rec.get('op')
+        if op == 'upsert':
+            srv = rec.get('server') or {}
+            self.servers[srv.get('name')] = dict(srv, last_seen=now)
+        elif op == 'remove':
+            self.servers.pop(rec.get('name'), None)
+
+    def _log(self, rec):
+        if self._wal is None:
+            self._wal = open(SERVERS_WAL, 'a', encoding='utf-8')
+        self._wal.write(json.dumps(rec, ensure_ascii=False) + '\n')
+        self._wal.flush()
+        if WAL_FSYNC:
+            os.fsync(self._wal.fileno())
+        self.dirty = True
+
+    def _log_upsert(self, s):
+        self._log({'op': 'upsert', 'server': {'name': s['name'], 'rank': s['rank'], 'address': s.get('address')}})
+
+    def get(self, name):
+        return self.servers.get(name)
+
+    def all(self):
+        return list(self.servers.values())
+
+    def add(self, name, address, now):
+        s = {'name': name, 'rank': self._take_rank(), 'address': address, 'last_seen': now}
+        self.servers[name] = s
+        self._schedule(s)
+        self._log_upsert(s)
+        return s
+
+    def set_address(self, s, address):
+        s['address'] = address
+        self._log_upsert(s)
+
+    def touch(self, s, now):
+        s['last_seen'] = now
+
+    def remove(self, name):
+        s = self.servers.pop(name, None)
+        if s is not None:
+            # its heap entry becomes stale and is dropped when it surfaces
+            self._tokens.pop(name, None)
+            if s.get('rank') is not None:
+                heapq.heappush(self.free_ranks, int(s['rank']))
+            self._log({'op': 'remove', 'name': name})
+
+    def expire(self, now):
+        """Remove and return servers whose last heartbeat is older than HEARTBEAT_TIMEOUT."""
+        expired = []
+        while self.expiry and self.expiry[0][0] < now:
+            _, token, name = heapq.heappop(self.expiry)
+            if self._tokens.get(name) != token:
+                continue
+            s = self.servers[name]
+            if now - float(s.get('last_seen', 0)) > HEARTBEAT_TIMEOUT:
+                self.remove(name)
+                expired.append(s)
+            else:
+                self._schedule(s)
+        return expired
 
-
-def find_server_by_name(servers, name):
-    for s in servers:
-        if s.get('name') == name:
-            return s
-    return None
-
-
-def assign_rank(servers):
-    used = {int(s.get('rank')) for s in servers if s.get('rank') is not None}
-    r = 1
-    while r in used:
-        r += 1
-    return r
-
-
-def cleanup_expired(servers):
-    now = time.time()
-    alive = []
-    for s in servers:
-        last = s.get('last_seen', 0)
-        if now - float(last) <= HEARTBEAT_TIMEOUT:
-            alive.append(s)
-    return alive
+    def snapshot(self):
+        """Write servers.txt and truncate the log."""
+        if not save_servers(self.all()):
+            return False
+        if self._wal is not None:
+            self._wal.close()
+            self._wal = None
+        open(SERVERS_WAL, 'w').close()
+        self.dirty = False
+        return True
 
 
 class ReferenceServer:
@@ -69,15 +248,38 @@ class ReferenceServer:
         ensure_storage()
         self.bind_addr = bind_addr
         self.coordinator = None
-        self.lock = threading.Lock()
+        self.registry = ServerRegistry()
         self.context = zmq.Context()
-        self.socket = self.context.socket(zmq.REP)
+        self.socket = self.context.socket(zmq.ROUTER)
         self.socket.bind(bind_addr)
+        self.workers = self.context.socket(zmq.DEALER)
+        self.workers.bind(WORKERS_ADDR)
+        # membership version: bumped on every join, address change and expiry.
+        # epoch identifies this reference run, so a restart resets subscribers.
+        self.version = 0
+        self.epoch = time.time()
+        self.pub = self.context.socket(zmq.PUB)
+        self.pub.connect(f'tcp://{PUBSUB_ADDR}')
+        self.wake = self.context.socket(zmq.PULL)
+        self.wake.bind(WAKE_ADDR)
+        # only the front end thread touches the registry, version and PUB socket;
+        # other threads submit a callable to this queue and wake it up
+        self.writes = queue.Queue()
+        self._local = threading.local()
+        # immutable view of the membership served to 'list' without locking;
+        # the writer replaces it (never mutates it) after each change
+        self.changes = collections.deque(maxlen=CHANGE_LOG_SIZE)
+        self.view = None
+        self._refresh_view()
 
     def start(self):
         print('Reference listening on', self.bind_addr)
-        t = threading.Thread(target=self._serve_loop, daemon=True)
-        t.start()
+        for _ in range(REF_WORKERS):
+            threading.Thread(target=self._worker_loop, daemon=True).start()
+        threading.Thread(target=self._serve_loop, daemon=True).start()
+        threading.Thread(target=self._reap_loop, daemon=True).start()
+        threading.Thread(target=self._tick_loop, daemon=True).start()
+        threading.Thread(target=self._snapshot_loop, daemon=True).start()
         # menu loop if interactive
         try:
             if os.isatty(0):
@@ -88,94 +290,270 @@ class ReferenceServer:
                     time.sleep(1)
         except KeyboardInterrupt:
             print('Shutting down reference')
+            self._call(self.registry.snapshot)
+
+    @staticmethod
+    def _decode(raw):
+        try:
+            req = msgpack.unpackb(raw, raw=False, strict_map_key=False)
+        except Exception:
+            try:
+                req = json.loads(raw.decode('utf-8'))
+            except Exception:
+                req = None
+        return req if isinstance(req, dict) else None
+
+    @staticmethod
+    def _encode(req, reply):
+        # echo the caller's correlation id
+        rid = (req.get('data') or {}).get('req_id') if req else None
+        if rid is not None and isinstance(reply.get('data'), dict):
+            reply['data']['req_id'] = rid
+        # reply as msgpack
+        try:
+            return msgpack.packb(reply, use_bin_type=True)
+        except Exception:
+            return json.dumps(reply).encode('utf-8')
+
+    def _reply_for(self, req):
+        if req is None:
+            return {'service': 'error', 'data': {'message': 'invalid payload', 'timestamp': time.time(), 'clock': 0}}
+        try:
+            return self.handle_request(req)
+        except Exception as e:
+            print('Reference request error:', e)
+            return {'service': 'error', 'data': {'message': str(e), 'timestamp': time.time(), 'clock': 0}}
 
     def _serve_loop(self):
+        """ROUTER front end and single writer.
+
+        Reads are forwarded to the worker pool. Writes are applied here in
+        batches: every request already queued on the socket is handled, the
+        list view is refreshed once, and only then are the replies sent, so a
+        server that registered and then lists sees itself.
+        """
+        poller = zmq.Poller()
+        poller.register(self.socket, zmq.POLLIN)
+        poller.register(self.workers, zmq.POLLIN)
+        poller.register(self.wake, zmq.POLLIN)
         while True:
             try:
-                raw = self.socket.recv()
-                try:
-                    req = msgpack.unpackb(raw, raw=False, strict_map_key=False)
-                except Exception:
-                    try:
-                        req = json.loads(raw.decode('utf-8'))
-                    except Exception:
-                        req = None
-                if req is None:
-                    reply = {'service': 'error', 'data': {'message': 'invalid payload', 'timestamp': time.time(), 'clock': 0}}
-                else:
-                    reply = self.handle_request(req)
-                # reply as msgpack
-                try:
-                    self.socket.send(msgpack.packb(reply, use_bin_type=True))
-                except Exception:
-                    self.socket.send(json.dumps(reply).encode('utf-8'))
+                events = dict(poller.poll())
+                if self.workers in events:
+                    while True:
+                        try:
+                            self.socket.send_multipart(self.workers.recv_multipart(zmq.NOBLOCK))
+                        except zmq.Again:
+                            break
+                version = self.version
+                if self.wake in events:
+                    self._run_submitted()
+                replies = []
+                if self.socket in events:
+                    while len(replies) < 256:
+                        try:
+                            frames = self.socket.recv_multipart(zmq.NOBLOCK)
+                        except zmq.Again:
+                            break
+                        req = self._decode(frames[-1])
+                        if req is not None and req.get('service') in READ_SERVICES:
+                            self._renew(req)
+                            self.workers.send_multipart(frames)
+                            continue
+                        replies.append(frames[:-1] + [self._encode(req, self._reply_for(req))])
+                if self.version != version:
+                    self._refresh_view()
+                for frames in replies:
+                    self.socket.send_multipart(frames)
+            except zmq.ContextTerminated:
+                break
             except Exception as e:
                 # keep serving even on errors
                 print('Reference serve loop error:', e)
 
+    def _worker_loop(self):
+        sock = self.context.socket(zmq.DEALER)
+        sock.connect(WORKERS_ADDR)
+        while True:
+            try:
+                frames = sock.recv_multipart()
+                req = self._decode(frames[-1])
+                sock.send_multipart(frames[:-1] + [self._encode(req, self._reply_for(req))])
+            except zmq.ContextTerminated:
+                break
+            except Exception as e:
+                print('Reference worker error:', e)
+
+    def _renew(self, req):
+        # a read from a registered server renews its lease; unknown names are not registered
+        s = self.registry.get((req.get('data') or {}).get('user'))
+        if s is not None:
+            self.registry.touch(s, time.time())
+
+    def _submit(self, fn):
+        """Queue fn to run on the front end thread; returns a Future with its result."""
+        fut = Future()
+        self.writes.put((fn, fut))
+        # zmq sockets are not thread safe: one wake-up socket per calling thread
+        push = getattr(self._local, 'push', None)
+        if push is None:
+            push = self._local.push = self.context.socket(zmq.PUSH)
+            push.connect(WAKE_ADDR)
+        push.send(b'')
+        return fut
+
+    def _call(self, fn):
+        return self._submit(fn).result()
+
+    def _run_submitted(self):
+        while True:
+            try:
+                self.wake.recv(zmq.NOBLOCK)
+            except zmq.Again:
+                break
+        while True:
+            try:
+                fn, fut = self.writes.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                fut.set_result(fn())
+            except Exception as e:
+                fut.set_exception(e)
+
+    def _refresh_view(self):
+        servers = tuple({'name': s.get('name'), 'rank': s.get('rank'), 'address': s.get('address')}
+                        for s in self.registry.all())
+        self.view = {'list': servers, 'version': self.version, 'epoch': self.epoch,
+                     'changes': tuple(self.changes), 'names': frozenset(s['name'] for s in servers)}
+
+    def _publish(self, payload):
+        # runs on the front end thread, the only user of the PUB socket
+        try:
+            if PUBSUB_FRAMING == 'msgpack':
+                fields = {'sender': 'reference', 'clock': 0, 'timestamp': time.time(), 'body': payload}
+                self.pub.send_multipart([MEMBERSHIP_TOPIC.encode('utf-8'), msgpack.packb(fields, use_bin_type=True)])
+            else:
+                self.pub.send_string(f'{MEMBERSHIP_TOPIC} {json.dumps(payload)}')
+        except Exception as e:
+            print('Erro publicando membership:', e)
+
+    def _membership_event(self, event, s):
+        """Bump the version and publish one change (join, update or leave)."""
+        self.version += 1
+        server = {'name': s.get('name'), 'rank': s.get('rank'), 'address': s.get('address')}
+        self.changes.append((self.version, event, server))
+        self._publish({'event': event, 'server': server, 'version': self.version, 'epoch': self.epoch})
+
+    def _expire(self):
+        """Drop expired servers, publishing a leave event for each one."""
+        for s in self.registry.expire(time.time()):
+            self._membership_event('leave', s)
+
+    def _reap_loop(self):
+        # expiry only happens here, off the read path; leaves are pushed as they occur
+        while True:
+            time.sleep(REAP_INTERVAL)
+            try:
+                self._call(self._expire)
+            except Exception as e:
+                print('Reference reap error:', e)
+
+    def _snapshot_loop(self):
+        while True:
+            time.sleep(SNAPSHOT_INTERVAL)
+            try:
+                self._call(lambda: self.registry.dirty and self.registry.snapshot())
+            except Exception as e:
+                print('Reference snapshot error:', e)
+
+    def _register(self, name, address, now):
+        """Find or add a server and renew its lease (rank and heartbeat)."""
+        s = self.registry.get(name)
+        if s is None:
+            s = self.registry.add(name, address, now)
+            self._membership_event('join', s)
+        else:
+            self.registry.touch(s, now)
+            if address and s.get('address') != address:
+                self.registry.set_address(s, address)
+                self._membership_event('update', s)
+        return s
+
+    def _tick_loop(self):
+        while True:
+            time.sleep(MEMBERSHIP_TICK)
+            self._submit(lambda: self._publish({'event': 'tick', 'version': self.version, 'epoch': self.epoch}))
+
     def handle_request(self, req):
+        """Serve reads from the current view; writes run only on the front end thread."""
         svc = req.get('service')
-        data = req.get('data', {})
+        data = req.get('data') or {}
         now = time.time()
-        # load servers
-        with self.lock:
-            servers = load_servers()
-
-            if svc == 'rank':
-                name = data.get('user')
-                address = data.get('address') or data.get('addr')
-                # find or assign
-                s = find_server_by_name(servers, name)
-                if s is None:
-                    rank = assign_rank(servers)
-                    s = {'name': name, 'rank': rank, 'address': address, 'last_seen': now}
-                    servers.append(s)
-                    save_servers(servers)
-                else:
-                    # update address/last_seen
-                    if address:
-                        s['address'] = address
-                    s['last_seen'] = now
-                    save_servers(servers)
-                return {'service': 'rank', 'data': {'rank': s['rank'], 'timestamp': now, 'clock': 0}}
-
-            elif svc == 'list':
-                # cleanup expired before returning
-                servers = cleanup_expired(servers)
-                save_servers(servers)
-                simple = [{'name': s.get('name'), 'rank': s.get('rank'), 'address': s.get('address')} for s in servers]
-                return {'service': 'list', 'data': {'list': simple, 'timestamp': now, 'clock': 0}}
-
-            elif svc == 'heartbeat':
-                name = data.get('user')
-                address = data.get('address') or data.get('addr')
-                s = find_server_by_name(servers, name)
-                if s is None:
-                    rank = assign_rank(servers)
-                    s = {'name': name, 'rank': rank, 'address': address, 'last_seen': now}
-                    servers.append(s)
-                else:
-                    s['last_seen'] = now
-                    if address:
-                        s['address'] = address
-                save_servers(servers)
-                return {'service': 'heartbeat', 'data': {'timestamp': now, 'clock': 0}}
-
-            elif svc == 'clock':
-                # return server time
-                return {'service': 'clock', 'data': {'time': now, 'timestamp': now, 'clock': 0}}
-
-            elif svc == 'election':
-                # if coordinator announced in the request, update and reply with coordinator
-                coord = data.get('coordinator')
-                if coord:
-                    self.coordinator = coord
-                    return {'service': 'election', 'data': {'coordinator': coord, 'timestamp': now, 'clock': 0}}
-                # otherwise, acknowledge election request
-                return {'service': 'election', 'data': {'election': 'OK', 'timestamp': now, 'clock': 0}}
+        if svc == 'list':
+            view = self.view
+            reply = {'version': view['version'], 'epoch': view['epoch'], 'timestamp': now, 'clock': 0}
+            if data.get('user') in view['names']:
+                reply['lease'] = HEARTBEAT_TIMEOUT
+            since = data.get('since_version')
+            # a delta only makes sense against the same reference run
+            if isinstance(since, int) and data.get('epoch') == view['epoch'] and since <= view['version']:
+                if since == view['version']:
+                    reply['not_modified'] = True
+                    return {'service': 'list', 'data': reply}
+                delta = membership_delta(view['changes'], since)
+                if delta is not None:
+                    reply.update(delta=True, since_version=since, added=delta[0], removed=delta[1], changed=delta[2])
+                    return {'service': 'list', 'data': reply}
+            reply['list'] = list(view['list'])
+            return {'service': 'list', 'data': reply}
+
+        elif svc == 'clock':
+            # return server time
+            reply = {'time': now, 'timestamp': now, 'clock': 0}
+            if data.get('user') in self.view['names']:
+                reply['lease'] = HEARTBEAT_TIMEOUT
+            return {'service': 'clock', 'data': reply}
+
+        elif svc in ('rank', 'heartbeat', 'election'):
+            return self._apply_write(svc, data, now)
 
-            else:
-                return {'service': 'error', 'data': {'message': 'unknown service', 'timestamp': now, 'clock': 0}}
+        else:
+            return {'service': 'error', 'data': {'message': 'unknown service', 'timestamp': now, 'clock': 0}}
+
+    def _apply_write(self, svc, data, now):
+        # runs on the front end thread
+        if svc == 'rank':
+            name = data.get('user')
+            address = data.get('address') or data.get('addr')
+            # find or assign
+            s = self._register(name, address, now)
+            return {'service': 'rank', 'data': {'rank': s['rank'], 'lease': HEARTBEAT_TIMEOUT,
+                                                'timestamp': now, 'clock': 0}}
+
+        elif svc == 'heartbeat':
+            # data.users renews several servers at once (e.g. replicas on one host):
+            # a list of names or of {user, address} maps
+            entries = data.get('users') or [data]
+            renewed = 0
+            for entry in entries:
+                if not isinstance(entry, dict):
+                    entry = {'user': entry}
+                name = entry.get('user')
+                if not name:
+                    continue
+                self._register(name, entry.get('address') or entry.get('addr'), now)
+                renewed += 1
+            return {'service': 'heartbeat', 'data': {'lease': HEARTBEAT_TIMEOUT, 'renewed': renewed,
+                                                     'timestamp': now, 'clock': 0}}
+
+        # election: if coordinator announced in the request, update and reply with coordinator
+        coord = data.get('coordinator')
+        if coord:
+            self.coordinator = coord
+            return {'service': 'election', 'data': {'coordinator': coord, 'timestamp': now, 'clock': 0}}
+        # otherwise, acknowledge election request
+        return {'service': 'election', 'data': {'election': 'OK', 'timestamp': now, 'clock': 0}}
 
     def menu_loop(self):
         print('\nReference admin menu (type help for commands)')
@@ -192,7 +570,7 @@ class ReferenceServer:
             if cmd in ('h', 'help'):
                 print('\nCommands:')
                 print('  list            - show registered servers')
-                print('  save            - persist servers to file')
+                print('  save            - write a snapshot and truncate the log')
                 print('  cleanup         - remove expired servers')
                 print('  show <name>     - show server details')
                 print('  announce <name> - set coordinator to <name>')
@@ -201,27 +579,17 @@ class ReferenceServer:
                 continue
             parts = cmd.split()
             if parts[0] == 'list':
-                with self.lock:
-                    servers = load_servers()
-                    servers = cleanup_expired(servers)
-                    print(json.dumps(servers, indent=2, ensure_ascii=False))
+                self._call(self._expire)
+                print(json.dumps(self._call(lambda: [dict(s) for s in self.registry.all()]), indent=2, ensure_ascii=False))
             elif parts[0] == 'save':
-                with self.lock:
-                    servers = load_servers()
-                    save_servers(servers)
-                    print('saved')
+                print('saved' if self._call(self.registry.snapshot) else 'save failed')
             elif parts[0] == 'cleanup':
-                with self.lock:
-                    servers = load_servers()
-                    servers = cleanup_expired(servers)
-                    save_servers(servers)
-                    print('cleanup done')
+                self._call(self._expire)
+                print('cleanup done')
             elif parts[0] == 'show' and len(parts) > 1:
                 name = parts[1]
-                with self.lock:
-                    servers = load_servers()
-                    s = find_server_by_name(servers, name)
-                    print(json.dumps(s or {}, indent=2, ensure_ascii=False))
+                s = self._call(lambda: dict(self.registry.get(name) or {}))
+                print(json.dumps(s, indent=2, ensure_ascii=False))
             elif parts[0] == 'announce' and len(parts) > 1:
                 name = parts[1]
                 self.coordinator = name
@@ -1,147 +1,1162 @@
 import os
 import zmq
+import zmq.asyncio
+import asyncio
 import time
 import msgpack
 import threading
+import queue
+import collections
+import concurrent.futures
+import atexit
+import signal
+import sys
 import socket as pysocket
 import json
+import http.server
+import random
+import struct
+import urllib.parse
+import uuid
 from datetime import datetime, timedelta, timezone
 
 br_tz = timezone(timedelta(hours=-3))
 
 context = zmq.Context()
-socket = context.socket(zmq.REP)
-socket.connect("tcp://broker:5556")
 
 logical_clock = 0
-app_time = time.time()
+# application clock used by Berkeley: local time plus an offset adjusted by the coordinator
+app_time_offset = 0.0
 message_count = 0
 coordinator_name = None
 
 SERVER_NAME = os.environ.get("SERVER_NAME") or pysocket.gethostname()
 
 REFERENCE_ADDR = os.environ.get("REFERENCE_ADDR", "reference:5560")
+BROKER_ADDR = os.environ.get("BROKER_ADDR", "broker:5556")
+
+# SERVER_MODE=rep: single REP socket (default); SERVER_MODE=threads: ROUTER front end
+# with WORKERS request threads behind an inproc DEALER
+# SERVER_MODE=asyncio: ROUTER front end on zmq.asyncio, one task per request (up to
+# ASYNC_MAX_INFLIGHT), with the admin endpoint, subscriber and heartbeat in the same loop
+# SERVER_MODE=lb: like threads, but for the load-balancing broker (BROKER_MODE=lb): a
+# DEALER announces READY with BROKER_CAPACITY as capacity and the broker routes by load
+SERVER_MODE = os.environ.get("SERVER_MODE", "rep")
+WORKERS = int(os.environ.get("WORKERS") or os.cpu_count() or 4)
+# lb mode: requests the broker may have outstanding here. Headroom above WORKERS keeps
+# the next requests queued locally instead of each one waiting a broker round trip
+BROKER_CAPACITY = int(os.environ.get("BROKER_CAPACITY") or 4 * WORKERS)
+ASYNC_MAX_INFLIGHT = int(os.environ.get("ASYNC_MAX_INFLIGHT", "10000"))
+# lb mode: heartbeat period towards the broker (must match the broker's setting)
+BROKER_HEARTBEAT_INTERVAL = float(os.environ.get("BROKER_HEARTBEAT_INTERVAL", "1.0"))
+INDEX_REFRESH_INTERVAL = float(os.environ.get("INDEX_REFRESH_INTERVAL", "0.1"))
+
+STORAGE_DIR = os.environ.get("STORAGE_DIR", "/app/storage-server")
+LOGINS_FILE = os.path.join(STORAGE_DIR, "logins.txt")
+CHANNELS_FILE = os.path.join(STORAGE_DIR, "channels.txt")
+HISTORY_MSG_FILE = os.path.join(STORAGE_DIR, "historico_msg.txt")
+HISTORY_PUBSUB_FILE = os.path.join(STORAGE_DIR, "historico_pubsub.txt")
+
+# group commit of history records: flush every HISTORY_FLUSH_INTERVAL seconds or
+# HISTORY_BATCH_SIZE records; HISTORY_FSYNC is one of none | interval | every-batch
+HISTORY_FLUSH_INTERVAL = float(os.environ.get("HISTORY_FLUSH_INTERVAL", "0.05"))
+HISTORY_BATCH_SIZE = int(os.environ.get("HISTORY_BATCH_SIZE", "256"))
+HISTORY_FSYNC = os.environ.get("HISTORY_FSYNC", "interval")
+HISTORY_FSYNC_INTERVAL = float(os.environ.get("HISTORY_FSYNC_INTERVAL", "1.0"))
+# 'publish'/'message' with data.durable wait up to this many seconds for their record to be durable
+HISTORY_DURABLE_TIMEOUT = float(os.environ.get("HISTORY_DURABLE_TIMEOUT", "5.0"))
+# indexed history log queried by the 'history' service (one store per server under HISTORY_DIR)
+HISTORY_DIR = os.path.join(STORAGE_DIR, "history")
+HISTORY_SEGMENT_BYTES = int(os.environ.get("HISTORY_SEGMENT_BYTES", str(64 * 1024 * 1024)))
+HISTORY_MAX_LIMIT = int(os.environ.get("HISTORY_MAX_LIMIT", "500"))
+HISTORY_OPEN_FILES = int(os.environ.get("HISTORY_OPEN_FILES", "256"))
+# largest 'batch' request accepted; bigger batches are refused whole to keep tail latency bounded
+BATCH_MAX = int(os.environ.get("BATCH_MAX", "100"))
+
+PUBSUB_ADDR = os.environ.get("PUBSUB_ADDR", "proxy_pubsub:5557")
+PUBSUB_SUB_ADDR = os.environ.get("PUBSUB_SUB_ADDR", "proxy_pubsub:5558")
+PUB_HWM = int(os.environ.get("PUB_HWM", "10000"))
+# pub/sub payload framing: "text" ("<topic> <text>", one frame) or "msgpack"
+# ([topic, msgpack {sender, clock, timestamp, body}]); subscribers accept both
+PUBSUB_FRAMING = os.environ.get("PUBSUB_FRAMING", "text")
+# delivery tracing (msgpack framing only): 'publish'/'message' requests carrying
+# data.trace, plus a TRACE_SAMPLE fraction of all others, are published with a
+# third frame {id, t0, t_recv, t_pub} of time_ns() stamps (see pub-sub/subscriber.py --measure)
+TRACE_SAMPLE = float(os.environ.get("TRACE_SAMPLE", "0"))
+TRACED_SERVICES = {"publish", "message"}
+
+# reference / peer calls: per-attempt timeout (s), retries after a timeout, base backoff (s)
+REQUEST_TIMEOUT = float(os.environ.get("REQUEST_TIMEOUT", "3.0"))
+REQUEST_RETRIES = int(os.environ.get("REQUEST_RETRIES", "2"))
+REQUEST_BACKOFF = float(os.environ.get("REQUEST_BACKOFF", "0.1"))
+
+# Berkeley round: overall deadline (s), max offset from the median kept in the average (s),
+# and how many servers are polled/adjusted at once
+BERKELEY_DEADLINE = float(os.environ.get("BERKELEY_DEADLINE", "3.0"))
+BERKELEY_OUTLIER = float(os.environ.get("BERKELEY_OUTLIER", "5.0"))
+BERKELEY_MAX_PARALLEL = int(os.environ.get("BERKELEY_MAX_PARALLEL", "32"))
+
+# sync rounds (election check / Berkeley): every SYNC_INTERVAL seconds and/or every
+# SYNC_EVERY replies (0 disables either), never closer than SYNC_MIN_GAP seconds apart
+SYNC_INTERVAL = float(os.environ.get("SYNC_INTERVAL", "30"))
+SYNC_EVERY = int(os.environ.get("SYNC_EVERY", "10"))
+SYNC_MIN_GAP = float(os.environ.get("SYNC_MIN_GAP", "1.0"))
+# lease assumed until the reference grants one; renewed at a third of its length
+LEASE_DEFAULT = float(os.environ.get("LEASE_DEFAULT", "30"))
+
+# upper bounds (s) of the latency histogram buckets of the admin 'metrics' service;
+# METRICS_HTTP_PORT > 0 also serves them as text exposition on GET /metrics
+METRICS_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+                   2.5, 5.0, 10.0)
+METRICS_HTTP_PORT = int(os.environ.get("METRICS_HTTP_PORT", "0"))
 
 admin_port = None
 
 SERVER_ADDR = None
 
+# guards logical_clock and message_count, which are shared by request worker threads
+clock_lock = threading.Lock()
+
+def current_app_time():
+    return time.time() + app_time_offset
+
+def set_app_time(t):
+    global app_time_offset
+    with clock_lock:
+        app_time_offset = float(t) - time.time()
+
+def adjust_app_time(delta):
+    global app_time_offset
+    with clock_lock:
+        app_time_offset += float(delta)
+
 def update_clock_on_receive(received):
     global logical_clock
     try:
         if received is None:
             return
         r = int(received)
-        if r > logical_clock:
-            logical_clock = r
+        with clock_lock:
+            if r > logical_clock:
+                logical_clock = r
     except Exception:
         pass
 
 def increment_clock_before_send():
     global logical_clock
-    logical_clock += 1
-    return logical_clock
+    with clock_lock:
+        logical_clock += 1
+        return logical_clock
+
+class Metrics:
+    """Process-wide counters and fixed-bucket latency histograms.
+
+    Series are keyed by name plus labels. Buckets are the same on every server
+    (METRICS_BUCKETS), so admin_tool can add histograms from several servers
+    and still read percentiles off the sum.
+    """
+
+    def __init__(self, buckets=METRICS_BUCKETS):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.counters = collections.Counter()
+        # (name, labels) -> [count per bucket (last one is +Inf), sum, count]
+        self.histograms = {}
+
+    def incr(self, name, n=1, **labels):
+        with self.lock:
+            self.counters[(name, tuple(sorted(labels.items())))] += n
+
+    def observe(self, name, seconds, **labels):
+        i = 0
+        while i < len(self.buckets) and seconds > self.buckets[i]:
+            i += 1
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            h = self.histograms.get(key)
+            if h is None:
+                h = self.histograms[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            h[0][i] += 1
+            h[1] += seconds
+            h[2] += 1
+
+    def snapshot(self):
+        with self.lock:
+            counters = [{"name": name, "labels": dict(labels), "value": value}
+                        for (name, labels), value in sorted(self.counters.items())]
+            histograms = [{"name": name, "labels": dict(labels), "buckets": list(h[0]), "sum": h[1], "count": h[2]}
+                          for (name, labels), h in sorted(self.histograms.items())]
+        return {"buckets_s": list(self.buckets), "counters": counters, "histograms": histograms}
+
+    def exposition(self, gauges, counters=None):
+        """Text exposition format (Prometheus) of the snapshot plus `gauges` and extra `counters` ({name: value})."""
+        def fmt(labels, **extra):
+            items = dict({"server": SERVER_NAME}, **labels, **extra)
+            return "{" + ",".join(f'{k}="{v}"' for k, v in items.items()) + "}"
+
+        snap = self.snapshot()
+        snap["counters"] += [{"name": name, "labels": {}, "value": value} for name, value in (counters or {}).items()]
+        lines = []
+        typed = set()
+
+        def family(name, kind):
+            # one TYPE line per metric family; the snapshot is sorted, so its series are adjacent
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} {kind}")
+
+        for c in snap["counters"]:
+            name = f"servidor_{c['name']}_total"
+            family(name, "counter")
+            lines.append(f"{name}{fmt(c['labels'])} {c['value']}")
+        for h in snap["histograms"]:
+            name = f"servidor_{h['name']}"
+            family(name, "histogram")
+            cumulative = 0
+            for le, n in zip([*map(str, self.buckets), "+Inf"], h["buckets"]):
+                cumulative += n
+                lines.append(f"{name}_bucket{fmt(h['labels'], le=le)} {cumulative}")
+            lines += [f"{name}_sum{fmt(h['labels'])} {h['sum']}", f"{name}_count{fmt(h['labels'])} {h['count']}"]
+        for name, value in gauges.items():
+            if value is not None:
+                lines += [f"# TYPE servidor_{name} gauge", f"servidor_{name}{fmt({})} {value}"]
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+
+class TailedIndex:
+    """In-memory index of the first column of an append-only storage file.
+
+    The file is read once at startup and afterwards only the bytes appended since
+    the last read offset are parsed, so appends made by other replicas on the
+    shared volume are picked up without rereading the whole file. A change of
+    inode, a shrinking size or an mtime change without growth means the file was
+    rewritten, and the index is rebuilt from the start.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self._names = []
+        self._index = set()
+        self._offset = 0
+        self._inode = None
+        self._mtime = None
+        # when False, exists()/names() answer from memory and refresh() is driven externally
+        self.auto_refresh = True
+        self.refresh()
+
+    def _reset(self, inode=None):
+        self._names = []
+        self._index = set()
+        self._offset = 0
+        self._inode = inode
+        self._mtime = None
+
+    def _refresh_locked(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            self._reset()
+            return
+        if st.st_ino != self._inode or st.st_size < self._offset or \
+                (st.st_size == self._offset and self._mtime is not None and st.st_mtime_ns != self._mtime):
+            self._reset(st.st_ino)
+        if st.st_size == self._offset:
+            self._mtime = st.st_mtime_ns
+            return
+        start = time.perf_counter()
+        with open(self.path, "rb") as f:
+            f.seek(self._offset)
+            chunk = f.read(st.st_size - self._offset)
+        metrics.observe("storage_seconds", time.perf_counter() - start, op="read", target="index")
+        # only consume complete lines; a partially written one is read on the next refresh
+        end = chunk.rfind(b"\n")
+        if end < 0:
+            return
+        for line in chunk[:end].decode("utf-8", errors="replace").split("\n"):
+            name = line.strip().split(",")[0]
+            if name and name not in self._index:
+                self._index.add(name)
+                self._names.append(name)
+        self._offset += end + 1
+        if self._offset == st.st_size:
+            self._mtime = st.st_mtime_ns
+
+    def refresh(self):
+        with self.lock:
+            self._refresh_locked()
+
+    def exists(self, name):
+        with self.lock:
+            if self.auto_refresh:
+                self._refresh_locked()
+            return name in self._index
+
+    def names(self):
+        with self.lock:
+            if self.auto_refresh:
+                self._refresh_locked()
+            return list(self._names)
+
+    def add(self, name, timestamp):
+        """Append a new entry. Returns False if the name was already present."""
+        with self.lock:
+            self._refresh_locked()
+            if name in self._index:
+                return False
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            start = time.perf_counter()
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(f"{name},{timestamp}\n")
+            metrics.observe("storage_seconds", time.perf_counter() - start, op="write", target="index")
+            self._refresh_locked()
+            return True
+
+
+class UserRegistry(TailedIndex):
+    """Registered users (logins.txt)."""
+
+    def users(self):
+        return self.names()
+
+
+class ChannelCatalog(TailedIndex):
+    """Existing channels (channels.txt), in creation order."""
+
+    def channels(self):
+        return self.names()
+
+
+class Publisher:
+    """Single long-lived PUB socket shared by every thread of the process.
+
+    Connecting once at startup avoids a context + TCP handshake per message and the
+    slow-joiner loss of a freshly connected PUB socket. zmq sockets are not
+    thread-safe, so sends are serialized with a lock.
+    """
+
+    def __init__(self, ctx, address, hwm=PUB_HWM):
+        self.address = address
+        self.lock = threading.Lock()
+        self.sent = 0
+        self.failed = 0
+        self.socket = ctx.socket(zmq.PUB)
+        self.socket.setsockopt(zmq.SNDHWM, hwm)
+        self.socket.setsockopt(zmq.LINGER, 1000)
+        self.socket.connect(f"tcp://{address}")
+
+    def send_string(self, msg):
+        with self.lock:
+            try:
+                self.socket.send_string(msg)
+                self.sent += 1
+            except Exception:
+                self.failed += 1
+                raise
+
+    def publish(self, topic, sender, body, clock, timestamp, text, trace=None):
+        """Publish one message in the configured framing; `text` is the single-frame payload.
+
+        With msgpack framing a `trace` (see stamp_trace) goes out as a third
+        frame, stamped with t_pub right before the send.
+        """
+        if PUBSUB_FRAMING != "msgpack":
+            self.send_string(f"{topic} {text}")
+            return
+        frames = [topic.encode("utf-8"), msgpack.packb({"sender": sender, "clock": clock, "timestamp": timestamp,
+                                                        "body": body}, use_bin_type=True)]
+        with self.lock:
+            try:
+                if trace is not None:
+                    frames.append(msgpack.packb(dict(trace, t_pub=time.time_ns()), use_bin_type=True))
+                self.socket.send_multipart(frames)
+                self.sent += 1
+            except Exception:
+                self.failed += 1
+                raise
+
+
+def stamp_trace(service, data, t_recv):
+    """Mark a request for delivery tracing: keep the client's id/t0 and add t_recv."""
+    if service not in TRACED_SERVICES or PUBSUB_FRAMING != "msgpack" or not isinstance(data, dict):
+        return
+    trace = data.get("trace")
+    if trace is None and not (TRACE_SAMPLE and random.random() < TRACE_SAMPLE):
+        return
+    trace = trace if isinstance(trace, dict) else {}
+    data["trace"] = {"id": str(trace.get("id") or uuid.uuid4().hex[:16]), "t0": trace.get("t0"),
+                     "t_recv": t_recv, "server": SERVER_NAME}
+
+
+def decode_pubsub(frames):
+    """Return (topic, fields) for a message in either framing.
+
+    Multipart messages carry the fields as msgpack. Single-frame messages are
+    "<topic> <text>"; a JSON text becomes the body, anything else stays a string.
+    """
+    if len(frames) >= 2:
+        return frames[0].decode("utf-8"), msgpack.unpackb(frames[1], raw=False, strict_map_key=False)
+    topic, _, text = frames[0].decode("utf-8").partition(" ")
+    try:
+        body = json.loads(text)
+    except ValueError:
+        body = text
+    return topic, {"sender": None, "clock": None, "timestamp": None, "body": body}
+
+
+class HistoryStore:
+    """Append-only segmented history log of one server, with offset indexes.
+
+    Records are JSON lines in seg-NNNNNN.log files, rolled over at
+    HISTORY_SEGMENT_BYTES. Every record gets a fixed-size entry (clock, segment,
+    offset, length) in idx/all.idx and in one index file per channel and per
+    user involved (idx/c-<channel>.idx, idx/u-<user>.idx). Clocks only grow
+    within a store, so each index file is sorted by clock: a query binary
+    searches it and reads one contiguous run of entries, i.e. O(log n + page).
+
+    Only the owning server writes its store (through HistoryWriter, which owns
+    the file descriptors); any server can search every store in HISTORY_DIR.
+    """
+
+    ENTRY = struct.Struct("<qIQI")
+
+    def __init__(self, root, server):
+        self.server = server
+        self.dir = os.path.join(root, urllib.parse.quote(server, safe=""))
+        os.makedirs(os.path.join(self.dir, "idx"), exist_ok=True)
+        segments = sorted(f for f in os.listdir(self.dir) if f.startswith("seg-"))
+        self.segment = int(segments[-1][4:10]) if segments else 1
+        self.segment_size = self._size(self._segment_path(self.dir, self.segment))
+        # drop entries torn by a crash, or later appends would be misaligned
+        for name in os.listdir(os.path.join(self.dir, "idx")):
+            path = os.path.join(self.dir, "idx", name)
+            torn = self._size(path) % self.ENTRY.size
+            if torn:
+                os.truncate(path, self._size(path) - torn)
+        self.last_clock = self._last_clock(self.dir, "all")
+
+    @staticmethod
+    def _size(path):
+        try:
+            return os.path.getsize(path)
+        except OSError:
+            return 0
+
+    @staticmethod
+    def _segment_path(directory, segment):
+        return os.path.join(directory, f"seg-{segment:06d}.log")
+
+    @staticmethod
+    def _index_path(directory, key):
+        return os.path.join(directory, "idx", key + ".idx")
+
+    @staticmethod
+    def keys(record):
+        q = lambda v: urllib.parse.quote(str(v), safe="")
+        if record.get("type") == "publish":
+            return ["all", "c-" + q(record.get("channel")), "u-" + q(record.get("user"))]
+        users = dict.fromkeys([record.get("src"), record.get("dst")])
+        return ["all"] + ["u-" + q(u) for u in users if u]
+
+    def encode(self, records):
+        """Lay records out as {path: bytes} to append, segment data before index entries.
+
+        Positions are assigned here, so the result must be written in full
+        (HistoryWriter retries a batch until it is).
+        """
+        data, entries = {}, {}
+        for record in records:
+            line = (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+            if self.segment_size and self.segment_size + len(line) > HISTORY_SEGMENT_BYTES:
+                self.segment += 1
+                self.segment_size = 0
+            data.setdefault(self._segment_path(self.dir, self.segment), []).append(line)
+            entry = self.ENTRY.pack(int(record["clock"]), self.segment, self.segment_size, len(line))
+            self.segment_size += len(line)
+            self.last_clock = max(self.last_clock, int(record["clock"]))
+            for key in self.keys(record):
+                entries.setdefault(self._index_path(self.dir, key), []).append(entry)
+        pending = {path: b"".join(parts) for path, parts in data.items()}
+        pending.update((path, b"".join(parts)) for path, parts in entries.items())
+        return pending
+
+    @classmethod
+    def _last_clock(cls, directory, key):
+        try:
+            with open(cls._index_path(directory, key), "rb") as f:
+                f.seek(0, os.SEEK_END)
+                if f.tell() < cls.ENTRY.size:
+                    return 0
+                f.seek(-cls.ENTRY.size, os.SEEK_END)
+                return cls.ENTRY.unpack(f.read(cls.ENTRY.size))[0]
+        except OSError:
+            return 0
+
+    @classmethod
+    def search(cls, directory, key, lo, hi, limit, descending):
+        """Up to `limit` records of `key` with lo <= clock <= hi, newest first if descending."""
+        size = cls.ENTRY.size
+        try:
+            fd = os.open(cls._index_path(directory, key), os.O_RDONLY)
+        except OSError:
+            return []
+        try:
+            # a partially appended entry at the end is not counted
+            n = os.fstat(fd).st_size // size
+
+            def bisect(clock):
+                left, right = 0, n
+                while left < right:
+                    mid = (left + right) // 2
+                    if cls.ENTRY.unpack(os.pread(fd, size, mid * size))[0] < clock:
+                        left = mid + 1
+                    else:
+                        right = mid
+                return left
+
+            first, end = bisect(lo), bisect(hi + 1)
+            take = min(limit, end - first)
+            start = end - take if descending else first
+            raw = os.pread(fd, take * size, start * size)
+        finally:
+            os.close(fd)
+        entries = [cls.ENTRY.unpack_from(raw, i * size) for i in range(len(raw) // size)]
+        if descending:
+            entries.reverse()
+        records, fds = [], {}
+        try:
+            for clock, segment, offset, length in entries:
+                if segment not in fds:
+                    fds[segment] = os.open(cls._segment_path(directory, segment), os.O_RDONLY)
+                line = os.pread(fds[segment], length, offset)
+                if len(line) == length:  # skip data lost before an fsync
+                    records.append(json.loads(line))
+        finally:
+            for fd in fds.values():
+                os.close(fd)
+        return records
+
+
+def query_history(key, limit, before=None, after=None, cursor=None):
+    """Search every server's store under HISTORY_DIR and merge by (clock, server).
+
+    Results are newest first, unless only `after` is given. cursor is the
+    [clock, server] of the last record of the previous page; records equal
+    in clock are ordered by server name, so pages never skip or repeat one.
+    """
+    descending = not (after is not None and before is None)
+    try:
+        stores = sorted(os.listdir(HISTORY_DIR))
+    except OSError:
+        stores = []
+    found = []
+    for quoted in stores:
+        server = urllib.parse.unquote(quoted)
+        lo = after + 1 if after is not None else 0
+        hi = before - 1 if before is not None else 2 ** 62
+        if cursor:
+            c_clock, c_server = int(cursor[0]), str(cursor[1])
+            if descending:
+                hi = min(hi, c_clock if server < c_server else c_clock - 1)
+            else:
+                lo = max(lo, c_clock if server > c_server else c_clock + 1)
+        if lo > hi:
+            continue
+        for record in HistoryStore.search(os.path.join(HISTORY_DIR, quoted), key, lo, hi, limit, descending):
+            record["server"] = server
+            found.append(record)
+    found.sort(key=lambda r: (r.get("clock", 0), r["server"]), reverse=descending)
+    page = found[:limit]
+    more = len(found) > limit
+    next_cursor = [page[-1].get("clock"), page[-1]["server"]] if page and more else None
+    return page, next_cursor
+
+
+class HistoryWriter:
+    """Background group-commit writer for the history files.
+
+    Request threads only enqueue a record and get its sequence number back; a
+    single writer thread appends batches with one write per file (O_APPEND, so
+    lines from other replicas sharing the volume are not interleaved) and fsyncs
+    according to the configured policy. durable_seq is the highest sequence
+    number known to be persisted under that policy; a batch that fails to be
+    written or synced is retried and never counted as written or durable.
+
+    Records passed along with a line also go to the indexed HistoryStore, in
+    the same batch and under the same durability policy.
+    """
+
+    POLICIES = ("none", "interval", "every-batch")
+    RETRY_DELAY = 0.5
+
+    def __init__(self, flush_interval=HISTORY_FLUSH_INTERVAL, batch_size=HISTORY_BATCH_SIZE,
+                 fsync_policy=HISTORY_FSYNC, fsync_interval=HISTORY_FSYNC_INTERVAL, store=None):
+        if fsync_policy not in self.POLICIES:
+            raise ValueError(f"HISTORY_FSYNC inválido: {fsync_policy!r} (use {', '.join(self.POLICIES)})")
+        self.flush_interval = flush_interval
+        self.batch_size = max(1, batch_size)
+        self.fsync_policy = fsync_policy
+        self.fsync_interval = fsync_interval
+        self.store = store
+        self.queue = queue.Queue()
+        self.cond = threading.Condition()
+        self.seq = 0
+        self.written_seq = 0
+        self.durable_seq = 0
+        self.batches = 0
+        self.errors = 0
+        self.last_error = None
+        self.closed = False
+        self._fds = {}
+        self._dirty = set()
+        self._last_fsync = time.monotonic()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def append(self, path, line, record=None):
+        """Queue one history line (and its store record, if any); returns its sequence number."""
+        with self.cond:
+            if self.closed:
+                raise RuntimeError("history writer encerrado")
+            self.seq += 1
+            seq = self.seq
+            # enqueue under the lock so queue order matches sequence order
+            self.queue.put((seq, path, line, record))
+        return seq
+
+    def queue_depth(self):
+        return self.queue.qsize()
+
+    def wait_durable(self, seq, timeout=None):
+        with self.cond:
+            return self.cond.wait_for(lambda: self.durable_seq >= seq, timeout)
+
+    def stats(self):
+        with self.cond:
+            return {
+                "queue_depth": self.queue.qsize(),
+                "seq": self.seq,
+                "written_seq": self.written_seq,
+                "durable_seq": self.durable_seq,
+                "batches": self.batches,
+                "errors": self.errors,
+                "last_error": self.last_error,
+                "fsync": self.fsync_policy,
+            }
+
+    def close(self, timeout=5.0):
+        """Stop accepting records, drain the queue and fsync what was written."""
+        with self.cond:
+            if self.closed:
+                return
+            self.closed = True
+            self.queue.put(None)
+        self.thread.join(timeout)
+
+    def _error(self, what, path, e):
+        self.errors += 1
+        msg = f"{what} {path}: {e}"
+        # the failing batch is retried; log each distinct error once
+        if msg != self.last_error:
+            print("[history] erro ao", msg)
+        self.last_error = msg
+
+    def _fd(self, path):
+        fd = self._fds.get(path)
+        if fd is None:
+            # one index file per channel/user: keep only the most recently opened ones
+            while len(self._fds) >= HISTORY_OPEN_FILES:
+                old = next(iter(self._fds))
+                if old in self._dirty:
+                    os.fsync(self._fds[old])
+                    self._dirty.discard(old)
+                os.close(self._fds.pop(old))
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            self._fds[path] = fd
+        return fd
+
+    def _sync(self):
+        """fsync every file written since the last sync; returns False on failure."""
+        for path in list(self._dirty):
+            start = time.perf_counter()
+            try:
+                os.fsync(self._fds[path])
+            except OSError as e:
+                self._error("sincronizar", path, e)
+                return False
+            metrics.observe("storage_seconds", time.perf_counter() - start, op="fsync", target="history")
+            self._dirty.discard(path)
+        self._last_fsync = time.monotonic()
+        with self.cond:
+            self.durable_seq = self.written_seq
+            self.cond.notify_all()
+        return True
 
-def send_req_to_reference(req_msg):
+    def _write_pending(self, pending):
+        """Write the remaining bytes of each file in pending (path -> bytes).
+
+        Short writes are continued and whatever was written is removed from
+        pending, so a retry after an error never duplicates lines.
+        """
+        for path in list(pending):
+            data = pending[path]
+            try:
+                fd = self._fd(path)
+                while data:
+                    n = os.write(fd, data)
+                    data = data[n:]
+                    pending[path] = data
+                    self._dirty.add(path)
+            except OSError as e:
+                self._error("gravar", path, e)
+                return False
+            del pending[path]
+        return True
+
+    def _write(self, batch):
+        per_file = {}
+        for _, path, line, _ in batch:
+            per_file.setdefault(path, []).append(line)
+        pending = {path: "".join(lines).encode("utf-8") for path, lines in per_file.items()}
+        records = [record for *_, record in batch if record is not None]
+        if self.store is not None and records:
+            pending.update(self.store.encode(records))
+        # keep retrying this batch: later records must not become durable before it
+        start = time.perf_counter()
+        while not self._write_pending(pending):
+            time.sleep(self.RETRY_DELAY)
+        metrics.observe("storage_seconds", time.perf_counter() - start, op="write", target="history")
+        with self.cond:
+            self.written_seq = batch[-1][0]
+            self.batches += 1
+            if self.fsync_policy == "none":
+                self.durable_seq = self.written_seq
+                self.cond.notify_all()
+        if self.fsync_policy == "every-batch":
+            while not self._sync():
+                time.sleep(self.RETRY_DELAY)
+
+    def _run(self):
+        while True:
+            # with unsynced data under the interval policy, wake up in time to fsync it
+            timeout = None
+            if self._dirty and self.fsync_policy == "interval":
+                timeout = max(0.0, self._last_fsync + self.fsync_interval - time.monotonic())
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                if not self._sync():
+                    self._last_fsync = time.monotonic()  # back off before the next attempt
+                continue
+            batch = []
+            stop = item is None
+            if item is not None:
+                batch.append(item)
+                deadline = time.monotonic() + self.flush_interval
+                while len(batch) < self.batch_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    try:
+                        item = self.queue.get(timeout=remaining)
+                    except queue.Empty:
+                        break
+                    if item is None:
+                        stop = True
+                        break
+                    batch.append(item)
+            if batch:
+                self._write(batch)
+            if stop:
+                # drain whatever was queued before close() and sync it
+                while True:
+                    try:
+                        item = self.queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if item is not None:
+                        self._write([item])
+                self._sync()
+                for fd in self._fds.values():
+                    os.close(fd)
+                self._fds.clear()
+                return
+            if self._dirty and self.fsync_policy == "interval" and \
+                    time.monotonic() - self._last_fsync >= self.fsync_interval:
+                if not self._sync():
+                    self._last_fsync = time.monotonic()
+
+
+history_store = HistoryStore(HISTORY_DIR, SERVER_NAME)
+history_writer = HistoryWriter(store=history_store)
+atexit.register(history_writer.close)
+# taken around clock increment + enqueue, so the store receives increasing clocks
+history_lock = threading.Lock()
+# a restarted server must not reuse clocks already in its history
+logical_clock = max(logical_clock, history_store.last_clock)
+
+
+def history_ack(seq, wait=False):
+    """Reply fields for a queued history record: its sequence number and the writer's
+    durable sequence; with `wait`, block until the record is durable (or the timeout)."""
+    if seq is None:
+        return {}
+    ack = {"history_seq": seq}
+    if wait:
+        ack["durable"] = history_writer.wait_durable(seq, HISTORY_DURABLE_TIMEOUT)
+    ack["durable_seq"] = history_writer.durable_seq
+    return ack
+
+
+def handle_sigterm(signum, frame):
+    # docker stop sends SIGTERM, which skips atexit: drain queued history first
+    history_writer.close()
+    sys.exit(0)
+
+
+signal.signal(signal.SIGTERM, handle_sigterm)
+publisher = Publisher(context, PUBSUB_ADDR)
+user_registry = UserRegistry(LOGINS_FILE)
+channel_catalog = ChannelCatalog(CHANNELS_FILE)
+
+def decode_request(raw):
+    # unpack with MessagePack, fallback to json decode for compatibility
+    try:
+        return msgpack.unpackb(raw, raw=False, strict_map_key=False)
+    except Exception:
+        return json.loads(raw.decode('utf-8'))
+
+
+class PeerClient:
+    """Persistent REQ connection to one endpoint (reference or a server admin port).
+
+    Each call carries a correlation id (data.req_id) and waits at most `timeout`
+    seconds for the reply. On timeout the socket is closed and reopened (lazy
+    pirate), since a REQ socket cannot send again before it receives, and the
+    request is retried with exponential backoff. Calls on one client are
+    serialized with a lock; latency is kept for the last LATENCY_SAMPLES calls.
+    """
+
+    LATENCY_SAMPLES = 1000
+
+    def __init__(self, ctx, address, timeout=REQUEST_TIMEOUT, retries=REQUEST_RETRIES, backoff=REQUEST_BACKOFF):
+        self.ctx = ctx
+        self.address = address
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.lock = threading.Lock()
+        self.socket = None
+        self._next_id = 0
+        self.calls = 0
+        self.ok = 0
+        self.timeouts = 0
+        self.failures = 0
+        self.resets = 0
+        self.latencies = collections.deque(maxlen=self.LATENCY_SAMPLES)
+
+    def _connect(self):
+        s = self.ctx.socket(zmq.REQ)
+        s.setsockopt(zmq.LINGER, 0)
+        s.connect(f"tcp://{self.address}")
+        self.socket = s
+
+    def _reset(self):
+        if self.socket is not None:
+            self.socket.close(0)
+            self.socket = None
+            self.resets += 1
+
+    def call(self, msg, timeout=None, retries=None):
+        """Send msg and return the unpacked reply, or None after every attempt timed out."""
+        timeout = self.timeout if timeout is None else timeout
+        retries = self.retries if retries is None else retries
+        with self.lock:
+            self.calls += 1
+            self._next_id += 1
+            req_id = f"{SERVER_NAME}-{self._next_id}"
+            data = dict(msg.get("data") or {})
+            data["req_id"] = req_id
+            payload = msgpack.packb({"service": msg.get("service"), "data": data}, use_bin_type=True)
+            for attempt in range(retries + 1):
+                if attempt:
+                    time.sleep(self.backoff * (2 ** (attempt - 1)))
+                try:
+                    if self.socket is None:
+                        self._connect()
+                    start = time.perf_counter()
+                    self.socket.send(payload)
+                    if not self.socket.poll(int(timeout * 1000), zmq.POLLIN):
+                        self.timeouts += 1
+                        self._reset()
+                        continue
+                    reply = decode_request(self.socket.recv())
+                except Exception:
+                    self._reset()
+                    continue
+                rdata = reply.get("data") if isinstance(reply, dict) else None
+                if isinstance(rdata, dict) and rdata.get("req_id") not in (None, req_id):
+                    # reply to an earlier request: the connection is out of step
+                    self._reset()
+                    continue
+                self.latencies.append(time.perf_counter() - start)
+                self.ok += 1
+                return reply
+            self.failures += 1
+            return None
+
+    def stats(self):
+        with self.lock:
+            lat = sorted(self.latencies)
+        def pct(q):
+            return round(lat[min(len(lat) - 1, int(q * len(lat)))] * 1000, 3) if lat else None
+        return {
+            "address": self.address,
+            "calls": self.calls,
+            "ok": self.ok,
+            "timeouts": self.timeouts,
+            "failures": self.failures,
+            "resets": self.resets,
+            "avg_ms": round(sum(lat) / len(lat) * 1000, 3) if lat else None,
+            "p50_ms": pct(0.50),
+            "p99_ms": pct(0.99),
+            "max_ms": round(lat[-1] * 1000, 3) if lat else None,
+        }
+
+
+class PeerPool:
+    """One PeerClient per address, created on first use and reused afterwards."""
+
+    def __init__(self, ctx):
+        self.ctx = ctx
+        self.lock = threading.Lock()
+        self.clients = {}
+
+    def get(self, address):
+        with self.lock:
+            client = self.clients.get(address)
+            if client is None:
+                client = PeerClient(self.ctx, address)
+                self.clients[address] = client
+            return client
+
+    def stats(self):
+        with self.lock:
+            clients = list(self.clients.values())
+        return [c.stats() for c in clients]
+
+
+peer_pool = PeerPool(context)
+
+
+def send_req_to_reference(req_msg, timeout=None, retries=None):
     """Send a REQ to the reference service and return the unpacked reply map."""
     try:
-        ctx = zmq.Context()
-        s = ctx.socket(zmq.REQ)
-        s.connect(f"tcp://{REFERENCE_ADDR}")
         now_ts = datetime.now(br_tz).strftime("%H:%M:%S")
         c = increment_clock_before_send()
         data = req_msg.get("data", {})
         data["clock"] = c
         data["timestamp"] = now_ts
+        # identify ourselves on every call, so any request renews our lease
+        data.setdefault("user", SERVER_NAME)
         msg = {"service": req_msg.get("service"), "data": data}
-        s.send(msgpack.packb(msg, use_bin_type=True), 0)
-        raw = s.recv()
-        try:
-            reply = msgpack.unpackb(raw, raw=False, strict_map_key=False)
-        except Exception:
-            import json as _json
-            reply = _json.loads(raw.decode('utf-8'))
+        reply = peer_pool.get(REFERENCE_ADDR).call(msg, timeout=timeout, retries=retries)
+        if reply is None:
+            return {"service": "error", "data": {"status": "erro", "message": "reference não respondeu"}}
         try:
             rdata = reply.get("data", {})
             rc = rdata.get("clock")
             update_clock_on_receive(rc)
-        except Exception:
-            pass
-        try:
-            s.close()
-            ctx.term()
+            if rdata.get("lease"):
+                lease_renewed(float(rdata["lease"]))
         except Exception:
             pass
         return reply
     except Exception as e:
         return {"service": "error", "data": {"status": "erro", "message": str(e)}}
 
-def heartbeat_loop(interval=5):
-    while True:
+lease = {"duration": LEASE_DEFAULT, "renewed_at": None, "heartbeats": 0}
+
+
+def lease_renewed(duration):
+    lease["duration"] = duration
+    lease["renewed_at"] = time.monotonic()
+
+
+def renewal_delay():
+    """Seconds until the lease is due for renewal (a third of it after the last one)."""
+    if lease["renewed_at"] is None:
+        return 0.0
+    return lease["renewed_at"] + lease["duration"] / 3 - time.monotonic()
+
+
+def send_heartbeat():
+    data = {"user": SERVER_NAME}
+    if SERVER_ADDR:
+        data["address"] = SERVER_ADDR
+    req = {"service": "heartbeat", "data": data}
+    lease["heartbeats"] += 1
+    return send_req_to_reference(req)
+
+
+def next_heartbeat():
+    """Send a heartbeat only if no other reference call renewed the lease; returns seconds to wait."""
+    if renewal_delay() <= 0:
         try:
-            data = {"user": SERVER_NAME}
-            if SERVER_ADDR:
-                data["address"] = SERVER_ADDR
-            req = {"service": "heartbeat", "data": data}
-            send_req_to_reference(req)
+            send_heartbeat()
         except Exception:
             pass
-        time.sleep(interval)
+    # after a failed renewal, try again soon
+    return max(renewal_delay(), 1.0)
 
-try:
-    rank_reply = send_req_to_reference({"service": "rank", "data": {"user": SERVER_NAME}})
-    server_rank = rank_reply.get("data", {}).get("rank")
-except Exception:
-    server_rank = None
 
-# start heartbeat thread
-def send_req_to_server(address, msg, timeout=3):
+def heartbeat_loop():
+    # the first heartbeat carries the admin address, which 'rank' did not
+    try:
+        send_heartbeat()
+    except Exception:
+        pass
+    while True:
+        time.sleep(next_heartbeat())
+
+# On startup, ask reference for rank and register; wait for the reference as
+# long as it takes, each attempt being bounded by the client timeout
+server_rank = None
+while server_rank is None:
+    try:
+        rank_reply = send_req_to_reference({"service": "rank", "data": {"user": SERVER_NAME}})
+        server_rank = rank_reply.get("data", {}).get("rank")
+    except Exception:
+        server_rank = None
+    if server_rank is None:
+        print("[servidor] aguardando reference em", REFERENCE_ADDR)
+        time.sleep(1)
+
+def send_req_to_server(address, msg, timeout=3, retries=0):
     """Send a REQ to another server admin endpoint and return unpacked reply or None on error."""
     try:
-        ctx = zmq.Context()
-        s = ctx.socket(zmq.REQ)
-        s.setsockopt(zmq.RCVTIMEO, int(timeout * 1000))
-        s.setsockopt(zmq.SNDTIMEO, int(timeout * 1000))
-        s.connect(f"tcp://{address}")
-        s.send(msgpack.packb(msg, use_bin_type=True))
-        raw = s.recv()
-        try:
-            reply = msgpack.unpackb(raw, raw=False, strict_map_key=False)
-        except Exception:
-            reply = json.loads(raw.decode('utf-8'))
-        try:
-            s.close()
-            ctx.term()
-        except Exception:
-            pass
-        return reply
+        return peer_pool.get(address).call(msg, timeout=timeout, retries=retries)
     except Exception:
         return None
 
 
 def publish_announcement(topic, payload):
     try:
-        pub_ctx = zmq.Context()
-        pub = pub_ctx.socket(zmq.PUB)
-        pub.connect("tcp://proxy_pubsub:5557")
-        # publish as: "topic <json>"
-        pub.send_string(f"{topic} {json.dumps(payload)}")
-        pub.close()
-        pub_ctx.term()
+        # text framing: "topic <json>"
+        publisher.publish(topic, SERVER_NAME, payload, logical_clock, datetime.now(br_tz).strftime("%H:%M:%S"),
+                          json.dumps(payload))
     except Exception:
         pass
 
 
+class MembershipView:
+    """Local copy of the reference's server list, kept current by the 'membership' topic.
+
+    Events carry a version that increases by one per change and the epoch of the
+    reference run. Events are applied in order; a gap, an epoch change or a tick
+    announcing a different version triggers a 'list' with since_version, which
+    the reference answers with a delta (or not_modified) when it can, and with
+    the full list otherwise. Reads never touch the network once the view is loaded.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.members = {}
+        self.version = None
+        self.epoch = None
+        self.full_loads = 0
+        self.delta_loads = 0
+        self.not_modified = 0
+        self.events = 0
+
+    def reload(self):
+        with self.lock:
+            since, epoch = self.version, self.epoch
+        req = {} if since is None else {"since_version": since, "epoch": epoch}
+        reply = send_req_to_reference({"service": "list", "data": req})
+        data = reply.get("data", {}) if isinstance(reply, dict) else {}
+        if reply.get("service") != "list":
+            return False
+        with self.lock:
+            version = data.get("version")
+            if data.get("not_modified"):
+                self.not_modified += 1
+            elif data.get("delta"):
+                # a delta holds final states, so it also applies on top of events
+                # received meanwhile, unless the view already moved past it
+                if self.epoch == data.get("epoch") and (self.version or 0) <= version:
+                    for name in data.get("removed", []):
+                        self.members.pop(name, None)
+                    for server in data.get("added", []) + data.get("changed", []):
+                        self.members[server.get("name")] = server
+                    self.version = version
+                self.delta_loads += 1
+            else:
+                self.members = {s.get("name"): s for s in data.get("list", [])}
+                self.version = version
+                self.epoch = data.get("epoch")
+                self.full_loads += 1
+        return True
+
+    def apply_event(self, ev):
+        """Apply one membership event; returns False if the view had to be reloaded."""
+        kind = ev.get("event")
+        version = ev.get("version")
+        with self.lock:
+            current = self.version is not None and ev.get("epoch") == self.epoch
+            if current and kind == "tick":
+                in_sync = version == self.version
+            elif current and version is not None and version <= self.version:
+                return True  # already covered by a reload
+            elif current and version == self.version + 1:
+                server = ev.get("server") or {}
+                if kind == "leave":
+                    self.members.pop(server.get("name"), None)
+                else:
+                    self.members[server.get("name")] = server
+                self.version = version
+                self.events += 1
+                return True
+            else:
+                in_sync = False
+        if not in_sync:
+            self.reload()
+        return in_sync
+
+    def servers(self):
+        with self.lock:
+            loaded = self.version is not None or self.members
+        if not loaded:
+            self.reload()
+        with self.lock:
+            return sorted(self.members.values(), key=lambda s: s.get("rank") or 0)
+
+    def stats(self):
+        with self.lock:
+            return {"version": self.version, "epoch": self.epoch, "members": len(self.members),
+                    "events": self.events, "full_loads": self.full_loads, "delta_loads": self.delta_loads,
+                    "not_modified": self.not_modified}
+
+
+membership = MembershipView()
+sync_executor = concurrent.futures.ThreadPoolExecutor(max_workers=BERKELEY_MAX_PARALLEL)
+last_berkeley_round = None
+
+
 def maybe_trigger_sync():
     global coordinator_name
     try:
         if coordinator_name == SERVER_NAME:
             perform_berkeley_sync()
         else:
-            # check coordinator presence via reference list
+            # check coordinator presence in the local membership view
             try:
-                lst = send_req_to_reference({"service": "list", "data": {}})
-                servers = lst.get("data", {}).get("list", [])
+                servers = membership.servers()
                 coords = [s for s in servers if s.get("name") == coordinator_name]
                 if not coordinator_name or not coords:
                     perform_election()
@@ -151,45 +1166,192 @@ def maybe_trigger_sync():
         pass
 
 
+def _clock_call(addr, data, deadline):
+    """One admin 'clock' call bounded by the phase deadline; returns (reply, offset) or (None, None).
+
+    offset is the peer's app time minus ours, taken as soon as the reply arrives
+    (the reading is rtt/2 old by then, Cristian), so a slow or dead peer in the
+    same phase does not skew it.
+    """
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        return None, None
+    start = time.perf_counter()
+    reply = send_req_to_server(addr, {"service": "clock", "data": data}, timeout=remaining)
+    rtt = time.perf_counter() - start
+    t = (reply or {}).get('data', {}).get('time')
+    offset = float(t) + rtt / 2 - current_app_time() if isinstance(t, (int, float)) else None
+    return reply, offset
+
+
+def _scatter(calls, deadline):
+    """Run (key, fn, args) calls in parallel; return {key: result} for those done by the deadline."""
+    futures = {sync_executor.submit(fn, *args): key for key, fn, args in calls}
+    done, _ = concurrent.futures.wait(futures, timeout=max(0.0, deadline - time.monotonic()))
+    results = {}
+    for f in done:
+        try:
+            results[futures[f]] = f.result()
+        except Exception:
+            pass
+    return results
+
+
 def perform_berkeley_sync():
-    """Coordinator polls servers for their app_time, computes average and instructs adjustments."""
-    global app_time, logical_clock
+    """Coordinator polls servers for their app time, computes the average offset and
+    sends each server its own correction.
+
+    Polls and adjustments are sent to every server in parallel, each phase under
+    its own deadline (BERKELEY_DEADLINE). Each reading is corrected by half its
+    round-trip time (Cristian), turned into an offset from the coordinator's clock
+    when it arrives, and offsets
+    further than BERKELEY_OUTLIER seconds from the median are left out of the
+    average. Every server that answered then receives delta = average - offset.
+    """
+    global last_berkeley_round
+    started = time.monotonic()
     try:
-        lst_reply = send_req_to_reference({"service": "list", "data": {}})
-        servers_list = lst_reply.get("data", {}).get("list", [])
-        times = []
-        addresses = []
-        times.append(app_time)
-        for s in servers_list:
+        deadline = started + BERKELEY_DEADLINE
+        peers = []
+        for s in membership.servers():
             name = s.get('name')
-            rank = s.get('rank')
-            addr = s.get('address') or f"{name}:{5600 + rank}"
             if name == SERVER_NAME:
                 continue
-            addresses.append((name, addr))
-            req = {"service": "clock", "data": {"timestamp": datetime.now(br_tz).strftime('%H:%M:%S'), "clock": logical_clock}}
-            reply = send_req_to_server(addr, req, timeout=3)
-            if reply and isinstance(reply.get('data',{}).get('time'), (int, float)):
-                times.append(float(reply['data']['time']))
-        if not times:
-            return
-        avg = sum(times) / len(times)
-        
-        for s in servers_list:
-            name = s.get('name')
-            rank = s.get('rank')
-            addr = s.get('address') or f"{name}:{5600 + rank}"
-            req2 = {"service": "clock", "data": {"time": avg, "timestamp": datetime.now(br_tz).strftime('%H:%M:%S'), "clock": increment_clock_before_send()}}
-            # send instruction; ignore replies
+            addr = s.get('address') or f"{name}:{5600 + int(s.get('rank'))}"
+            peers.append((name, addr))
+
+        poll = {"timestamp": datetime.now(br_tz).strftime('%H:%M:%S'), "clock": logical_clock}
+        replies = _scatter([(name, _clock_call, (addr, dict(poll), deadline)) for name, addr in peers], deadline)
+        offsets = {SERVER_NAME: 0.0}
+        for name, (reply, offset) in replies.items():
+            if offset is not None:
+                offsets[name] = offset
+
+        ordered = sorted(offsets.values())
+        median = ordered[len(ordered) // 2]
+        accepted = [o for o in ordered if abs(o - median) <= BERKELEY_OUTLIER]
+        avg = sum(accepted) / len(accepted)
+
+        addresses = dict(peers)
+        # the poll deadline has passed if any peer timed out: adjustments get their own
+        deadline = time.monotonic() + BERKELEY_DEADLINE
+        adjust = []
+        for name, offset in offsets.items():
             if name == SERVER_NAME:
-                app_time = avg
-            else:
-                try:
-                    send_req_to_server(addr, req2, timeout=3)
-                except Exception:
-                    pass
-    except Exception:
-        pass
+                continue
+            data = {"adjust": avg - offset, "timestamp": datetime.now(br_tz).strftime('%H:%M:%S'),
+                    "clock": increment_clock_before_send()}
+            adjust.append((name, _clock_call, (addresses[name], data, deadline)))
+        adjust_app_time(avg)
+        acked = _scatter(adjust, deadline)
+        last_berkeley_round = {
+            "servers": len(peers) + 1,
+            "replied": len(offsets) - 1,
+            "excluded": len(offsets) - len(accepted),
+            "adjusted": sum(1 for reply, _ in acked.values() if reply),
+            "avg_offset": avg,
+            "duration": time.monotonic() - started,
+        }
+        metrics.observe("berkeley_round_seconds", last_berkeley_round["duration"])
+    except Exception as e:
+        print("[berkeley] erro na sincronização:", e)
+
+
+class SyncScheduler:
+    """Single thread that runs sync rounds (maybe_trigger_sync).
+
+    Rounds are triggered by time (interval), by reply count (every) and on
+    demand (trigger, the admin 'sync' service with data.run). A trigger that
+    arrives while a round is pending or running is coalesced into it, so at most
+    one round runs at a time no matter how fast replies go out.
+    """
+
+    def __init__(self, interval=SYNC_INTERVAL, every=SYNC_EVERY, min_gap=SYNC_MIN_GAP):
+        self.interval = interval
+        self.every = every
+        self.min_gap = min_gap
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.pending = 0
+        self.running = False
+        self.rounds = 0
+        self.coalesced = 0
+        # monotonic start for the min-gap arithmetic, wall-clock start for the admin report
+        self._last_started = None
+        self.last_started = None
+        self.last_duration = None
+        self.last_reason = None
+        # reason of the pending wakeup, None when the interval elapsed
+        self._reason = None
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def notify_message(self):
+        if self.every <= 0:
+            return
+        with self.lock:
+            self.pending += 1
+            if self.pending < self.every:
+                return
+            self.pending = 0
+            self._wake("messages")
+
+    def trigger(self):
+        """Request a round now (still at least min_gap after the previous one)."""
+        with self.lock:
+            self._wake("admin")
+
+    def _wake(self, reason):
+        # called with self.lock held
+        if self.wakeup.is_set() or self.running:
+            self.coalesced += 1
+        if not self.wakeup.is_set():
+            self._reason = reason
+        self.wakeup.set()
+
+    def _run(self):
+        while True:
+            triggered = self.wakeup.wait(self.interval if self.interval > 0 else None)
+            # space rounds out; triggers arriving meanwhile fold into this one
+            if self._last_started is not None:
+                gap = self.min_gap - (time.monotonic() - self._last_started)
+                if gap > 0:
+                    time.sleep(gap)
+            with self.lock:
+                self.wakeup.clear()
+                self.running = True
+                self._last_started = time.monotonic()
+                self.last_started = time.time()
+                self.last_reason = self._reason if triggered else "interval"
+                self._reason = None
+            start = time.monotonic()
+            try:
+                maybe_trigger_sync()
+            finally:
+                with self.lock:
+                    self.running = False
+                    self.rounds += 1
+                    self.last_duration = time.monotonic() - start
+                metrics.observe("sync_round_seconds", self.last_duration, reason=self.last_reason)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "rounds": self.rounds,
+                "coalesced": self.coalesced,
+                "running": self.running,
+                "last_started": self.last_started,
+                "last_duration": self.last_duration,
+                "last_reason": self.last_reason,
+                "interval": self.interval,
+                "every": self.every,
+            }
+
+
+sync_scheduler = SyncScheduler()
 
 
 def perform_election():
@@ -199,8 +1361,7 @@ def perform_election():
     """
     global coordinator_name
     try:
-        lst_reply = send_req_to_reference({"service": "list", "data": {}})
-        servers_list = lst_reply.get("data", {}).get("list", [])
+        servers_list = membership.servers()
         if not servers_list:
             return
         # choose server with highest numeric rank (convert ranks to int)
@@ -216,6 +1377,9 @@ def perform_election():
                 winner = s
         if winner:
             winner_name = winner.get('name')
+            metrics.incr("elections")
+            if winner_name != coordinator_name:
+                metrics.incr("coordinator_changes")
             coordinator_name = winner_name
             announce = {"service": "election", "data": {"coordinator": winner_name, "timestamp": datetime.now(br_tz).strftime('%H:%M:%S'), "clock": increment_clock_before_send()}}
             # publish announcement so all subscribers update their local coordinator_name
@@ -224,84 +1388,185 @@ def perform_election():
         pass
 
 
+def clock_gauges():
+    """Logical clock and how far the Berkeley-adjusted app time is from this host's wall clock."""
+    with clock_lock:
+        offset = app_time_offset
+        return {"logical_clock": logical_clock, "app_time_seconds": time.time() + offset,
+                "app_time_offset_seconds": offset}
+
+
+def metrics_report():
+    """Data of the admin 'metrics' service: metrics snapshot plus gauges read at call time."""
+    report = metrics.snapshot()
+    report.update(server=SERVER_NAME, mode=SERVER_MODE, uptime_s=round(time.time() - metrics.started, 1),
+                  replies=message_count, clocks=clock_gauges(), coordinator=coordinator_name,
+                  pubsub={"sent": publisher.sent, "failed": publisher.failed},
+                  history_queue=history_writer.queue_depth())
+    return report
+
+
+def metrics_text():
+    gauges = dict(clock_gauges(), uptime_seconds=round(time.time() - metrics.started, 1),
+                  history_queue_depth=history_writer.queue_depth())
+    return metrics.exposition(gauges, {"pubsub_sent": publisher.sent, "pubsub_send_failures": publisher.failed})
+
+
+class MetricsHTTPHandler(http.server.BaseHTTPRequestHandler):
+    """GET /metrics for scrapers (METRICS_HTTP_PORT)."""
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = metrics_text().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, fmt, *args):
+        pass
+
+
+def metrics_http_loop(port):
+    try:
+        http.server.ThreadingHTTPServer(("0.0.0.0", port), MetricsHTTPHandler).serve_forever()
+    except Exception as e:
+        print("[metrics] erro no endpoint HTTP:", e)
+
+
+def handle_admin_request(raw):
+    """Decode one admin request (clock, election, storage, metrics) and return the encoded reply."""
+    global coordinator_name
+    now_ts = datetime.now(br_tz).strftime('%H:%M:%S')
+    data = None
+    try:
+        try:
+            req = msgpack.unpackb(raw, raw=False, strict_map_key=False)
+        except Exception:
+            req = json.loads(raw.decode('utf-8'))
+        svc = req.get('service')
+        data = req.get('data', {})
+        if svc == 'clock':
+            # 'adjust' -> relative correction from the Berkeley coordinator;
+            # 'time' -> absolute value (admin_tool set-clock)
+            if 'adjust' in data:
+                try:
+                    adjust_app_time(data.get('adjust'))
+                except Exception:
+                    pass
+            elif 'time' in data:
+                try:
+                    set_app_time(data.get('time'))
+                except Exception:
+                    pass
+            reply = {'service': 'clock', 'data': {'time': current_app_time(), 'offset': app_time_offset,
+                                                  'timestamp': now_ts, 'clock': logical_clock}}
+        elif svc == 'election':
+            # If the request contains a coordinator announcement, update local coordinator
+            coord_in = data.get('coordinator')
+            if coord_in:
+                if coord_in != coordinator_name:
+                    metrics.incr("coordinator_changes")
+                coordinator_name = coord_in
+                reply = {'service': 'election', 'data': {'coordinator': coordinator_name, 'timestamp': now_ts, 'clock': logical_clock}}
+            else:
+                # acknowledge election request and return current coordinator (if any)
+                reply = {'service': 'election', 'data': {'election': 'OK', 'coordinator': coordinator_name, 'timestamp': now_ts, 'clock': logical_clock}}
+        elif svc == 'membership':
+            lease_info = {'duration': lease['duration'], 'renew_in': round(renewal_delay(), 3),
+                          'heartbeats': lease['heartbeats']}
+            reply = {'service': 'membership', 'data': {'membership': membership.stats(), 'servers': membership.servers(),
+                                                       'lease': lease_info, 'timestamp': now_ts, 'clock': logical_clock}}
+        elif svc == 'sync':
+            # scheduler state plus the outcome of the last Berkeley round run here;
+            # data.run asks for a round now (coalesced with one already pending)
+            if data.get('run'):
+                sync_scheduler.trigger()
+            reply = {'service': 'sync', 'data': {'scheduler': sync_scheduler.stats(), 'berkeley': last_berkeley_round,
+                                                 'coordinator': coordinator_name, 'triggered': bool(data.get('run')),
+                                                 'timestamp': now_ts, 'clock': logical_clock}}
+        elif svc == 'peers':
+            # reference/peer client latency and timeout counters
+            reply = {'service': 'peers', 'data': {'peers': peer_pool.stats(), 'timestamp': now_ts, 'clock': logical_clock}}
+        elif svc == 'storage':
+            # history writer state: queue depth and written/durable sequence numbers
+            reply = {'service': 'storage', 'data': {'history': history_writer.stats(), 'timestamp': now_ts, 'clock': logical_clock}}
+        elif svc == 'metrics':
+            # per-service request counters/histograms, sync/storage timing, pub/sub failures, clocks;
+            # data.format == 'text' returns the text exposition format instead
+            if data.get('format') == 'text':
+                reply = {'service': 'metrics', 'data': {'text': metrics_text(), 'timestamp': now_ts, 'clock': logical_clock}}
+            else:
+                reply = {'service': 'metrics', 'data': dict(metrics_report(), timestamp=now_ts, clock=logical_clock)}
+        else:
+            reply = {'service': 'error', 'data': {'status': 'erro', 'message': 'servico desconhecido', 'timestamp': now_ts, 'clock': logical_clock}}
+    except Exception as e:
+        reply = {'service': 'error', 'data': {'status': 'erro', 'message': str(e), 'timestamp': now_ts}}
+    try:
+        # echo the caller's correlation id
+        if isinstance(data, dict) and data.get('req_id') is not None:
+            reply['data']['req_id'] = data['req_id']
+    except Exception:
+        pass
+    try:
+        return msgpack.packb(reply, use_bin_type=True)
+    except Exception:
+        return json.dumps(reply).encode('utf-8')
+
+
 def admin_server_loop(port):
-    global app_time, logical_clock, coordinator_name
     try:
         admin_ctx = zmq.Context()
         rep = admin_ctx.socket(zmq.REP)
         rep.bind(f"tcp://0.0.0.0:{port}")
         while True:
             raw = rep.recv()
-            try:
-                try:
-                    req = msgpack.unpackb(raw, raw=False, strict_map_key=False)
-                except Exception:
-                    req = json.loads(raw.decode('utf-8'))
-                svc = req.get('service')
-                data = req.get('data', {})
-                now_ts = datetime.now(br_tz).strftime('%H:%M:%S')
-                if svc == 'clock':
-                    # If data contains 'time' -> this is an adjustment instruction
-                    if 'time' in data:
-                        try:
-                            app_time = float(data.get('time'))
-                        except Exception:
-                            pass
-                        reply = {'service': 'clock', 'data': {'time': app_time, 'timestamp': now_ts, 'clock': logical_clock}}
-                    else:
-                        reply = {'service': 'clock', 'data': {'time': app_time, 'timestamp': now_ts, 'clock': logical_clock}}
-                elif svc == 'election':
-                    # If the request contains a coordinator announcement, update local coordinator
-                    coord_in = data.get('coordinator')
-                    if coord_in:
-                        coordinator_name = coord_in
-                        reply = {'service': 'election', 'data': {'coordinator': coordinator_name, 'timestamp': now_ts, 'clock': logical_clock}}
-                    else:
-                        # acknowledge election request and return current coordinator (if any)
-                        reply = {'service': 'election', 'data': {'election': 'OK', 'coordinator': coordinator_name, 'timestamp': now_ts, 'clock': logical_clock}}
-                else:
-                    reply = {'service': 'error', 'data': {'status': 'erro', 'message': 'servico desconhecido', 'timestamp': now_ts, 'clock': logical_clock}}
-            except Exception as e:
-                reply = {'service': 'error', 'data': {'status': 'erro', 'message': str(e), 'timestamp': now_ts}}
-            try:
-                rep.send(msgpack.packb(reply, use_bin_type=True))
-            except Exception:
-                rep.send(json.dumps(reply).encode('utf-8'))
+            rep.send(handle_admin_request(raw))
     except Exception:
         pass
 
 
+def handle_servers_message(frames):
+    """Apply one message of the 'servers' topic (coordinator announcements) or of
+    the 'membership' topic (server list changes)."""
+    global coordinator_name
+    topic, fields = decode_pubsub(frames)
+    payload = fields.get("body")
+    if not isinstance(payload, dict):
+        return
+    if topic == "membership":
+        membership.apply_event(payload)
+        return
+    svc = payload.get('service')
+    data = payload.get('data', {})
+    if svc == 'election':
+        coord = data.get('coordinator')
+        if coord:
+            # update coordinator name
+            if coord != coordinator_name:
+                metrics.incr("coordinator_changes")
+            coordinator_name = coord
+
+
 def sub_servers_loop():
     # subscribe to 'servers' topic to learn about elections/coord announcements
     try:
         sub_ctx = zmq.Context()
         sub = sub_ctx.socket(zmq.SUB)
-        sub.connect("tcp://proxy_pubsub:5558")
+        sub.connect(f"tcp://{PUBSUB_SUB_ADDR}")
         sub.setsockopt_string(zmq.SUBSCRIBE, "servers")
+        sub.setsockopt_string(zmq.SUBSCRIBE, "membership")
         while True:
             try:
-                raw = sub.recv_string()
-                # raw looks like: "servers {json}"
-                parts = raw.split(' ', 1)
-                if len(parts) < 2:
-                    continue
-                payload = json.loads(parts[1])
-                svc = payload.get('service')
-                data = payload.get('data', {})
-                if svc == 'election':
-                    coord = data.get('coordinator')
-                    if coord:
-                        # update coordinator name
-                        global coordinator_name
-                        coordinator_name = coord
+                handle_servers_message(sub.recv_multipart())
             except Exception:
                 time.sleep(0.1)
     except Exception:
         pass
 
-# On startup, ask reference for rank and register
-
-
 def pretty_print(service, data):
     # Simple pretty printer for server logs: prints tables for common services
     try:
@@ -339,6 +1604,10 @@ def pretty_print(service, data):
                 print("+------------------------------+")
             else:
                 print("(nenhum canal cadastrado)")
+        elif service == "batch":
+            replies = data.get("replies", [])
+            print(f"[BATCH] status={data.get('status')} itens={len(replies)} erros={data.get('errors', 0)} "
+                  f"time={data.get('timestamp', '')} {data.get('message', '')}")
         elif service in ("publish", "message"):
             status = data.get("status")
             msg = data.get("message") if service == "publish" else data.get("message")
@@ -358,6 +1627,16 @@ try:
     else:
         admin_port = 5600
     SERVER_ADDR = f"{SERVER_NAME}:{admin_port}"
+except Exception:
+    pass
+
+sync_scheduler.start()
+
+if METRICS_HTTP_PORT:
+    threading.Thread(target=metrics_http_loop, args=(METRICS_HTTP_PORT,), daemon=True).start()
+
+# in asyncio mode the admin endpoint, subscriber and heartbeat run in the event loop
+if SERVER_MODE != "asyncio":
     # start admin server
     admin_thread = threading.Thread(target=admin_server_loop, args=(admin_port,), daemon=True)
     admin_thread.start()
@@ -365,415 +1644,565 @@ try:
     sub_thread = threading.Thread(target=sub_servers_loop, daemon=True)
     sub_thread.start()
     # start heartbeat thread (now we can include address)
-    hb_thread = threading.Thread(target=heartbeat_loop, args=(5,), daemon=True)
+    hb_thread = threading.Thread(target=heartbeat_loop, daemon=True)
     hb_thread.start()
-except Exception:
-    pass
 
-while True:
-    try:
-        # receive raw bytes and unpack with MessagePack
-        raw = socket.recv()
-        try:
-            request = msgpack.unpackb(raw, raw=False, strict_map_key=False)
-        except Exception:
-            # fallback to json decode for compatibility
-            import json as _json
-            request = _json.loads(raw.decode('utf-8'))
-        # Update logical clock from incoming message if it has one
+def handle_message(dados):
+    src = dados.get("src")
+    dst = dados.get("dst")
+    message = dados.get("message")
+    status = "OK"
+    error_msg = ""
+    seq = None
+    time_br = datetime.now(br_tz).strftime("%H:%M:%S")
+    # Verifica se usuário de destino existe
+    if not dst or not user_registry.exists(dst):
+        status = "erro"
+        error_msg = "Usuário de destino não existe."
+    else:
+        # Publica mensagem no tópico do usuário de destino via Pub/Sub
         try:
-            incoming_clock = None
-            if isinstance(request, dict):
-                incoming_clock = request.get("data", {}).get("clock")
-            update_clock_on_receive(incoming_clock)
-        except Exception:
-            pass
-        service = request.get("service")
-
-        if service == "message":
-            dados = request["data"]
-            src = dados.get("src")
-            dst = dados.get("dst")
-            message = dados.get("message")
-            timestamp = dados.get("timestamp")
-            status = "OK"
-            error_msg = ""
-            time_br = datetime.now(br_tz).strftime("%H:%M:%S")
-            # Verifica se usuário de destino existe
-            usuarios_existentes = set()
-            try:
-                with open("/app/storage-server/logins.txt", "r", encoding="utf-8") as f:
-                    for line in f:
-                        u = line.strip().split(",")[0]
-                        if u:
-                            usuarios_existentes.add(u)
-            except FileNotFoundError:
-                pass
-            if not dst or dst not in usuarios_existentes:
-                status = "erro"
-                error_msg = "Usuário de destino não existe."
-            else:
-                # Publica mensagem no tópico do usuário de destino via Pub/Sub
-                try:
-                    pub_context = zmq.Context()
-                    pub_socket = pub_context.socket(zmq.PUB)
-                    pub_socket.connect("tcp://proxy_pubsub:5557")
-                    # increment clock before sending this outgoing pub/sub message
-                    c_pub = increment_clock_before_send()
-                    pub_socket.send_string(f"{dst} {src}: {message} [{time_br}] (clock={c_pub})")
-                    pub_socket.close()
-                    pub_context.term()
-                    # Salva histórico
-                    with open("/app/storage-server/historico_msg.txt", "a", encoding="utf-8") as f:
-                        f.write(f"{src},{dst},{message},{time_br},{c_pub}\n")
-                    # Log explícito de envio de mensagem para o terminal do servidor
-                    try:
-                        print(f"[SEND] {src} -> {dst}: {message} [{time_br}]")
-                    except Exception:
-                        pass
-                except Exception as e:
-                    status = "erro"
-                    error_msg = f"Erro ao enviar mensagem: {str(e)}"
-            # prepare reply and include logical clock
-            c = increment_clock_before_send()
-            reply = {
-                "service": "message",
-                "data": {
-                    "status": status,
-                    "message": error_msg,
-                    "timestamp": time_br,
-                    "clock": c
-                }
-            }
-            # pretty print and send packed with MessagePack
-            pretty_print(reply.get("service"), reply.get("data", {}))
+            with history_lock:
+                # increment clock before sending this outgoing pub/sub message
+                c_pub = increment_clock_before_send()
+                publisher.publish(dst, src, message, c_pub, time_br, f"{src}: {message} [{time_br}] (clock={c_pub})",
+                                  trace=dados.get("trace"))
+                # Salva histórico (gravado em lote pelo history_writer)
+                seq = history_writer.append(HISTORY_MSG_FILE, f"{src},{dst},{message},{time_br},{c_pub}\n",
+                                            {"type": "message", "src": src, "dst": dst, "message": message,
+                                             "timestamp": time_br, "clock": c_pub})
+            # Log explícito de envio de mensagem para o terminal do servidor
             try:
-                socket.send(msgpack.packb(reply, use_bin_type=True))
-                message_count += 1
-                if message_count % 10 == 0:
-                    threading.Thread(target=maybe_trigger_sync, daemon=True).start()
+                print(f"[SEND] {src} -> {dst}: {message} [{time_br}]")
             except Exception:
-                import json as _json
-                socket.send(_json.dumps(reply).encode('utf-8'))
-                message_count += 1
-                if message_count % 10 == 0:
-                    threading.Thread(target=maybe_trigger_sync, daemon=True).start()
-            continue
+                pass
+        except Exception as e:
+            status = "erro"
+            error_msg = f"Erro ao enviar mensagem: {str(e)}"
+    ack = history_ack(seq, dados.get("durable"))
+    # prepare reply and include logical clock
+    c = increment_clock_before_send()
+    return {
+        "service": "message",
+        "data": {
+            "status": status,
+            "message": error_msg,
+            "timestamp": time_br,
+            "clock": c,
+            **ack
+        }
+    }
 
-        elif service == "login":
-            dados = request["data"]
-            user = dados.get("user")
-            timestamp = dados.get("timestamp")
-            time_br = datetime.now(br_tz).strftime("%H:%M:%S")
-
-            if not timestamp:
-                timestamp = time_br
-
-            if not user or not timestamp:
-                reply = {
-                    "service": "login",
-                    "data": {
-                        "status": "erro",
-                        "timestamp": time_br,
-                        "description": "Dados de login inválidos: 'user' ou 'timestamp' ausente."
-                    }
-                }
-                pretty_print(reply.get("service"), reply.get("data", {}))
-                try:
-                    socket.send(msgpack.packb(reply, use_bin_type=True))
-                    message_count += 1
-                    if message_count % 10 == 0:
-                        threading.Thread(target=maybe_trigger_sync, daemon=True).start()
-                except Exception:
-                    import json as _json
-                    socket.send(_json.dumps(reply).encode('utf-8'))
-                    message_count += 1
-                    if message_count % 10 == 0:
-                        threading.Thread(target=maybe_trigger_sync, daemon=True).start()
-                continue
 
-            # Verifica se usuário já está cadastrado
-            user_exists = False
-            try:
-                with open("/app/storage-server/logins.txt", "r", encoding="utf-8") as f:
-                    for line in f:
-                        existing = line.strip().split(",")[0]
-                        if existing == user:
-                            user_exists = True
-                            break
-            except FileNotFoundError:
-                user_exists = False
-
-            if user_exists:
-                c = increment_clock_before_send()
-                reply = {
-                    "service": "login",
-                    "data": {
-                        "status": "logado",
-                        "timestamp": time_br,
-                        "description": f"Usuário '{user}' já está cadastrado e logado.",
-                        "clock": c,
-                        "user": user
-                    }
-                }
-                try:
-                    socket.send(msgpack.packb(reply, use_bin_type=True))
-                except Exception:
-                    import json as _json
-                    socket.send(_json.dumps(reply).encode('utf-8'))
-                continue
+def handle_login(dados):
+    user = dados.get("user")
+    timestamp = dados.get("timestamp")
+    time_br = datetime.now(br_tz).strftime("%H:%M:%S")
 
-            # usuário não existe -> registra e responde sucesso
-            try:
-                # ensure storage dir exists inside container
-                os.makedirs("/app/storage-server", exist_ok=True)
-                with open("/app/storage-server/logins.txt", "a", encoding="utf-8") as f:
-                    f.write(f"{user},{timestamp}\n")
-                c = increment_clock_before_send()
-                reply = {
-                    "service": "login",
-                    "data": {
-                        "status": "sucesso",
-                        "timestamp": time_br,
-                        "description": "Login registrado com sucesso.",
-                        "clock": c,
-                        "user": user
-                    }
-                }
-            except Exception as e:
-                reply = {
-                    "service": "login",
-                    "data": {
-                        "status": "erro",
-                        "timestamp": time_br,
-                        "description": f"Erro ao gravar arquivo: {str(e)}"
-                    }
-                }
-            pretty_print(reply.get("service"), reply.get("data", {}))
-            try:
-                socket.send(msgpack.packb(reply, use_bin_type=True))
-                message_count += 1
-                if message_count % 10 == 0:
-                    threading.Thread(target=maybe_trigger_sync, daemon=True).start()
-            except Exception:
-                import json as _json
-                socket.send(_json.dumps(reply).encode('utf-8'))
-                message_count += 1
-                if message_count % 10 == 0:
-                    threading.Thread(target=maybe_trigger_sync, daemon=True).start()
-            continue
+    if not timestamp:
+        timestamp = time_br
 
-        elif service == "users":
-            dados = request["data"]
-            users = []
-            try:
-                with open("/app/storage-server/logins.txt", "r", encoding="utf-8") as f:
-                    for line in f:
-                        user = line.strip().split(",")[0]
-                        if user:
-                            users.append(user)
-            except FileNotFoundError:
-                users = []
-            time_br = datetime.now(br_tz).strftime("%H:%M:%S")
-            c = increment_clock_before_send()
-            reply = {
-                "service": "users",
-                "data": {
-                    "timestamp": time_br,
-                    "users": users,
-                    "clock": c
-                }
+    if not user or not timestamp:
+        return {
+            "service": "login",
+            "data": {
+                "status": "erro",
+                "timestamp": time_br,
+                "description": "Dados de login inválidos: 'user' ou 'timestamp' ausente."
             }
-            pretty_print(reply.get("service"), reply.get("data", {}))
-            try:
-                socket.send(msgpack.packb(reply, use_bin_type=True))
-                message_count += 1
-                if message_count % 10 == 0:
-                    threading.Thread(target=maybe_trigger_sync, daemon=True).start()
-            except Exception:
-                import json as _json
-                socket.send(_json.dumps(reply).encode('utf-8'))
-                message_count += 1
-                if message_count % 10 == 0:
-                    threading.Thread(target=maybe_trigger_sync, daemon=True).start()
-            continue
+        }
 
-        elif service == "channel":
-            dados = request["data"]
-            channel = dados.get("channel")
-            timestamp = dados.get("timestamp")
-            status = "sucesso"
-            description = ""
-            time_br = datetime.now(br_tz).strftime("%H:%M:%S")
-            if not channel or not timestamp:
-                status = "erro"
-                description = "Dados de canal inválidos: 'channel' ou 'timestamp' ausente."
-            else:
-                try:
-                    # ensure storage dir exists
-                    os.makedirs("/app/storage-server", exist_ok=True)
-                    with open("/app/storage-server/channels.txt", "a", encoding="utf-8") as f:
-                        f.write(f"{channel},{timestamp}\n")
-                except Exception as e:
-                    status = "erro"
-                    description = f"Erro ao gravar canal: {str(e)}"
-            c = increment_clock_before_send()
-            reply = {
-                "service": "channel",
-                "data": {
-                    "status": status,
-                    "timestamp": time_br,
-                    "description": description,
-                    "clock": c
-                }
+    # Verifica se usuário já está cadastrado e, se não estiver, registra
+    try:
+        registered = user_registry.add(user, timestamp)
+    except Exception as e:
+        return {
+            "service": "login",
+            "data": {
+                "status": "erro",
+                "timestamp": time_br,
+                "description": f"Erro ao gravar arquivo: {str(e)}"
             }
-            pretty_print(reply.get("service"), reply.get("data", {}))
-            try:
-                socket.send(msgpack.packb(reply, use_bin_type=True))
-                message_count += 1
-                if message_count % 10 == 0:
-                    threading.Thread(target=maybe_trigger_sync, daemon=True).start()
-            except Exception:
-                import json as _json
-                socket.send(_json.dumps(reply).encode('utf-8'))
-                message_count += 1
-                if message_count % 10 == 0:
-                    threading.Thread(target=maybe_trigger_sync, daemon=True).start()
-            continue
+        }
 
-        elif service == "channels":
-            dados = request["data"]
-            channels = []
-            try:
-                with open("/app/storage-server/channels.txt", "r", encoding="utf-8") as f:
-                    for line in f:
-                        channel = line.strip().split(",")[0]
-                        if channel:
-                            channels.append(channel)
-            except FileNotFoundError:
-                channels = []
-            time_br = datetime.now(br_tz).strftime("%H:%M:%S")
-            c = increment_clock_before_send()
-            reply = {
-                "service": "channels",
-                "data": {
-                    "timestamp": time_br,
-                    "channels": channels,
-                    "clock": c
-                }
+    c = increment_clock_before_send()
+    if not registered:
+        return {
+            "service": "login",
+            "data": {
+                "status": "logado",
+                "timestamp": time_br,
+                "description": f"Usuário '{user}' já está cadastrado e logado.",
+                "clock": c,
+                "user": user
             }
-            pretty_print(reply.get("service"), reply.get("data", {}))
-            try:
-                socket.send(msgpack.packb(reply, use_bin_type=True))
-                message_count += 1
-                if message_count % 10 == 0:
-                    threading.Thread(target=maybe_trigger_sync, daemon=True).start()
-            except Exception:
-                import json as _json
-                socket.send(_json.dumps(reply).encode('utf-8'))
-                message_count += 1
-                if message_count % 10 == 0:
-                    threading.Thread(target=maybe_trigger_sync, daemon=True).start()
-            continue
+        }
+    # usuário não existia -> registrado, responde sucesso
+    return {
+        "service": "login",
+        "data": {
+            "status": "sucesso",
+            "timestamp": time_br,
+            "description": "Login registrado com sucesso.",
+            "clock": c,
+            "user": user
+        }
+    }
 
-        elif service == "publish":
-            dados = request["data"]
-            user = dados.get("user")
-            channel = dados.get("channel")
-            message = dados.get("message")
-            timestamp = dados.get("timestamp")
-            status = "OK"
-            error_msg = ""
-            time_br = datetime.now(br_tz).strftime("%H:%M:%S")
-            # Verifica se canal existe
-            canais_existentes = set()
-            try:
-                with open("/app/storage-server/channels.txt", "r", encoding="utf-8") as f:
-                    for line in f:
-                        c = line.strip().split(",")[0]
-                        if c:
-                            canais_existentes.add(c)
-            except FileNotFoundError:
-                pass
-            if not channel or channel not in canais_existentes:
+
+def handle_users(dados):
+    users = user_registry.users()
+    time_br = datetime.now(br_tz).strftime("%H:%M:%S")
+    c = increment_clock_before_send()
+    return {
+        "service": "users",
+        "data": {
+            "timestamp": time_br,
+            "users": users,
+            "clock": c
+        }
+    }
+
+
+def handle_channel(dados):
+    channel = dados.get("channel")
+    timestamp = dados.get("timestamp")
+    status = "sucesso"
+    description = ""
+    time_br = datetime.now(br_tz).strftime("%H:%M:%S")
+    if not channel or not timestamp:
+        status = "erro"
+        description = "Dados de canal inválidos: 'channel' ou 'timestamp' ausente."
+    else:
+        try:
+            if not channel_catalog.add(channel, timestamp):
                 status = "erro"
-                error_msg = "Canal não existe."
-            else:
-                # Publica mensagem no canal via Pub/Sub
-                try:
-                    pub_context = zmq.Context()
-                    pub_socket = pub_context.socket(zmq.PUB)
-                    pub_socket.connect("tcp://proxy_pubsub:5557")
-                    # increment logical clock before publishing to channel
-                    c_pub = increment_clock_before_send()
-                    pub_socket.send_string(f"{channel} {user}: {message} [{time_br}] (clock={c_pub})")
-                    pub_socket.close()
-                    pub_context.term()
-                    # Salva histórico
-                    os.makedirs("/app/storage-server", exist_ok=True)
-                    with open("/app/storage-server/historico_pubsub.txt", "a", encoding="utf-8") as f:
-                        f.write(f"{channel},{user},{message},{time_br},{c_pub}\n")
-                except Exception as e:
-                    status = "erro"
-                    error_msg = f"Erro ao publicar: {str(e)}"
-            c = increment_clock_before_send()
-            reply = {
-                "service": "publish",
-                "data": {
-                    "status": status,
-                    "message": error_msg,
-                    "timestamp": time_br,
-                    "clock": c
-                }
-            }
-            pretty_print(reply.get("service"), reply.get("data", {}))
+                description = f"Canal '{channel}' já existe."
+        except Exception as e:
+            status = "erro"
+            description = f"Erro ao gravar canal: {str(e)}"
+    c = increment_clock_before_send()
+    return {
+        "service": "channel",
+        "data": {
+            "status": status,
+            "timestamp": time_br,
+            "description": description,
+            "clock": c
+        }
+    }
+
+
+def handle_channels(dados):
+    channels = channel_catalog.channels()
+    time_br = datetime.now(br_tz).strftime("%H:%M:%S")
+    c = increment_clock_before_send()
+    return {
+        "service": "channels",
+        "data": {
+            "timestamp": time_br,
+            "channels": channels,
+            "clock": c
+        }
+    }
+
+
+def handle_publish(dados):
+    user = dados.get("user")
+    channel = dados.get("channel")
+    message = dados.get("message")
+    status = "OK"
+    error_msg = ""
+    seq = None
+    time_br = datetime.now(br_tz).strftime("%H:%M:%S")
+    # Verifica se canal existe
+    if not channel or not channel_catalog.exists(channel):
+        status = "erro"
+        error_msg = "Canal não existe."
+    else:
+        # Publica mensagem no canal via Pub/Sub
+        try:
+            with history_lock:
+                # increment logical clock before publishing to channel
+                c_pub = increment_clock_before_send()
+                publisher.publish(channel, user, message, c_pub, time_br,
+                                  f"{user}: {message} [{time_br}] (clock={c_pub})", trace=dados.get("trace"))
+                # Salva histórico (gravado em lote pelo history_writer)
+                seq = history_writer.append(HISTORY_PUBSUB_FILE, f"{channel},{user},{message},{time_br},{c_pub}\n",
+                                            {"type": "publish", "channel": channel, "user": user, "message": message,
+                                             "timestamp": time_br, "clock": c_pub})
+        except Exception as e:
+            status = "erro"
+            error_msg = f"Erro ao publicar: {str(e)}"
+    ack = history_ack(seq, dados.get("durable"))
+    c = increment_clock_before_send()
+    return {
+        "service": "publish",
+        "data": {
+            "status": status,
+            "message": error_msg,
+            "timestamp": time_br,
+            "clock": c,
+            **ack
+        }
+    }
+
+
+def handle_history(dados):
+    channel = dados.get("channel")
+    user = dados.get("user")
+    time_br = datetime.now(br_tz).strftime("%H:%M:%S")
+    messages, next_cursor = [], None
+    status, error_msg = "OK", ""
+    if bool(channel) == bool(user):
+        status, error_msg = "erro", "Informe 'channel' ou 'user'."
+    else:
+        try:
+            limit = max(1, min(int(dados.get("limit") or 50), HISTORY_MAX_LIMIT))
+            before = dados.get("before")
+            after = dados.get("after")
+            key = "c-" if channel else "u-"
+            key += urllib.parse.quote(str(channel or user), safe="")
+            start = time.perf_counter()
+            messages, next_cursor = query_history(key, limit,
+                                                  before=int(before) if before is not None else None,
+                                                  after=int(after) if after is not None else None,
+                                                  cursor=dados.get("cursor"))
+            metrics.observe("storage_seconds", time.perf_counter() - start, op="read", target="history")
+        except Exception as e:
+            status, error_msg = "erro", f"Erro ao consultar histórico: {str(e)}"
+    c = increment_clock_before_send()
+    return {
+        "service": "history",
+        "data": {
+            "status": status,
+            "message": error_msg,
+            "messages": messages,
+            "next_cursor": next_cursor,
+            "timestamp": time_br,
+            "clock": c
+        }
+    }
+
+
+def handle_batch(dados):
+    """Run an ordered list of sub-requests in one round trip.
+
+    Item clocks are merged into the logical clock once, up front; each item then
+    runs through its normal handler and gets its own reply (and clock tick). A
+    failing item yields an error reply in its slot without stopping the rest.
+    """
+    items = dados.get("requests")
+    t_recv = time.time_ns()
+    time_br = datetime.now(br_tz).strftime("%H:%M:%S")
+    replies = []
+    status, error_msg = "OK", ""
+    if not isinstance(items, list):
+        status, error_msg = "erro", "Informe 'requests' como uma lista de {service, data}."
+    elif len(items) > BATCH_MAX:
+        status, error_msg = "erro", f"Lote com {len(items)} itens excede o limite de {BATCH_MAX}."
+    else:
+        clocks = [item.get("data", {}).get("clock") for item in items
+                  if isinstance(item, dict) and isinstance(item.get("data"), dict)]
+        try:
+            merged = max(int(x) for x in clocks if x is not None)
+        except (TypeError, ValueError):
+            merged = None
+        update_clock_on_receive(merged)
+        for item in items:
+            service = item.get("service") if isinstance(item, dict) else None
+            handler = BATCH_SERVICES.get(service)
             try:
-                socket.send(msgpack.packb(reply, use_bin_type=True))
-                message_count += 1
-                if message_count % 10 == 0:
-                    threading.Thread(target=maybe_trigger_sync, daemon=True).start()
-            except Exception:
-                import json as _json
-                socket.send(_json.dumps(reply).encode('utf-8'))
-                message_count += 1
-                if message_count % 10 == 0:
-                    threading.Thread(target=maybe_trigger_sync, daemon=True).start()
-            continue
+                if handler is None:
+                    raise ValueError(f"servico '{service}' nao permitido em lote")
+                stamp_trace(service, item.get("data"), t_recv)
+                replies.append(handler(item.get("data") or {}))
+            except Exception as e:
+                replies.append({"service": service or "error", "data": {
+                    "status": "erro", "message": str(e), "clock": increment_clock_before_send()}})
+    c = increment_clock_before_send()
+    return {
+        "service": "batch",
+        "data": {
+            "status": status,
+            "message": error_msg,
+            "replies": replies,
+            "errors": sum(1 for r in replies if r.get("data", {}).get("status") == "erro"),
+            "timestamp": time_br,
+            "clock": c
+        }
+    }
+
+
+SERVICES = {
+    "message": handle_message,
+    "login": handle_login,
+    "users": handle_users,
+    "channel": handle_channel,
+    "channels": handle_channels,
+    "publish": handle_publish,
+    "history": handle_history,
+    "batch": handle_batch,
+}
+# services allowed inside a batch ('history' reads are unbounded disk work and stay out)
+BATCH_SERVICES = {name: SERVICES[name] for name in ("login", "channel", "publish", "message", "users", "channels")}
+
+
+def handle_request(request):
+    """Dispatch one decoded request to its service handler and return the reply map."""
+    t_recv = time.time_ns()
+    # Update logical clock from incoming message if it has one
+    try:
+        incoming_clock = None
+        if isinstance(request, dict):
+            incoming_clock = request.get("data", {}).get("clock")
+        update_clock_on_receive(incoming_clock)
+    except Exception:
+        pass
+    service = request.get("service")
+    handler = SERVICES.get(service)
+    if handler is None:
+        # Serviço desconhecido
+        metrics.incr("request_errors", service="unknown")
+        c = increment_clock_before_send()
+        return {"service": "error", "data": {"status": "erro", "message": "servico desconhecido", "clock": c}}
+    data = request.get("data") or {}
+    stamp_trace(service, data, t_recv)
+    start = time.perf_counter()
+    failed = True
+    try:
+        reply = handler(data)
+        failed = reply.get("data", {}).get("status") == "erro"
+    finally:
+        metrics.observe("request_seconds", time.perf_counter() - start, service=service)
+        if failed:
+            metrics.incr("request_errors", service=service)
+    pretty_print(reply.get("service"), reply.get("data", {}))
+    return reply
+
+
+def count_message():
+    """Count a reply; the sync scheduler decides when the next round runs."""
+    global message_count
+    with clock_lock:
+        message_count += 1
+    sync_scheduler.notify_message()
+
+
+def error_reply(e):
+    import traceback
+    print("Erro ao processar requisição:", str(e))
+    traceback.print_exc()
+    c = increment_clock_before_send()
+    return {"service": "error", "data": {"status": "erro", "message": str(e), "clock": c}}
 
+
+def encode_reply(reply):
+    try:
+        out = msgpack.packb(reply, use_bin_type=True)
+    except Exception:
+        out = json.dumps(reply).encode('utf-8')
+    count_message()
+    return out
+
+
+def process_raw(raw):
+    """Decode a raw request, run it and return the encoded reply."""
+    try:
+        reply = handle_request(decode_request(raw))
+    except Exception as e:
+        reply = error_reply(e)
+    return encode_reply(reply)
+
+
+def serve_rep():
+    """Legacy mode: one REP socket, one request at a time.
+
+    Pipelined DEALER clients put a correlation id frame before the payload
+    ([b"", req_id, payload]); every frame before the payload is echoed back.
+    """
+    socket = context.socket(zmq.REP)
+    socket.connect(f"tcp://{BROKER_ADDR}")
+    while True:
+        try:
+            frames = socket.recv_multipart()
+            socket.send_multipart(frames[:-1] + [process_raw(frames[-1])])
+        except Exception as e:
+            print("Erro no loop REP:", e)
+
+
+def request_worker(ctx, backend_addr):
+    """Worker thread: handles requests forwarded by the inproc DEALER.
+
+    Messages arrive with their full routing envelope; the last frame is the
+    payload and every frame before it is echoed back so the ROUTER front end
+    can route the reply.
+    """
+    sock = ctx.socket(zmq.DEALER)
+    sock.connect(backend_addr)
+    while True:
+        try:
+            frames = sock.recv_multipart()
+            sock.send_multipart(frames[:-1] + [process_raw(frames[-1])])
+        except Exception as e:
+            print("Erro no worker:", e)
+
+
+def serve_threads(workers):
+    """ROUTER front end connected to the broker, N worker threads behind an inproc DEALER."""
+    frontend = context.socket(zmq.ROUTER)
+    frontend.connect(f"tcp://{BROKER_ADDR}")
+    backend = context.socket(zmq.DEALER)
+    backend_addr = "inproc://request-workers"
+    backend.bind(backend_addr)
+    for _ in range(workers):
+        threading.Thread(target=request_worker, args=(context, backend_addr), daemon=True).start()
+    print(f"[servidor] modo threads com {workers} workers")
+    zmq.proxy(frontend, backend)
+
+
+def serve_lb(workers, capacity=BROKER_CAPACITY):
+    """DEALER connected to the load-balancing broker, N worker threads behind an inproc DEALER.
+
+    The broker never sends this server more than `capacity` requests at a time,
+    so beyond that requests wait in the broker (where another server may take
+    them) instead of piling up here. A HEARTBEAT goes out every BROKER_HEARTBEAT_INTERVAL so the
+    broker can tell a dead server from a busy one; it also carries the capacity,
+    so a restarted broker picks this server up again without a new READY.
+    """
+    frontend = context.socket(zmq.DEALER)
+    frontend.connect(f"tcp://{BROKER_ADDR}")
+    capacity = str(capacity).encode()
+    frontend.send_multipart([b"", b"READY", capacity])
+    backend = context.socket(zmq.DEALER)
+    backend_addr = "inproc://request-workers"
+    backend.bind(backend_addr)
+    for _ in range(workers):
+        threading.Thread(target=request_worker, args=(context, backend_addr), daemon=True).start()
+    print(f"[servidor] modo lb com {workers} workers, capacidade {capacity.decode()}")
+    # forwarding loop instead of zmq.proxy, which leaves no room for the heartbeat
+    poller = zmq.Poller()
+    poller.register(frontend, zmq.POLLIN)
+    poller.register(backend, zmq.POLLIN)
+    next_beat = time.monotonic() + BROKER_HEARTBEAT_INTERVAL
+    while True:
+        timeout = max(0, int((next_beat - time.monotonic()) * 1000))
+        events = dict(poller.poll(timeout))
+        for src, dst in ((frontend, backend), (backend, frontend)):
+            if src in events:
+                while True:
+                    try:
+                        dst.send_multipart(src.recv_multipart(zmq.NOBLOCK))
+                    except zmq.Again:
+                        break
+        if time.monotonic() >= next_beat:
+            frontend.send_multipart([b"", b"HEARTBEAT", capacity])
+            next_beat = time.monotonic() + BROKER_HEARTBEAT_INTERVAL
+
+
+# services that touch storage files run in the default executor in asyncio mode;
+# everything else only touches in-memory state and the non-blocking PUB socket
+ASYNC_OFFLOADED_SERVICES = {"login", "channel", "history", "batch"}
+
+
+async def process_raw_async(raw):
+    try:
+        request = decode_request(raw)
+        data = request.get("data")
+        # a durable publish/message blocks on the history writer: keep it off the loop too
+        if request.get("service") in ASYNC_OFFLOADED_SERVICES or (isinstance(data, dict) and data.get("durable")):
+            reply = await asyncio.to_thread(handle_request, request)
         else:
-            # Serviço desconhecido
-            c = increment_clock_before_send()
-            unknown = {"service": "error", "data": {"status": "erro", "message": "servico desconhecido", "clock": c}}
-            try:
-                socket.send(msgpack.packb(unknown, use_bin_type=True))
-                message_count += 1
-                if message_count % 10 == 0:
-                    threading.Thread(target=maybe_trigger_sync, daemon=True).start()
-            except Exception:
-                import json as _json
-                socket.send(_json.dumps(unknown).encode('utf-8'))
-                message_count += 1
-                if message_count % 10 == 0:
-                    threading.Thread(target=maybe_trigger_sync, daemon=True).start()
-            continue
+            reply = handle_request(request)
     except Exception as e:
-        import traceback
-        print("Erro ao processar requisição:", str(e))
-        traceback.print_exc()
+        reply = error_reply(e)
+    return encode_reply(reply)
+
+
+async def admin_server_async(actx, port):
+    rep = actx.socket(zmq.REP)
+    rep.bind(f"tcp://0.0.0.0:{port}")
+    while True:
+        raw = await rep.recv()
+        await rep.send(handle_admin_request(raw))
+
+
+async def sub_servers_async(actx):
+    sub = actx.socket(zmq.SUB)
+    sub.connect(f"tcp://{PUBSUB_SUB_ADDR}")
+    sub.setsockopt_string(zmq.SUBSCRIBE, "servers")
+    sub.setsockopt_string(zmq.SUBSCRIBE, "membership")
+    while True:
         try:
-            c = increment_clock_before_send()
-            err_reply = {"service": "error", "data": {"status": "erro", "message": str(e), "clock": c}}
+            frames = await sub.recv_multipart()
+            if frames[0].startswith(b"membership"):
+                # may fall back to a full 'list' from the reference: keep it off the loop
+                await asyncio.to_thread(handle_servers_message, frames)
+            else:
+                handle_servers_message(frames)
+        except Exception:
+            await asyncio.sleep(0.1)
+
+
+async def heartbeat_async():
+    try:
+        await asyncio.to_thread(send_heartbeat)
+    except Exception:
+        pass
+    while True:
+        await asyncio.sleep(await asyncio.to_thread(next_heartbeat))
+
+
+async def index_refresh_async(interval=INDEX_REFRESH_INTERVAL):
+    """Tail logins.txt/channels.txt off the event loop; requests read the in-memory index."""
+    while True:
+        for idx in (user_registry, channel_catalog):
             try:
-                socket.send(msgpack.packb(err_reply, use_bin_type=True))
-                message_count += 1
-                if message_count % 10 == 0:
-                    threading.Thread(target=maybe_trigger_sync, daemon=True).start()
+                await asyncio.to_thread(idx.refresh)
             except Exception:
-                import json as _json
-                socket.send(_json.dumps(err_reply).encode('utf-8'))
-                message_count += 1
-                if message_count % 10 == 0:
-                    threading.Thread(target=maybe_trigger_sync, daemon=True).start()
-        except Exception:
-            pass
-        continue
\ No newline at end of file
+                pass
+        await asyncio.sleep(interval)
+
+
+async def serve_asyncio(max_inflight):
+    """ROUTER front end on zmq.asyncio: each request runs as a task, up to max_inflight at once."""
+    actx = zmq.asyncio.Context()
+    frontend = actx.socket(zmq.ROUTER)
+    frontend.connect(f"tcp://{BROKER_ADDR}")
+    user_registry.auto_refresh = False
+    channel_catalog.auto_refresh = False
+    background = [
+        asyncio.create_task(admin_server_async(actx, admin_port)),
+        asyncio.create_task(sub_servers_async(actx)),
+        asyncio.create_task(heartbeat_async()),
+        asyncio.create_task(index_refresh_async()),
+    ]
+    slots = asyncio.Semaphore(max_inflight)
+    inflight = set()
+
+    async def respond(frames):
+        try:
+            reply = await process_raw_async(frames[-1])
+            await frontend.send_multipart(frames[:-1] + [reply])
+        except Exception as e:
+            print("Erro na tarefa asyncio:", e)
+        finally:
+            slots.release()
+
+    print(f"[servidor] modo asyncio (até {max_inflight} requisições em andamento)")
+    while True:
+        await slots.acquire()
+        frames = await frontend.recv_multipart()
+        task = asyncio.create_task(respond(frames))
+        inflight.add(task)
+        task.add_done_callback(inflight.discard)
+
+
+if SERVER_MODE == "threads":
+    serve_threads(WORKERS)
+elif SERVER_MODE == "lb":
+    serve_lb(WORKERS)
+elif SERVER_MODE == "asyncio":
+    asyncio.run(serve_asyncio(ASYNC_MAX_INFLIGHT))
+else:
+    serve_rep()